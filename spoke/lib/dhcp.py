@@ -7,6 +7,10 @@ SpokeDHCPSubnets - Creation/deletion/retrieval of DHCP subnet objects.
 SpokeDHCPGroup - Creation/deletion/retrieval of DHCP group objects.
 SpokeDHCPHost - Creation/deletion/retrieval of DHCP host objects.
 SpokeDHCPAttr - Creation/deletion/retrieval of DHCP attribute objects.
+SpokeDHCPConf - Compilation of a DHCP service to dhcpd.conf files.
+
+Functions:
+read_hosts - parse a CSV or JSON stream of DHCP reservations.
 
 Exceptions:
 NotFound - raised on failure to find an object when one is expected.
@@ -16,16 +20,24 @@ TODO - create default group when creating service
 TODO - set group as optional parameter (defaults to 'default' group).
 """
 # core modules
+import os
+import re
+import csv
+import json
+import hashlib
 import logging
+import itertools
 
 # own modules
 import spoke.lib.common as common
 import spoke.lib.error as error
 import spoke.lib.config as config
+import spoke.lib.ip_helper as ip_helper
 from spoke.lib.directory import SpokeLDAP
 
 # 3rd party modules
 import ldap
+import ldap.dn
 
 class SpokeDHCPServer(SpokeLDAP):
     
@@ -40,6 +52,7 @@ class SpokeDHCPServer(SpokeLDAP):
         self.search_scope = 2 # ldap.SUB
         self.retrieve_attr = None
         self.dhcp_server_class = 'dhcpServer'
+        self.projection = ['objectClass', 'cn', 'dhcpServiceDN']
         self.dhcp_conf_suffix = self.config.get('DHCP', 'dhcp_conf_suffix', '-config') 
         
     def create(self, dhcp_server):
@@ -147,8 +160,8 @@ class SpokeDHCPSubnet(SpokeLDAP):
         
     def _get_dhcp_service(self, dhcp_server):
         """Retrieve a DHCP service object."""
-        service = SpokeDHCPService()
-        result = service.get(dhcp_server)
+        result = self._resolve('dhcp_service', dhcp_server,
+                               lambda: SpokeDHCPService().get(dhcp_server))
         if result['data'] == []:
             msg = "Can't find DHCP service for %s" % dhcp_server
             raise error.NotFound(msg)          
@@ -279,6 +292,7 @@ class SpokeDHCPHost(SpokeLDAP):
         self.dhcp_host_class = 'dhcpHost'
         self.dhcp_options_class = 'dhcpOptions'
         self.dhcp_conf_suffix = self.config.get('DHCP', 'dhcp_conf_suffix', '-config')
+        self.import_chunk = int(self.config.get('DHCP', 'import_chunk', 1000))
         self.dhcp_server = dhcp_server
         self.dhcp_group_name = group_name
         group = self._get_dhcp_group(self.dhcp_server, self.dhcp_group_name)
@@ -286,8 +300,8 @@ class SpokeDHCPHost(SpokeLDAP):
         
     def _get_dhcp_service(self, dhcp_server):
         """Retrieve a DHCP service object."""
-        service = SpokeDHCPService()
-        result = service.get(dhcp_server)
+        result = self._resolve('dhcp_service', dhcp_server,
+                               lambda: SpokeDHCPService().get(dhcp_server))
         if result['data'] == []:
             msg = "Can't find DHCP service for %s" % dhcp_server
             raise error.NotFound(msg)          
@@ -295,8 +309,8 @@ class SpokeDHCPHost(SpokeLDAP):
         
     def _get_dhcp_group(self, dhcp_server, group_name):
         """Retrieve a DHCP group object."""
-        group = SpokeDHCPGroup(dhcp_server)
-        result = group.get(group_name)
+        result = self._resolve('dhcp_group', (dhcp_server, group_name),
+                lambda: SpokeDHCPGroup(dhcp_server).get(group_name))
         if result['data'] == []:
             msg = "Can't find DHCP group %s for %s" % (group_name, dhcp_server)
             raise error.NotFound(msg)          
@@ -319,6 +333,78 @@ class SpokeDHCPHost(SpokeLDAP):
         self.log.debug('Result: %s' % result)
         return result
     
+    def _host_entry(self, host_name, mac, ip, options=None):
+        """Return (dn, dn_info) for a DHCP host with its reservation."""
+        if self.dhcp_server == host_name:
+            msg = 'DHCP hostname %s with same name as DHCP server %s' % \
+                                                (host_name, self.dhcp_server)
+            raise error.InputError(msg)
+        if not (host_name and mac and ip):
+            msg = 'DHCP host needs a hostname, MAC and IP (got %s, %s, %s)' \
+                                                        % (host_name, mac, ip)
+            raise error.InputError(msg)
+        mac = common.validate_mac(mac)
+        ip = common.validate_ip_address(ip)
+        dn = 'cn=%s,%s' % (host_name, self.dhcp_group_dn)
+        dn_attr = {'objectClass': ['top', self.dhcp_host_class,
+                                   self.dhcp_options_class],
+                   'cn': [host_name],
+                   'dhcpHWAddress': ['ethernet %s' % mac],
+                   'dhcpStatements': ['fixed-address %s' % ip],
+                   'dhcpOption': ['host-name "%s"' % host_name]}
+        if isinstance(options, basestring):
+            options = [options]
+        if options:
+            dn_attr['dhcpOption'].extend(options)
+        dn_info = [(k, v) for (k, v) in dn_attr.items()]
+        return (dn, dn_info)
+
+    def create_host(self, host_name, mac, ip, options=None):
+        """Create DHCP host with its MAC, IP and host-name option (plus any
+        extra dhcpOption values) in one add; return DHCP host objects."""
+        try:
+            (dn, dn_info) = self._host_entry(host_name, mac, ip, options)
+        except error.InputError, e:
+            self.log.error(e.msg)
+            raise e
+        result = self._create_object(dn, dn_info)
+        self.log.debug('Result: %s' % result)
+        return result
+
+    def create_hosts(self, hosts):
+        """Create many DHCP hosts, as create_host does, pipelining the adds.
+        
+        hosts is an iterable of dicts with hostname, mac, ip and optionally
+        options keys (as read_hosts yields); it is consumed import_chunk
+        hosts at a time. Yields (host_name, result) in input order, where
+        result is the create_host result or the Spoke exception raised."""
+        hosts = iter(hosts)
+        while True:
+            chunk = list(itertools.islice(hosts, self.import_chunk))
+            if not chunk:
+                break
+            names = []
+            entries = []
+            failed = {}
+            for host in chunk:
+                host_name = host.get('hostname')
+                try:
+                    entry = self._host_entry(host_name, host.get('mac'),
+                                             host.get('ip'),
+                                             host.get('options'))
+                except error.InputError, e:
+                    failed[len(names)] = e
+                    names.append(host_name)
+                    continue
+                names.append(host_name)
+                entries.append(entry)
+            results = iter(self._create_objects(entries))
+            for (index, host_name) in enumerate(names):
+                if index in failed:
+                    yield (host_name, failed[index])
+                else:
+                    yield (host_name, results.next())
+
     def get(self, host_name):
         """Search for a DHCP host_name; return a results list."""
         dn = 'cn=%s,%s' % (host_name, self.dhcp_group_dn)
@@ -371,8 +457,8 @@ class SpokeDHCPAttr(SpokeLDAP):
     
     def _get_dhcp_service(self, dhcp_server):
         """Retrieve a DHCP service object."""
-        service = SpokeDHCPService()
-        result = service.get(dhcp_server)
+        result = self._resolve('dhcp_service', dhcp_server,
+                               lambda: SpokeDHCPService().get(dhcp_server))
         if result['data'] == []:
             msg = "Can't find DHCP service for %s" % dhcp_server
             raise error.NotFound(msg)          
@@ -380,8 +466,8 @@ class SpokeDHCPAttr(SpokeLDAP):
     
     def _get_dhcp_group(self, dhcp_server, group_name):
         """Retrieve a DHCP group object."""
-        group = SpokeDHCPGroup(dhcp_server)
-        result = group.get(group_name)
+        result = self._resolve('dhcp_group', (dhcp_server, group_name),
+                lambda: SpokeDHCPGroup(dhcp_server).get(group_name))
         if result['data'] == []:
             msg = "Can't find DHCP group for %s" % dhcp_server
             raise error.NotFound(msg)          
@@ -389,8 +475,9 @@ class SpokeDHCPAttr(SpokeLDAP):
     
     def _get_dhcp_host(self, dhcp_server, group_name, host_name):
         """Retrieve a DHCP host object."""
-        host = SpokeDHCPHost(dhcp_server, group_name)
-        result = host.get(host_name)
+        name = (dhcp_server, group_name, host_name)
+        result = self._resolve('dhcp_host', name,
+                lambda: SpokeDHCPHost(dhcp_server, group_name).get(host_name))
         if result['data'] == []:
             msg = "Can't find DHCP host for %s in group %s" % (dhcp_server, \
                                                                     group_name)
@@ -433,3 +520,246 @@ class SpokeDHCPAttr(SpokeLDAP):
         result = self._delete_object(dn, dn_info)
         self.log.debug('Result: %s' % result)
         return result
+
+class SpokeDHCPConf(SpokeLDAP):
+    
+    """Compile a DHCP service's LDAP tree into dhcpd.conf files."""
+    
+    def __init__(self, dhcp_server, conf_dir=None):
+        """Get config, setup logging and LDAP connection."""
+        SpokeLDAP.__init__(self)
+        self.config = config.setup()
+        self.log = logging.getLogger(__name__)
+        self.base_dn = self.config.get('DHCP', 'dhcp_basedn')
+        self.search_scope = 2 # ldap.SUB
+        self.retrieve_attr = ['objectClass', 'cn', 'dhcpNetMask', 'dhcpRange',
+                              'dhcpHWAddress', 'dhcpStatements', 'dhcpOption']
+        self.dhcp_conf_suffix = self.config.get('DHCP', 'dhcp_conf_suffix', '-config')
+        if not conf_dir:
+            conf_dir = self.config.get('DHCP', 'dhcp_conf_dir', 
+                                       '/etc/dhcp/spoke')
+        self.conf_dir = common.validate_filename(conf_dir)
+        self.conf_file = self.config.get('DHCP', 'dhcp_conf_file', 'dhcpd.conf')
+        self.manifest = os.path.join(self.conf_dir, '.spoke-dhcp.json')
+        self.dhcp_server = dhcp_server
+        self.dhcp_service = self._get_dhcp_service(self.dhcp_server)
+        self.dhcp_service_dn = self.dhcp_service['data'][0].__getitem__(0)
+        
+    def _get_dhcp_service(self, dhcp_server):
+        """Retrieve a DHCP service object."""
+        result = self._resolve('dhcp_service', dhcp_server,
+                               lambda: SpokeDHCPService().get(dhcp_server))
+        if result['data'] == []:
+            msg = "Can't find DHCP service for %s" % dhcp_server
+            raise error.NotFound(msg)          
+        return result
+    
+    def _read_tree(self):
+        """Page through the service subtree once; return (entries, children)
+        where entries maps dn to attrs and children a dn to its child dns.
+        Both are keyed by the normalised, lower cased dn."""
+        entries = {}
+        children = {}
+        for (dn, attrs) in self._iter_objects(self.dhcp_service_dn, 
+                                              self.search_scope, 
+                                              '(objectClass=*)',
+                                              self.retrieve_attr):
+            entries[_dn_key(dn)] = (dn, attrs)
+        service_key = _dn_key(self.dhcp_service_dn)
+        for key in entries:
+            parent = ldap.dn.dn2str(ldap.dn.str2dn(key)[1:])
+            if key != service_key and parent in entries:
+                children.setdefault(parent, []).append(key)
+        for keys in children.values():
+            keys.sort()
+        return (entries, children)
+    
+    def _statements(self, attrs, indent):
+        """Return dhcpd.conf statement lines for an entry's attributes."""
+        lines = []
+        for value in attrs.get('dhcpHWAddress', []):
+            lines.append('%shardware %s;' % (indent, value))
+        for value in attrs.get('dhcpRange', []):
+            lines.append('%srange %s;' % (indent, value))
+        for value in attrs.get('dhcpStatements', []):
+            lines.append('%s%s;' % (indent, value))
+        for value in attrs.get('dhcpOption', []):
+            lines.append('%soption %s;' % (indent, value))
+        return lines
+    
+    def _declaration(self, key, entries, children, files, prefix=''):
+        """Add the fragment declaring an entry to files, with an include of
+        each child's own fragment in place of the child; return the
+        fragment's file name, or None for an unsupported entry."""
+        (dn, attrs) = entries[key]
+        classes = [c.lower() for c in attrs.get('objectClass', [])]
+        name = attrs.get('cn', [''])[0]
+        if 'dhcphost' in classes:
+            lines = ['host %s {' % name]
+        elif 'dhcpgroup' in classes:
+            lines = ['# %s' % name, 'group {']
+        elif 'dhcpsubnet' in classes:
+            mask = int(attrs.get('dhcpNetMask', ['32'])[0])
+            netmask = ip_helper.int_to_ip((0xffffffffL << (32 - mask)) & 
+                                          0xffffffffL)
+            lines = ['subnet %s netmask %s {' % (name, netmask)]
+        else:
+            self.log.debug('Skipping unsupported DHCP entry %s' % dn)
+            return None
+        file_name = self._fragment_name(key, entries, prefix)
+        lines.extend(self._statements(attrs, '    '))
+        for child in children.get(key, []):
+            child_name = self._declaration(child, entries, children, files,
+                                           file_name[:-len('.conf')] + '.')
+            if child_name is not None:
+                lines.append('    include "%s";' % 
+                             os.path.join(self.conf_dir, child_name))
+        lines.append('}')
+        files[file_name] = '\n'.join(lines) + '\n'
+        return file_name
+    
+    def _fragment_name(self, key, entries, prefix=''):
+        """Return the file name holding an entry's declaration; prefix is
+        its parent's, so entries of one name in two groups do not clash."""
+        (dn, attrs) = entries[key]
+        rdn = ldap.dn.str2dn(dn)[0][0][1]
+        classes = [c.lower() for c in attrs.get('objectClass', [])]
+        kind = 'entry'
+        for (object_class, kind_name) in (('dhcphost', 'host'), 
+                                          ('dhcpgroup', 'group'),
+                                          ('dhcpsubnet', 'subnet')):
+            if object_class in classes:
+                kind = kind_name
+        return '%s%s-%s.conf' % (prefix, kind, 
+                                 re.sub('[^A-Za-z0-9_-]', '_', rdn))
+    
+    def _render(self):
+        """Return {file name: content} for the service."""
+        (entries, children) = self._read_tree()
+        service_key = _dn_key(self.dhcp_service_dn)
+        if service_key not in entries:
+            msg = "Can't read DHCP service %s" % self.dhcp_service_dn
+            raise error.NotFound(msg)
+        files = {}
+        includes = []
+        for key in children.get(service_key, []):
+            name = self._declaration(key, entries, children, files)
+            if name is not None:
+                includes.append('include "%s";' % 
+                                os.path.join(self.conf_dir, name))
+        (dn, attrs) = entries[service_key]
+        lines = ['# Generated by spoke from %s; do not edit' % dn]
+        lines.extend(self._statements(attrs, ''))
+        lines.extend(includes)
+        files[self.conf_file] = '\n'.join(lines) + '\n'
+        return files
+    
+    def _load_manifest(self):
+        """Return the file hashes recorded by the last export."""
+        try:
+            manifest = open(self.manifest)
+        except IOError:
+            return {'files': {}}
+        try:
+            try:
+                return json.load(manifest)
+            except ValueError:
+                return {'files': {}}
+        finally:
+            manifest.close()
+    
+    def _write_file(self, name, content):
+        """Replace a file in conf_dir atomically."""
+        path = os.path.join(self.conf_dir, name)
+        tmp = path + '.tmp'
+        conf = open(tmp, 'w')
+        try:
+            conf.write(content)
+        finally:
+            conf.close()
+        os.rename(tmp, path)
+        return path
+    
+    def export(self):
+        """Write dhcpd.conf and a fragment per subnet, group and host to
+        conf_dir, rewriting only those whose content hash changed since
+        the last export; return the paths written or removed.
+        
+        A fragment includes its children's fragments rather than holding
+        them, so a changed host rewrites only its own file."""
+        if not os.path.isdir(self.conf_dir):
+            msg = "DHCP config directory %s not found" % self.conf_dir
+            raise error.NotFound(msg)
+        files = self._render()
+        digests = dict((name, hashlib.sha1(content).hexdigest())
+                       for (name, content) in files.items())
+        old = self._load_manifest()
+        changed = []
+        for (name, content) in sorted(files.items()):
+            path = os.path.join(self.conf_dir, name)
+            if old['files'].get(name) == digests[name] and \
+                                                    os.path.isfile(path):
+                continue
+            changed.append(self._write_file(name, content))
+        for name in sorted(old['files']):
+            path = os.path.join(self.conf_dir, str(name))
+            if name not in files and os.path.isfile(path):
+                os.remove(path)
+                changed.append(path)
+        manifest = {'files': digests}
+        self._write_file(os.path.basename(self.manifest), 
+                         json.dumps(manifest, sort_keys=True, indent=1))
+        result = common.process_results(changed, 'DHCP config file')
+        if changed:
+            result['msg'] = 'Updated %s DHCP config file(s):' % len(changed)
+        else:
+            result['msg'] = 'DHCP config for %s is up to date' % \
+                                                            self.dhcp_server
+        self.log.debug('Result: %s' % result)
+        return result
+    
+def _dn_key(dn):
+    """Return dn lower cased and in one canonical string form."""
+    return ldap.dn.dn2str(ldap.dn.str2dn(dn.lower()))
+
+def _encode(value):
+    """Return value with any unicode from json converted to UTF-8 str."""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_encode(v) for v in value]
+    if isinstance(value, dict):
+        return dict((_encode(k), _encode(v)) for (k, v) in value.items())
+    return value
+
+def read_hosts(stream, format='csv'):
+    """Parse DHCP reservations from an open file; yield a dict per host.
+    
+    CSV rows are HOST_NAME,MAC,IP followed by any extra dhcpOption values;
+    blank lines and lines starting with # are skipped. JSON is a list of
+    objects with hostname, mac, ip and optionally an options list."""
+    if format == 'json':
+        try:
+            hosts = json.load(stream)
+        except ValueError, e:
+            raise error.InputError('Invalid JSON host list: %s' % e)
+        if not isinstance(hosts, list):
+            raise error.InputError('JSON host list must be a list of hosts')
+        for host in hosts:
+            if not isinstance(host, dict):
+                msg = 'Invalid JSON host entry: %s' % host
+                raise error.InputError(msg)
+            yield _encode(host)
+    elif format == 'csv':
+        for row in csv.reader(stream):
+            if not row or not row[0].strip() or row[0].startswith('#'):
+                continue
+            row = [field.strip() for field in row]
+            if len(row) < 3:
+                msg = 'Expected HOST_NAME,MAC,IP; got: %s' % ','.join(row)
+                raise error.InputError(msg)
+            yield {'hostname': row[0], 'mac': row[1], 'ip': row[2],
+                   'options': row[3:]}
+    else:
+        msg = 'Unknown host list format %s; use csv or json' % format
+        raise error.InputError(msg)
@@ -1,6 +1,12 @@
 """Provides LDAP access and management.
 
 Classes:
+SpokeLDAPConn - bounded pool of bound, self healing LDAP connections.
+SpokeLDAPHandle - stand-in for an LDAP object; runs each call on the pool.
+SpokeDNCache - bounded, expiring cache of name to object lookups.
+SpokeSearchCache - bounded, expiring cache of search results.
+SpokeSearchCacheKV - search result cache shared between processes in Redis.
+SpokeLDAPWatcher - thread invalidating the search cache on directory changes.
 SpokeLDAP - extends ldap with several convenience classes.
 
 Exceptions:
@@ -16,7 +22,14 @@ SpokeLDAPError - raised on errors during LDAP operations.
 TODO - greater use of ValidationError instead of NotFound or AlreadyExists
 """
 # core modules
+import copy
+import json
+import time
+import hashlib
+import Queue
+import collections
 import logging
+import threading
 import traceback
 
 # own modules
@@ -28,11 +41,38 @@ import spoke.lib.common as common
 try:
     import ldap
     import ldap.modlist
+    import ldap.ldapobject
 except:
     msg = 'Failed to import ldap'
     raise error.SpokeLDAPError(msg)
+try:
+    from ldap.controls.readentry import PreReadControl, PostReadControl
+except ImportError:
+    PreReadControl = PostReadControl = None # Older python-ldap
+try:
+    from ldap.controls import SimplePagedResultsControl
+except ImportError:
+    SimplePagedResultsControl = None
+try:
+    from ldap.controls import LDAPControl
+    from ldap.extop import ExtendedRequest
+except ImportError:
+    ExtendedRequest = None
+try:
+    from ldap.syncrepl import SyncreplConsumer
+except ImportError:
+    SyncreplConsumer = None
+
+# LDAP Transactions (RFC 5805)
+TXN_START = '1.3.6.1.1.21.1'
+TXN_SPEC = '1.3.6.1.1.21.2'
+TXN_END = '1.3.6.1.1.21.3'
 
 hLDAP = None
+hDNCache = None
+hSearchCache = False # None once setup finds the cache turned off
+NO_ATTRS = ['1.1'] # Request no attributes, just the dn (RFC 4511)
+_PENDING = object() # Bulk write not yet answered
 
 def setup():
     """Instantiate (once only) and return LDAP connection object"""
@@ -43,9 +83,49 @@ def setup():
         hLDAP = SpokeLDAPConn()  
     return hLDAP
 
+def dn_cache():
+    """Instantiate (once only) and return the DN resolution cache."""
+    global hDNCache
+    if hDNCache is None:
+        hDNCache = SpokeDNCache()
+    return hDNCache
+
+def search_cache():
+    """Instantiate (once only) and return the search cache, or None."""
+    global hSearchCache
+    if hSearchCache is False:
+        conf = config.setup()
+        backend = conf.get('LDAP', 'search_cache', 'no')
+        if backend == 'memory':
+            hSearchCache = SpokeSearchCache()
+        elif backend == 'kv':
+            hSearchCache = SpokeSearchCacheKV()
+        elif backend == 'no':
+            hSearchCache = None
+        else:
+            msg = 'search_cache must be one of no, memory, kv'
+            raise error.ConfigError(msg)
+        if hSearchCache is not None and \
+                    conf.get('LDAP', 'search_cache_watch', 'no') == 'yes':
+            SpokeLDAPWatcher(hSearchCache).start()
+    return hSearchCache
+
+def _dn_related(dn, other):
+    """Return True if one of two lower cased dns is at or below the other."""
+    return dn == other or dn.endswith(',' + other) or \
+                                                other.endswith(',' + dn)
+
 class SpokeLDAPConn:
     
-    """Extend ldap class with convenience methods."""
+    """Bounded pool of bound LDAP connections.
+    
+    Connections are opened on demand up to pool_size, checked with a
+    whoami before reuse once idle for check_interval seconds, and are
+    ReconnectLDAPObjects so they rebind themselves after a server restart.
+    A thread asking again while it holds a connection is lent the same one,
+    so it can not deadlock on itself (e.g. searching while it iterates a
+    paged search). With thread_affinity each thread keeps the connection it
+    first took."""
     
     def __init__(self):
         """Bind to LDAP directory, return an ldap object."""
@@ -57,13 +137,33 @@ class SpokeLDAPConn:
         self.bind_dn = self.config.get('LDAP', 'binddn')
         self.start_tls = self.config.get('LDAP', 'start_tls', False)
         self.bind_password = self.config.get('LDAP', 'bindpw')
+        self.pool_size = int(self.config.get('LDAP', 'pool_size', 4))
+        self.pool_timeout = float(self.config.get('LDAP', 'pool_timeout', 30))
+        self.check_interval = float(self.config.get('LDAP', 'check_interval',
+                                                    60))
+        self.retry_max = int(self.config.get('LDAP', 'retry_max', 3))
+        self.retry_delay = float(self.config.get('LDAP', 'retry_delay', 1))
+        self.thread_affinity = self.config.get('LDAP', 'thread_affinity', 'no')
+        self.uri = 'ldap://%s:%s' % (self.server, self.port)
+        # Idle connections as (connection, last used); None is an unopened slot
+        self.idle = Queue.LifoQueue()
+        for i in range(self.pool_size - 1):
+            self.idle.put(None)
+        self.local = threading.local()
+        self.extensions = None # Root DSE supportedExtension, read on demand
+        # Bind one connection now so a bad config fails straight away
+        self.idle.put((self._connect(), time.time()))
+        self.LDAP = SpokeLDAPHandle(self)
+
+    def _connect(self):
+        """Open and bind a new LDAP connection."""
         try:
-            self.LDAP = ldap.initialize('ldap://%s:%s' %
-                                         (self.server, self.port))
-            self.LDAP.protocol_version = 3 #ldap.VERSION3
+            conn = ldap.ldapobject.ReconnectLDAPObject(self.uri,
+                        retry_max=self.retry_max, retry_delay=self.retry_delay)
+            conn.protocol_version = 3 #ldap.VERSION3
             if self.start_tls:
-                self.LDAP.start_tls_s()
-            self.LDAP.simple_bind_s(self.bind_dn, self.bind_password)
+                conn.start_tls_s()
+            conn.simple_bind_s(self.bind_dn, self.bind_password)
             self.log.debug('Bound to LDAP server %s:%s as %s' % 
                            (self.server, self.port, self.bind_dn))
         except ldap.LDAPError:
@@ -75,53 +175,620 @@ class SpokeLDAPConn:
             trace = traceback.format_exc()
             msg = 'Unknown error'
             raise error.SpokeError(msg, trace)
+        return conn
+
+    def _alive(self, conn):
+        """Return True if conn still answers the server."""
+        try:
+            conn.whoami_s()
+        except ldap.LDAPError:
+            self.log.debug('Discarding dead LDAP connection')
+            try:
+                conn.unbind_s()
+            except ldap.LDAPError:
+                pass
+            return False
+        return True
+
+    def acquire(self):
+        """Take a connection from the pool, opening one if needed."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            self.local.holds += 1
+            return conn
+        try:
+            item = self.idle.get(timeout=self.pool_timeout)
+        except Queue.Empty:
+            msg = 'No LDAP connection free after %ss (pool_size %s)' % \
+                (self.pool_timeout, self.pool_size)
+            raise error.SpokeLDAPError(msg)
+        try:
+            if item is None:
+                conn = self._connect()
+            else:
+                (conn, last_used) = item
+                if time.time() - last_used > self.check_interval and \
+                                                    not self._alive(conn):
+                    conn = self._connect()
+        except:
+            self.idle.put(None) # Give the slot back
+            raise
+        self.local.conn = conn
+        self.local.holds = 1
+        return conn
+
+    def release(self, conn, broken=False):
+        """Return a connection to the pool (or drop it if broken).
+        
+        The connection goes back once every hold this thread took on it is
+        released; a connection already dropped as broken is ignored."""
+        if getattr(self.local, 'conn', None) is not conn:
+            return
+        self.local.holds -= 1
+        if broken:
+            self.local.conn = None
+            self.idle.put(None)
+        elif self.local.holds == 0 and self.thread_affinity != 'yes':
+            self.local.conn = None
+            self.idle.put((conn, time.time()))
+
+    def release_thread(self):
+        """Return the calling thread's affine connection to the pool."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None and self.local.holds == 0:
+            self.local.conn = None
+            self.idle.put((conn, time.time()))
+
+    def run(self, func, *args, **kwargs):
+        """Run func(conn, *args, **kwargs) on a pooled connection.
+        
+        ReconnectLDAPObject retries synchronous calls itself; if the server
+        is still reported down, the call is retried once on a fresh
+        connection before the error is passed on."""
+        conn = self.acquire()
+        try:
+            result = func(conn, *args, **kwargs)
+        except ldap.SERVER_DOWN:
+            self.log.debug('LDAP server down, reconnecting')
+            self.release(conn, broken=True)
+            conn = self.acquire()
+            try:
+                result = func(conn, *args, **kwargs)
+            except ldap.SERVER_DOWN:
+                self.release(conn, broken=True)
+                raise
+            except:
+                self.release(conn)
+                raise
+        except:
+            self.release(conn)
+            raise
+        self.release(conn)
+        return result
+
+    def supports(self, oid):
+        """Return True if the server lists extended operation oid."""
+        if self.extensions is None:
+            try:
+                result = self.call('search_s', '', ldap.SCOPE_BASE,
+                                   '(objectClass=*)', ['supportedExtension'])
+            except ldap.LDAPError:
+                result = []
+            self.extensions = []
+            if result:
+                self.extensions = result[0][1].get('supportedExtension', [])
+        return oid in self.extensions
+
+    def call(self, method, *args, **kwargs):
+        """Run an LDAP method on a pooled connection."""
+        return self.run(lambda conn, *a, **k: getattr(conn, method)(*a, **k),
+                        *args, **kwargs)
+
+def _write_ext(conn, op, args, ctrls):
+    """Run an asynchronous write on conn; return its response controls.
+    
+    The request and its result must use the same connection, so this runs
+    as a single unit on the pool rather than as two handle calls."""
+    msgid = getattr(conn, op + '_ext')(*args, serverctrls=ctrls)
+    rtype, rdata, rmsgid, rctrls = conn.result3(msgid)
+    return rctrls
+
+def _txn_end_value(txn_id, commit=True):
+    """Return the BER encoded End Transaction request for txn_id."""
+    def tlv(tag, value):
+        length = len(value)
+        if length < 0x80:
+            return tag + chr(length) + value
+        octets = ''
+        while length:
+            octets = chr(length & 0xff) + octets
+            length >>= 8
+        return tag + chr(0x80 | len(octets)) + octets + value
+    body = tlv('\x04', txn_id)
+    if not commit: # commit is TRUE by default, so only an abort says so
+        body = tlv('\x01', '\x00') + body
+    return tlv('\x30', body)
+
+def _unit_error(failed):
+    """Return the exception for the failed (op, exception) pairs of a stage.
+    
+    That is the first op's exception; where more than one failed, its
+    message goes on to name the dn of every failed op."""
+    err = failed[0][1]
+    if len(failed) > 1 and isinstance(err, error.SpokeError):
+        dns = ', '.join([op[2] for (op, e) in failed])
+        err.msg = '%s Failed writes: %s' % (err.msg, dns)
+        err.args = (err.msg,)
+    return err
+
+def _spoke_error(e, op, dn):
+    """Return the Spoke exception for LDAP error e raised by op on dn.
+    
+    op is 'create' (an add, or a modify adding attributes) or 'delete' (a
+    delete, or a modify removing attributes); call from an except block."""
+    if isinstance(e, error.SpokeError):
+        return e
+    if op == 'create':
+        if isinstance(e, ldap.ALREADY_EXISTS):
+            return error.AlreadyExists('Entry %s already exists.' % dn)
+        if isinstance(e, ldap.TYPE_OR_VALUE_EXISTS):
+            msg = 'Attempt to add attribute to %s which already exists.' % dn
+            return error.AlreadyExists(msg)
+        if isinstance(e, ldap.CONSTRAINT_VIOLATION):
+            msg = 'Attribute already exists and does not support multiples'
+            return error.AlreadyExists(msg)
+        if isinstance(e, ldap.NO_SUCH_OBJECT):
+            return error.NotFound("Part of %s missing, can't create." % dn)
+    else:
+        if isinstance(e, ldap.NO_SUCH_OBJECT):
+            return error.NotFound('%s does not exist, cannot delete' % dn)
+        if isinstance(e, ldap.NO_SUCH_ATTRIBUTE):
+            return error.NotFound('Attribute does not exist, cannot delete')
+        if isinstance(e, ldap.NOT_ALLOWED_ON_NONLEAF):
+            msg = '%s still has children, can\'t delete' % dn
+            return error.SaveTheBabies(msg)
+    trace = traceback.format_exc()
+    if isinstance(e, ldap.LDAPError):
+        return error.SpokeLDAPError(e, trace)
+    return error.SpokeError('Unknown error', trace)
+
+class SpokeLDAPHandle(object):
+    
+    """Stand-in for an LDAP object; each call runs on a pooled connection."""
+    
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, method):
+        def call(*args, **kwargs):
+            return self._pool.call(method, *args, **kwargs)
+        return call
+
+class SpokeDNCache:
+    
+    """Cache of lookups that turn a name into an LDAP object.
+    
+    Entries are keyed by (type, name), hold a _get_object result and live
+    for dn_cache_ttl seconds; past dn_cache_size the least recently used
+    is dropped. Writes through SpokeLDAP invalidate the entries at or
+    below the dn they touch; a TTL of 0 disables the cache."""
+    
+    def __init__(self):
+        self.config = config.setup()
+        self.log = logging.getLogger(__name__)
+        self.size = int(self.config.get('LDAP', 'dn_cache_size', 1024))
+        self.ttl = float(self.config.get('LDAP', 'dn_cache_ttl', 300))
+        self.entries = collections.OrderedDict() # key: (expires, result)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return a copy of the cached result for key, or None."""
+        with self.lock:
+            item = self.entries.pop(key, None)
+            if item is None:
+                return None
+            if item[0] < time.time():
+                return None
+            self.entries[key] = item # Most recently used goes last
+        return copy.deepcopy(item[1])
+
+    def set(self, key, result):
+        """Cache a result holding a single object."""
+        if self.ttl <= 0 or result['count'] != 1:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, copy.deepcopy(result))
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, dn):
+        """Drop every cached object at or below dn."""
+        dn = dn.lower()
+        with self.lock:
+            for key, (expires, result) in self.entries.items():
+                cached_dn = result['data'][0][0].lower()
+                if cached_dn == dn or cached_dn.endswith(',' + dn):
+                    self.log.debug('Dropping cached %s %s' % key)
+                    del self.entries[key]
+
+    def clear(self):
+        """Drop every cached object."""
+        with self.lock:
+            self.entries.clear()
+
+class SpokeSearchCache:
+    
+    """Cache of search results keyed by (base, scope, filter, attrs).
+    
+    Results live for search_cache_ttl seconds; past search_cache_size the
+    least recently used is dropped. A write at a dn drops every search
+    whose base is at, above or below it. Results are only stored if no
+    write was seen while the search ran (see token)."""
+    
+    def __init__(self):
+        self.config = config.setup()
+        self.log = logging.getLogger(__name__)
+        self.size = int(self.config.get('LDAP', 'search_cache_size', 4096))
+        self.ttl = float(self.config.get('LDAP', 'search_cache_ttl', 60))
+        self.entries = collections.OrderedDict() # key: (expires, base, data)
+        self.generation = 0 # Bumped by every invalidation
+        self.lock = threading.Lock()
+
+    def _bucket(self):
+        return int(time.time()) // max(self.ttl, 1)
+
+    def token(self):
+        """Return a token to take before searching and pass to set."""
+        return self.generation
+
+    def get(self, key):
+        """Return a copy of the cached search data for key, or None."""
+        with self.lock:
+            item = self.entries.pop(key, None)
+            if item is None or item[0] < time.time():
+                return None
+            self.entries[key] = item # Most recently used goes last
+        return copy.deepcopy(item[2])
+
+    def set(self, key, base, data, token):
+        """Cache search data, unless there was a write since token."""
+        with self.lock:
+            if token != self.generation:
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, base.lower(), 
+                                 copy.deepcopy(data))
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, dn):
+        """Drop every search at, above or below dn."""
+        dn = dn.lower()
+        with self.lock:
+            self.generation += 1
+            for key, (expires, base, data) in self.entries.items():
+                if _dn_related(base, dn):
+                    del self.entries[key]
+
+# Drop the cached searches at, above or below ARGV[1]. KEYS[1] is the
+# generation counter. Each base has a set of its search keys at ARGV[2] ..
+# base; the bases cached at or below a dn in time bucket b are in the set
+# at ARGV[3] .. b .. ':' .. dn. ARGV[4] is the current bucket and ARGV[5]
+# onwards the dns above ARGV[1].
+lua_search_invalidate = """
+local unpack = unpack or table.unpack
+if redis.replicate_commands then redis.replicate_commands() end
+local dn, prefix, under = ARGV[1], ARGV[2], ARGV[3]
+local bucket = tonumber(ARGV[4])
+redis.call('INCR', KEYS[1])
+local bases = {}
+for i = 5, #ARGV do bases[ARGV[i]] = true end
+for b = bucket - 1, bucket + 1 do
+    local index = under .. b .. ':' .. dn
+    for _, base in ipairs(redis.call('SMEMBERS', index)) do
+        bases[base] = true
+    end
+    redis.call('DEL', index)
+end
+bases[dn] = true
+for base in pairs(bases) do
+    local members = redis.call('SMEMBERS', prefix .. base)
+    for i = 1, #members, 1000 do
+        redis.call('DEL', unpack(members, i, math.min(i + 999, #members)))
+    end
+    redis.call('DEL', prefix .. base)
+end
+return nil
+"""
+
+def _dn_ancestors(dn):
+    """Return the dns above dn, nearest first."""
+    parts = dn.split(',')
+    return [','.join(parts[i:]) for i in range(1, len(parts))]
+
+class SpokeSearchCacheKV:
+    
+    """Search result cache held in Redis, shared between processes.
+    
+    Works as SpokeSearchCache, except that eviction past the TTL is left
+    to the Redis server's maxmemory policy. Results holding values that
+    are not UTF-8 text (e.g. binary attributes) are not cached.
+    
+    Each cached base is indexed under itself and every dn above it, in a
+    set per TTL long time bucket that expires after two buckets. A write
+    then reads only the index sets of its own dn and looks up the bases
+    above it, and no index outlives the entries it points to for long."""
+    
+    prefix = 'spoke:ldap:'
+    
+    def __init__(self):
+        import redis # Only needed with this backend
+        import spoke.lib.kv as kv
+        self.config = config.setup()
+        self.log = logging.getLogger(__name__)
+        self.ttl = int(self.config.get('LDAP', 'search_cache_ttl', 60))
+        self.KV = kv.setup().KV
+        self.kv_generation = self.prefix + 'generation'
+        self.kv_base = self.prefix + 'base:'
+        self.kv_under = self.prefix + 'under:'
+        self.invalidate_script = self.KV.register_script(lua_search_invalidate)
+        self.WatchError = redis.WatchError
+
+    def _key(self, key):
+        return self.prefix + 'search:' + hashlib.sha1(repr(key)).hexdigest()
+
+    def _bucket(self):
+        return int(time.time()) // max(self.ttl, 1)
+
+    def token(self):
+        """Return a token to take before searching and pass to set."""
+        return self.KV.get(self.kv_generation)
+
+    def get(self, key):
+        """Return the cached search data for key, or None."""
+        value = self.KV.get(self._key(key))
+        if value is None:
+            return None
+        data = []
+        for (dn, attrs) in json.loads(value):
+            if dn is not None:
+                dn = dn.encode('utf-8')
+            attrs = dict((k.encode('utf-8'), [v.encode('utf-8') for v in vs])
+                         for (k, vs) in attrs.items())
+            data.append((dn, attrs))
+        return data
+
+    def set(self, key, base, data, token):
+        """Cache search data, unless there was a write since token."""
+        try:
+            value = json.dumps(data)
+        except (TypeError, UnicodeDecodeError):
+            return
+        kv_key = self._key(key)
+        base = base.lower()
+        kv_base = self.kv_base + base
+        bucket = self._bucket()
+        pipe = self.KV.pipeline()
+        try:
+            pipe.watch(self.kv_generation)
+            if pipe.get(self.kv_generation) != token:
+                return
+            pipe.multi()
+            pipe.setex(kv_key, self.ttl, value)
+            pipe.sadd(kv_base, kv_key)
+            pipe.expire(kv_base, self.ttl)
+            for dn in [base] + _dn_ancestors(base):
+                kv_under = '%s%s:%s' % (self.kv_under, bucket, dn)
+                pipe.sadd(kv_under, base)
+                pipe.expire(kv_under, 2 * self.ttl)
+            pipe.execute()
+        except self.WatchError:
+            pass # A write raced us; leave it uncached
+        finally:
+            pipe.reset()
+
+    def invalidate(self, dn):
+        """Drop every search at, above or below dn."""
+        dn = dn.lower()
+        args = [dn, self.kv_base, self.kv_under, self._bucket()]
+        self.invalidate_script(keys=[self.kv_generation], 
+                               args=args + _dn_ancestors(dn))
+
+class SpokeLDAPWatcher(threading.Thread):
+    
+    """Invalidate the search cache as the directory changes.
+    
+    Follows basedn with a syncrepl (RFC 4533) refreshAndPersist search,
+    reconnecting after retry_delay if the server goes away, so changes
+    made outside Spoke also drop the searches they affect."""
+    
+    def __init__(self, cache):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.config = config.setup()
+        self.log = logging.getLogger(__name__)
+        self.cache = cache
+        self.base_dn = self.config.get('LDAP', 'basedn')
+        self.cookie = None
+        self.dns = {} # entryUUID: dn, to resolve deletes
+        self.refreshed = False
+
+    def run(self):
+        if SyncreplConsumer is None:
+            self.log.error('No syncrepl in python-ldap; cache watch disabled')
+            return
+        pool = setup()
+        while True:
+            try:
+                conn = _SpokeSyncConsumer(pool.uri, self)
+                conn.protocol_version = 3
+                if pool.start_tls:
+                    conn.start_tls_s()
+                conn.simple_bind_s(pool.bind_dn, pool.bind_password)
+                msgid = conn.syncrepl_search(self.base_dn, 
+                        ldap.SCOPE_SUBTREE, mode='refreshAndPersist',
+                        attrlist=NO_ATTRS)
+                while conn.syncrepl_poll(msgid=msgid, all=1):
+                    pass
+            except ldap.LDAPError, e:
+                self.log.debug('Cache watch lost (%s), reconnecting' % e)
+            time.sleep(pool.retry_delay)
+
+    def changed(self, dn):
+        """Invalidate dn, once the initial refresh is over."""
+        if self.refreshed:
+            self.cache.invalidate(dn)
+
+if SyncreplConsumer is not None:
+    class _SpokeSyncConsumer(ldap.ldapobject.LDAPObject, SyncreplConsumer):
+        
+        """Syncrepl consumer reporting changed dns to a SpokeLDAPWatcher."""
+        
+        def __init__(self, uri, watcher):
+            ldap.ldapobject.LDAPObject.__init__(self, uri)
+            self.watcher = watcher
+        
+        def syncrepl_get_cookie(self):
+            return self.watcher.cookie
+        
+        def syncrepl_set_cookie(self, cookie):
+            self.watcher.cookie = cookie
+        
+        def syncrepl_entry(self, dn, attrs, uuid):
+            old_dn = self.watcher.dns.get(uuid)
+            self.watcher.dns[uuid] = dn
+            self.watcher.changed(dn)
+            if old_dn is not None and old_dn != dn: # Renamed
+                self.watcher.changed(old_dn)
+        
+        def syncrepl_delete(self, uuids):
+            for uuid in uuids:
+                dn = self.watcher.dns.pop(uuid, None)
+                if dn is not None:
+                    self.watcher.changed(dn)
+        
+        def syncrepl_present(self, uuids, refreshDeletes=False):
+            pass
+        
+        def syncrepl_refreshdone(self):
+            self.watcher.refreshed = True
 
 class SpokeLDAP:
     
-    """Extend ldap class with convenience methods."""
+    """Extend ldap class with convenience methods.
+    
+    The write_verify option sets how writes are confirmed: search reads the
+    entry back after each write; control asks the server to return it in
+    the write response (RFC 4527 read entry controls), falling back to a
+    search if the server ignores the control; none trusts the write result
+    and builds the returned entry from the request itself.
+    
+    Searches made without an attribute list return the attributes named in
+    projection, which classes set to what their callers use; None returns
+    every attribute."""
+    
+    verify_modes = ('none', 'control', 'search')
+    projection = None
     
     def __init__(self):
         """Bind to LDAP directory; return an LDAP connection object."""
         self.config = config.setup()
         self.log = logging.getLogger(__name__)
-        self.LDAP = setup().LDAP
+        self.LDAPConn = setup()
+        self.LDAP = self.LDAPConn.LDAP
+        self.dn_cache = dn_cache()
+        self.search_cache = search_cache()
+        self.write_verify = self.config.get('LDAP', 'write_verify', 'control')
+        if self.write_verify not in self.verify_modes:
+            msg = 'write_verify must be one of %s' % ', '.join(self.verify_modes)
+            raise error.ConfigError(msg)
+        if self.write_verify == 'control' and PostReadControl is None:
+            self.log.debug('No read entry controls in python-ldap, searching')
+            self.write_verify = 'search'
+        self.bulk_window = int(self.config.get('LDAP', 'bulk_window', 32))
+        self.page_size = int(self.config.get('LDAP', 'page_size', 500))
+        self.transactions = self.config.get('LDAP', 'transactions', 'auto')
+        if SimplePagedResultsControl is None:
+            self.page_size = 0
 
-    def _create_object(self, dn, dn_info):
-        """Create a new LDAP object (e.g. a dn or attribute)."""
-        # Allowed LDAP operations
-        operation = {'add':self.LDAP.add_s, 'mod':self.LDAP.modify_s}
+    def _resolve(self, type, name, lookup):
+        """Return the object of type called name, running lookup() (which
+        returns a _get_object result) only if it is not already cached."""
+        result = self.dn_cache.get((type, name))
+        if result is None:
+            result = lookup()
+            self.dn_cache.set((type, name), result)
+        return result
+
+    def _invalidate(self, dn):
+        """Drop cached lookups and searches a write at dn may have changed."""
+        self.dn_cache.invalidate(dn)
+        if self.search_cache is not None:
+            self.search_cache.invalidate(dn)
+
+    def _write(self, op, dn, modlist=None, read=None, attrlist=None):
+        """Run an add, modify or delete; return the entry read by control.
+        
+        read is 'pre' or 'post' to request the entry as it was before or
+        after the write; returns (dn, attrs), or None if no control was
+        requested or the server did not return one."""
+        args = (dn,)
+        if modlist is not None:
+            args = (dn, modlist)
+        try:
+            if read is None or self.write_verify != 'control':
+                getattr(self.LDAP, op + '_s')(*args)
+                return None
+            if read == 'pre':
+                ctrl = PreReadControl(criticality=False, attrList=attrlist)
+            else:
+                ctrl = PostReadControl(criticality=False, attrList=attrlist)
+            rctrls = self.LDAPConn.run(_write_ext, op, args, [ctrl])
+        finally:
+            self._invalidate(dn)
+        for rctrl in rctrls or []:
+            if rctrl.controlType == ctrl.controlType:
+                return (rctrl.dn, rctrl.entry)
+        self.log.debug('Server returned no read entry control for %s' % dn)
+        return None
+
+    def _create_type(self, dn_info):
+        """Return the write (add or modify) for dn_info and attrs to read."""
         try:
             int(dn_info[0][0]) #attribute mod opertations begin with an integer.
-            type = 'mod'
+            type = 'modify'
             attrlist = [] # Collect a list of attributes to return
             for item in dn_info:
                 attrlist.append(item[1])
         except:
             type = 'add' #if it's not a modification, it's an add operation.
             attrlist = None
-        
+        return (type, attrlist)
+
+    def _sent_entry(self, dn, dn_info):
+        """Return the entry as sent; an attribute add lists only new values."""
+        attrs = {}
+        for item in dn_info:
+            values = item[-1]
+            if not isinstance(values, list):
+                values = [values]
+            attrs.setdefault(item[-2], []).extend(values)
+        return (dn, attrs)
+
+    def _create_object(self, dn, dn_info):
+        """Create a new LDAP object (e.g. a dn or attribute)."""
+        (type, attrlist) = self._create_type(dn_info)
         try:
-            operation[type](dn, dn_info)
-        except ldap.ALREADY_EXISTS:
-            msg = 'Entry %s already exists.' % dn
-            raise error.AlreadyExists(msg)
-        except ldap.TYPE_OR_VALUE_EXISTS:
-            msg = 'Attempt to add attribute to %s which already exists.' % dn
-            raise error.AlreadyExists(msg)
-        except ldap.CONSTRAINT_VIOLATION:
-            msg = 'Attribute already exists and does not support multiples'
-            raise error.AlreadyExists(msg)
-        except ldap.NO_SUCH_OBJECT:
-            msg = "Part of %s missing, can't create." % dn
-            raise error.NotFound(msg)
-        except ldap.LDAPError, e:
-            trace = traceback.format_exc()
-            raise error.SpokeLDAPError(e, trace)
+            entry = self._write(type, dn, dn_info, 'post', attrlist)
         except Exception, e:
-            trace = traceback.format_exc()
-            msg = 'Unknown error'
-            raise error.SpokeError(msg, trace)
-        result = self._get_object(dn, scope=ldap.SCOPE_BASE, attr=attrlist)
+            raise _spoke_error(e, 'create', dn)
+        if entry is None and self.write_verify == 'none':
+            entry = self._sent_entry(dn, dn_info)
+        if entry is not None:
+            result = self._process_results([entry], __name__)
+        else:
+            result = self._get_object(dn, scope=ldap.SCOPE_BASE, attr=attrlist)
         if result['exit_code'] == 0 and result['count'] == 1:
             result['msg'] = "Created %s:" % result['type']
             return result
@@ -135,43 +802,129 @@ class SpokeLDAP:
             scope = self.search_scope
         if filter is None:
             filter = '(objectClass=*)'
-        #if attr is not None:
-        #    attr = self.retrieve_attr 
-        try:
-            result = self.LDAP.search_s(dn, scope, filter, attr)
-        except ldap.NO_SUCH_OBJECT, e:
-            self.log.debug('Get failed; part of dn %s does not exist' % dn)
-            result = [] # treat missing branch elements as missing leaf
-        except ldap.LDAPError, e:
-            trace = traceback.format_exc()
-            raise error.SpokeLDAPError(e, trace)
-        except Exception, e:
-            trace = traceback.format_exc()
-            msg = 'Unknown error'
-            raise error.SpokeError(msg, trace)
+        if attr is None:
+            attr = self.projection
+        cache = self.search_cache
+        result = None
+        if cache is not None:
+            key = (dn.lower(), scope, filter, attr and tuple(attr))
+            token = cache.token()
+            result = cache.get(key)
+            if result is not None:
+                cache = None # A hit; nothing to store
+        if result is not None:
+            self.log.debug('Search of %s answered from cache' % dn)
+        elif self.page_size and scope != ldap.SCOPE_BASE:
+            result = list(self._iter_objects(dn, scope, filter, attr))
+        else:
+            try:
+                result = self.LDAP.search_s(dn, scope, filter, attr)
+            except ldap.NO_SUCH_OBJECT, e:
+                self.log.debug('Get failed; part of dn %s does not exist' % dn)
+                result = [] # treat missing branch elements as missing leaf
+            except ldap.LDAPError, e:
+                trace = traceback.format_exc()
+                raise error.SpokeLDAPError(e, trace)
+            except Exception, e:
+                trace = traceback.format_exc()
+                msg = 'Unknown error'
+                raise error.SpokeError(msg, trace)
         
+        if cache is not None:
+            cache.set(key, dn, result, token)
         if unique != False and len(result) > 1:
             msg = 'Multiple results found yet uniqueness requested'
             raise error.SearchUniqueError(msg)
         result = self._process_results(result, __name__)
         return result
 
+    def _iter_objects(self, dn, scope, filter=None, attr=None):
+        """Yield LDAP objects as (dn, attrs), a page of results at a time.
+        
+        Pages of page_size entries are requested with the Simple Paged
+        Results control (RFC 2696), so large searches neither hit server
+        size limits nor need holding in memory; a server without paging
+        returns everything as one page. The connection is held until the
+        generator is exhausted or closed, as the server keeps the paging
+        state with it; other calls this thread makes meanwhile are lent
+        the same connection. As with SpokeLDAPConn.run, a search the server
+        drops before its first page is retried once on a fresh connection."""
+        if scope is None:
+            scope = self.search_scope
+        if filter is None:
+            filter = '(objectClass=*)'
+        if not self.page_size:
+            for entry in self._get_object(dn, scope, filter, attr)['data']:
+                yield entry
+            return
+        ctrl = SimplePagedResultsControl(criticality=False,
+                                         size=self.page_size, cookie='')
+        def page(conn):
+            msgid = conn.search_ext(dn, scope, filter, attr, 
+                                    serverctrls=[ctrl])
+            return conn.result3(msgid)
+        broken = False
+        conn = self.LDAPConn.acquire()
+        try:
+            try:
+                result = page(conn)
+            except ldap.SERVER_DOWN:
+                self.log.debug('LDAP server down, reconnecting')
+                self.LDAPConn.release(conn, broken=True)
+                conn = self.LDAPConn.acquire()
+                result = page(conn)
+            while True:
+                rtype, rdata, rmsgid, rctrls = result
+                for entry in rdata:
+                    yield entry
+                ctrl.cookie = ''
+                for rctrl in rctrls or []:
+                    if rctrl.controlType == ctrl.controlType:
+                        ctrl.cookie = rctrl.cookie
+                if not ctrl.cookie:
+                    break
+                result = page(conn)
+        except ldap.NO_SUCH_OBJECT, e:
+            self.log.debug('Get failed; part of dn %s does not exist' % dn)
+        except ldap.SERVER_DOWN, e:
+            broken = True
+            trace = traceback.format_exc()
+            raise error.SpokeLDAPError(e, trace)
+        except ldap.LDAPError, e:
+            trace = traceback.format_exc()
+            raise error.SpokeLDAPError(e, trace)
+        finally:
+            self.LDAPConn.release(conn, broken)
+
     def _modify_attributes(self, dn, new_attrs, old_attrs=None):
-        """Modify an LDAP object (e.g. a dn or attribute)."""
-        ignore_old = 0
-        if old_attrs==None:
+        """Modify an LDAP object (e.g. a dn or attribute).
+        
+        Without old_attrs the search mode reads the entry to diff against;
+        the other modes replace each attribute in new_attrs outright, which
+        has the same effect without the extra round trip."""
+        attrs = []
+        for attr in new_attrs:
+            attrs.append(attr)
+        if old_attrs is not None:
+            dn_info = ldap.modlist.modifyModlist(old_attrs, new_attrs)
+        elif self.write_verify == 'search':
             old_object = self._get_object(dn, ldap.SCOPE_BASE,
                                         '(objectClass=*)', unique=True)
             if old_object['data'] == []:
                 msg = '%s does not exist, cannot modify' % dn
                 raise error.NotFound(msg)
             old_attrs = old_object['data'][0][1]
-            ignore_old = 1
-            
-        dn_info = ldap.modlist.modifyModlist(old_attrs, new_attrs, 
-                                             ignore_oldexistent=ignore_old)   
+            dn_info = ldap.modlist.modifyModlist(old_attrs, new_attrs, 
+                                                 ignore_oldexistent=1)
+        else:
+            dn_info = []
+            for attr in attrs:
+                dn_info.append((ldap.MOD_REPLACE, attr, new_attrs[attr] or None))
         try:
-            self.LDAP.modify_s(dn, dn_info)
+            entry = self._write('modify', dn, dn_info, 'post', attrs)
+        except ldap.NO_SUCH_OBJECT, e:
+            msg = '%s does not exist, cannot modify' % dn
+            raise error.NotFound(msg)
         except ldap.NO_SUCH_ATTRIBUTE, e:
             msg = 'Attribute does not exist, cannot modify'
             raise error.NotFound(msg)
@@ -182,26 +935,31 @@ class SpokeLDAP:
             trace = traceback.format_exc()
             msg = 'Unknown error'
             raise error.SpokeError(msg, trace)
-        attrs = []
-        for attr in new_attrs:
-            attrs.append(attr)
-        result = self._get_object(dn, scope=ldap.SCOPE_BASE, 
-                                  attr=attrs, unique=True)
+        if entry is None and self.write_verify == 'none':
+            values = {}
+            for attr in attrs:
+                value = new_attrs[attr]
+                if value and not isinstance(value, list):
+                    value = [value]
+                if value:
+                    values[attr] = value
+            entry = (dn, values)
+        if entry is not None:
+            result = self._process_results([entry], __name__)
+        else:
+            result = self._get_object(dn, scope=ldap.SCOPE_BASE, 
+                                      attr=attrs, unique=True)
         result['msg'] = "Modified %s attribute:" % result['type']
         return result
 
     def _delete_object(self, dn, dn_info=None):
         """Delete an LDAP object (e.g. a dn or attribute)."""
-        operation = {'del_dn':self.LDAP.delete_s,
-                     'del_attr':self.LDAP.modify_s}
         filter = 'objectClass=*'
         if dn_info == None:
             del_type = 'del_dn' # We're deleting a dn
-            kargs = {'dn':dn}
             attrlist = None
         else:
             del_type = 'del_attr' # We're deleting an attribute
-            kargs = {'dn': dn, 'modlist': dn_info}
             attrlist = [] # Collect a list of attributes to return
             for item in dn_info:
                 attrlist.append(item[1])
@@ -209,26 +967,22 @@ class SpokeLDAP:
             #    filter = '%s=%s' % (dn_info[0][1], dn_info[0][2])
         #self.log.debug('Running with filter %s' % filter)
         try:
-            operation[del_type](**kargs)
-        except ldap.NO_SUCH_OBJECT, e:
-            msg = '%s does not exist, cannot delete' % dn
-            raise error.NotFound(msg)
-        except ldap.NO_SUCH_ATTRIBUTE, e:
-            msg = 'Attribute does not exist, cannot delete'
-            raise error.NotFound(msg)
-        except ldap.NOT_ALLOWED_ON_NONLEAF, e:
-            msg = '%s still has children, can\'t delete' % dn
-            raise error.SaveTheBabies(msg)
-        except ldap.LDAPError, e:
-            trace = traceback.format_exc()
-            raise error.SpokeLDAPError(e, trace)
+            if del_type == 'del_dn':
+                # A successful delete needs no check, but the pre-read
+                # entry records what was removed
+                entry = self._write('delete', dn, read='pre')
+                if entry is not None:
+                    self.log.debug('Deleted %s: %s' % entry)
+            else:
+                entry = self._write('modify', dn, dn_info, 'post', attrlist)
         except Exception, e:
-            trace = traceback.format_exc()
-            msg = 'Unknown error'
-            raise error.SpokeError(msg, trace)
-        result = self._get_object(dn, scope=ldap.SCOPE_BASE, filter=filter, 
-                                  attr=attrlist)
+            raise _spoke_error(e, 'delete', dn)
         if del_type == 'del_dn': # we expect nothing back
+            if self.write_verify == 'search':
+                result = self._get_object(dn, scope=ldap.SCOPE_BASE,
+                                          filter=filter, attr=NO_ATTRS)
+            else:
+                result = self._process_results([], __name__)
             if result['exit_code'] == 3 and result['count'] == 0:
                 result['msg'] = "Deleted %s:" % result['type']
                 return result
@@ -236,6 +990,13 @@ class SpokeLDAP:
                 msg = 'Delete operation returned OK, but object still there?'
                 raise error.ValidationError(msg)
         else: # we're deleting an attribute so we expect an object back
+            if entry is None and self.write_verify == 'none':
+                entry = (dn, {})
+            if entry is not None:
+                result = self._process_results([entry], __name__)
+            else:
+                result = self._get_object(dn, scope=ldap.SCOPE_BASE,
+                                          filter=filter, attr=attrlist)
             if result['exit_code'] == 0 and result['count'] == 1:
                 result['msg'] = "Deleted %s attribute:" % result['type']
                 return result
@@ -243,16 +1004,235 @@ class SpokeLDAP:
                 msg = 'Delete attribute operation returned OK, but unable to find object'
                 raise error.NotFound(msg)
 
+    def _bulk(self, ops):
+        """Run writes on one connection, keeping bulk_window in flight.
+        
+        ops is a list of (op, kind, dn, modlist): op is add, modify or
+        delete and kind the _spoke_error mapping (create or delete). Each
+        result is read in submission order, so the returned list lines up
+        with ops; it holds the entry read by control (or None) for each
+        write that succeeded and the Spoke exception for each that failed.
+        Entries are never searched for, whatever the write_verify mode."""
+        results = [_PENDING] * len(ops)
+        pending = collections.deque() # (index, msgid), oldest first
+        next = 0
+        broken = False
+        conn = self.LDAPConn.acquire()
+        try:
+            while next < len(ops) or pending:
+                while next < len(ops) and len(pending) < self.bulk_window:
+                    (op, kind, dn, modlist) = ops[next]
+                    args = (dn,)
+                    if modlist is not None:
+                        args = (dn, modlist)
+                    ctrls = None
+                    if self.write_verify == 'control' and op != 'delete':
+                        attrlist = self._create_type(modlist)[1]
+                        ctrls = [PostReadControl(criticality=False,
+                                                 attrList=attrlist)]
+                    try:
+                        msgid = getattr(conn, op + '_ext')(*args,
+                                                           serverctrls=ctrls)
+                        pending.append((next, msgid))
+                    except ldap.SERVER_DOWN:
+                        raise
+                    except Exception, e:
+                        results[next] = _spoke_error(e, kind, dn)
+                    next += 1
+                if not pending:
+                    continue
+                (index, msgid) = pending[0]
+                (op, kind, dn, modlist) = ops[index]
+                try:
+                    rtype, rdata, rmsgid, rctrls = conn.result3(msgid)
+                    results[index] = None
+                    for rctrl in rctrls or []:
+                        if rctrl.controlType == PostReadControl.controlType:
+                            results[index] = (rctrl.dn, rctrl.entry)
+                except ldap.SERVER_DOWN:
+                    raise
+                except Exception, e:
+                    results[index] = _spoke_error(e, kind, dn)
+                pending.popleft()
+        except ldap.SERVER_DOWN, e:
+            broken = True
+            trace = traceback.format_exc()
+            for index in range(len(ops)):
+                if results[index] is _PENDING:
+                    msg = 'LDAP server down; %s of %s may not have run' % \
+                        (ops[index][0], ops[index][2])
+                    results[index] = error.SpokeLDAPError(msg, trace)
+        finally:
+            self.LDAPConn.release(conn, broken)
+            for (op, kind, dn, modlist) in ops:
+                self._invalidate(dn)
+        return results
+
+    def _bulk_result(self, op, entry):
+        """Return a _create_object or _delete_object style result for the
+        entry _bulk returned for op (or the exception it raised)."""
+        if isinstance(entry, Exception):
+            return entry
+        if op[0] == 'delete':
+            result = self._process_results([], __name__)
+            result['msg'] = "Deleted %s:" % result['type']
+            return result
+        if entry is None:
+            entry = self._sent_entry(op[2], op[3])
+        result = self._process_results([entry], __name__)
+        if op[1] == 'create':
+            result['msg'] = "Created %s:" % result['type']
+        else:
+            result['msg'] = "Deleted %s attribute:" % result['type']
+        return result
+
+    def _create_objects(self, entries):
+        """Create many objects; take [(dn, dn_info)], return a list of
+        _create_object results, or the exception raised, in the same order."""
+        ops = []
+        for (dn, dn_info) in entries:
+            ops.append((self._create_type(dn_info)[0], 'create', dn, dn_info))
+        return [self._bulk_result(op, entry) 
+                for (op, entry) in zip(ops, self._bulk(ops))]
+
+    def _delete_objects(self, dns):
+        """Delete many objects; take a list of dns, return a list of
+        _delete_object results, or the exception raised, in the same order."""
+        ops = [('delete', 'delete', dn, None) for dn in dns]
+        return [self._bulk_result(op, entry) 
+                for (op, entry) in zip(ops, self._bulk(ops))]
+
+    def _transaction(self, ops):
+        """Apply ops, as _bulk takes them, in one LDAP transaction.
+        
+        Returns None if the server refused to start a transaction, having
+        changed nothing; raises the Spoke exception for the failure if the
+        transaction did not commit."""
+        broken = False
+        conn = self.LDAPConn.acquire()
+        try:
+            try:
+                respoid, txn_id = conn.extop_s(ExtendedRequest(TXN_START, 
+                                                               None))
+            except ldap.SERVER_DOWN:
+                raise
+            except ldap.LDAPError, e:
+                self.log.debug('Transaction refused (%s), pipelining' % e)
+                return None
+            ctrl = LDAPControl(TXN_SPEC, True, encodedControlValue=txn_id)
+            # Nothing is applied on failure, so the error names the parent
+            # entry of the unit: created first and deleted last
+            (op, kind, dn, modlist) = ops[0]
+            if kind == 'delete':
+                dn = ops[-1][2]
+            msgids = []
+            try:
+                for (op_name, op_kind, op_dn, modlist) in ops:
+                    args = (op_dn,)
+                    if modlist is not None:
+                        args = (op_dn, modlist)
+                    msgids.append(getattr(conn, op_name + '_ext')(*args,
+                                                        serverctrls=[ctrl]))
+            except ldap.SERVER_DOWN:
+                raise
+            except ldap.LDAPError, e:
+                err = _spoke_error(e, kind, dn)
+                try:
+                    conn.extop_s(ExtendedRequest(TXN_END,
+                                    _txn_end_value(txn_id, commit=False)))
+                except ldap.LDAPError:
+                    pass
+                raise err
+            try:
+                conn.extop_s(ExtendedRequest(TXN_END, _txn_end_value(txn_id)))
+            except ldap.SERVER_DOWN:
+                raise
+            except ldap.LDAPError, e:
+                err = _spoke_error(e, kind, dn)
+                # The server may answer the update that failed the commit
+                for (msgid, op) in zip(msgids, ops):
+                    try:
+                        conn.result3(msgid, all=1, timeout=0)
+                    except ldap.TIMEOUT:
+                        conn.abandon(msgid)
+                    except ldap.SERVER_DOWN:
+                        raise
+                    except ldap.LDAPError, e:
+                        err = _spoke_error(e, op[1], op[2])
+                raise err
+            for msgid in msgids: # Update responses; the commit settles them
+                try:
+                    conn.result3(msgid, all=1, timeout=0)
+                except ldap.TIMEOUT:
+                    conn.abandon(msgid)
+                except ldap.LDAPError, e:
+                    self.log.debug('Update in committed transaction: %s' % e)
+        except ldap.SERVER_DOWN, e:
+            broken = True
+            trace = traceback.format_exc()
+            msg = 'LDAP server down during transaction; outcome unknown'
+            raise error.SpokeLDAPError(msg, trace)
+        finally:
+            self.LDAPConn.release(conn, broken)
+            for (op, kind, dn, modlist) in ops:
+                self._invalidate(dn)
+        return [None] * len(ops)
+
+    def _write_unit(self, stages):
+        """Apply related writes as one unit; return a result for each.
+        
+        stages is a list of lists of ops, as _bulk takes them; writes in a
+        stage must not depend on each other, while each stage may depend on
+        the ones before it (e.g. an entry, then its children). Where the
+        server supports LDAP transactions (RFC 5805) the unit commits or
+        fails as a whole. Otherwise each stage is pipelined with _bulk; on
+        a failure the entries the unit added are deleted again, but deletes
+        and modifies cannot be undone, and the exception raised names every
+        write of the failed stage that did not run."""
+        ops = [op for stage in stages for op in stage]
+        entries = None
+        if ExtendedRequest is not None and self.transactions == 'auto' and \
+                                        self.LDAPConn.supports(TXN_START):
+            entries = self._transaction(ops)
+        if entries is None:
+            entries = []
+            done = [] # Ops applied so far, stage by stage
+            for stage in stages:
+                results = self._bulk(stage)
+                failed = [(op, result) for (op, result) in zip(stage, results)
+                          if isinstance(result, Exception)]
+                if failed:
+                    done.append([op for (op, result) in zip(stage, results)
+                                 if not isinstance(result, Exception)])
+                    self._undo_adds(done)
+                    raise _unit_error(failed)
+                done.append(stage)
+                entries.extend(results)
+        return [self._bulk_result(op, entry) 
+                for (op, entry) in zip(ops, entries)]
+
+    def _undo_adds(self, stages):
+        """Delete the entries added by stages of ops, last stage first."""
+        for stage in reversed(stages):
+            ops = [('delete', 'delete', dn, None) 
+                   for (op, kind, dn, modlist) in stage if op == 'add']
+            for (op, result) in zip(ops, self._bulk(ops)):
+                if isinstance(result, Exception):
+                    msg = 'Unable to undo add of %s: %s' % (op[2], result)
+                    self.log.warning(msg)
+
     def _validate_exists(self, dn, filter=None, unique=False, attr=None):
         """Return result under supplied dn; otherwise raise NotFound."""
+        if attr is None:
+            attr = NO_ATTRS
         try:
             result = self._get_object(dn, self.search_scope, filter, attr)
         except ldap.NO_SUCH_OBJECT, e:
-            result = []
-        if not result:
+            result = self._process_results([])
+        if result['count'] == 0:
             msg = 'Validate exists failed'
             raise error.NotFound(msg)
-        elif unique != False and len(result) > 1:
+        elif unique != False and result['count'] > 1:
             msg = 'Multiple results found yet uniqueness requested'
             raise error.SearchUniqueError(msg)
         return True
@@ -261,10 +1241,10 @@ class SpokeLDAP:
         """Return true if not found; otherwise raise AlreadyExists.
         TODO add global option to replace _get_global."""
         try:
-            result = self._get_object(dn, self.search_scope, filter)
+            result = self._get_object(dn, self.search_scope, filter, NO_ATTRS)
         except ldap.NO_SUCH_OBJECT, e:
             return True
-        if result != []:
+        if result['count'] != 0:
             msg = 'Entry found, validate missing failed.'
             raise error.AlreadyExists(msg)
         return True
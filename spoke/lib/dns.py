@@ -96,8 +96,8 @@ class SpokeDNSResource(SpokeLDAP):
 
     def _get_org(self, org_name):
         """Retrieve our org object."""
-        org = SpokeOrg()
-        result = org.get(org_name)
+        result = self._resolve('org', org_name,
+                               lambda: SpokeOrg().get(org_name))
         if result['data'] == []:
             msg = "Can't find org %s" % org_name
             self.log.error(msg)
@@ -22,7 +22,7 @@ import spoke.lib.common as common
 import spoke.lib.error as error
 import spoke.lib.config as config
 import spoke.lib.logger as logger
-from spoke.lib.directory import SpokeLDAP
+from spoke.lib.directory import SpokeLDAP, NO_ATTRS
 from spoke.lib.user import SpokeUser
 from spoke.lib.org import SpokeOrg
 
@@ -70,8 +70,8 @@ class SpokeEmail(SpokeLDAP):
         
     def _get_user(self, org_name, user_id):
         """Retrieve a user object."""
-        user = SpokeUser(org_name)
-        result = user.get(user_id, unique=True)
+        result = self._resolve('user', (org_name, user_id),
+                lambda: SpokeUser(org_name).get(user_id, unique=True))
         if result['data'] == []:
             msg = "Can't find user %s in org %s" % (user_id, org_name)
             raise error.NotFound(msg)          
@@ -194,7 +194,8 @@ class SpokeEmailAddress(SpokeEmail):
         dn = self.base_dn
         filter = '%s=%s' % (self.smtp_address, email_addr)
         # Global search
-        result = self._get_object(dn, self.search_scope, filter, unique=True)
+        result = self._get_object(dn, self.search_scope, filter, NO_ATTRS,
+                                  unique=True)
         if result['data'] != []:
             self.log.info('Email address %s already exists.' % email_addr)
             raise error.AlreadyExists(result)
@@ -250,8 +251,8 @@ class SpokeEmailDomain(SpokeLDAP):
         
     def _get_org(self, org_name):
         """Retrieve our org object."""
-        org = SpokeOrg()
-        result = org.get(org_name)
+        result = self._resolve('org', org_name,
+                               lambda: SpokeOrg().get(org_name))
         if result['data'] == []:
             msg = "Can't find org %s" % org_name
             raise error.NotFound(msg)          
@@ -263,7 +264,8 @@ class SpokeEmailDomain(SpokeLDAP):
         dn = self.base_dn
         filter = '%s=%s' % (self.smtp_domain, email_dom)
         # Global search
-        result = self._get_object(dn, self.search_scope, filter, unique=True)
+        result = self._get_object(dn, self.search_scope, filter, NO_ATTRS,
+                                  unique=True)
         if result['data'] != []:
             self.log.info('Email domain %s already exists.' % email_dom)
             raise error.AlreadyExists(result)
@@ -60,8 +60,8 @@ class SpokeHost(SpokeLDAP):
     
     def _get_org(self, org_name):
         """Retrieve our org object."""
-        org = SpokeOrg()
-        result = org.get(org_name)
+        result = self._resolve('org', org_name,
+                               lambda: SpokeOrg().get(org_name))
         if result['data'] == []:
             msg = "Can't find org %s" % org_name
             raise error.NotFound(msg)          
@@ -204,6 +204,7 @@ class SpokeHostUUID(SpokeLDAP):
         self.next_uuid_dn = self.config.get('UUID','next_uuid_dn', self.base_dn)
         self.next_uuid_class = self.config.get('UUID','next_uuid_class', 'aenetNextUUID')
         self.next_uuid_start = self.config.get('UUID','next_uuid_start', 1)   
+        self.projection = ['objectClass', self.next_uuid_attr]
         self.next_uuid = self._get_next_uuid_dn()['data']
         self.next_uuid_attrs = self.next_uuid[0].__getitem__(1)
         self.next_uuid_classes = self.next_uuid_attrs['objectClass']
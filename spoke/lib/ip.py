@@ -1,7 +1,9 @@
 """IP address management module.
 
 Classes:
-SpokeIP - Creation/deletion/modification/retrieval of IP account details.
+SpokeSubnet - Creation/deletion/modification/retrieval of IP subnet details.
+SpokeSubnet6 - Creation/deletion/modification/retrieval of IPv6 subnets.
+SpokeSubnetLocator - Longest prefix match of IPs against managed subnets.
 Exceptions:
 NotFound - raised on failure to find an object when one is expected.
 AlreadyExists -raised on attempts to create an object when one already exists.
@@ -11,6 +13,10 @@ InsufficientResource - raised on a lack of a required resource.
 SearchError - raised to indicate unwanted search results were returned.
 """
 # core modules
+import json
+import hashlib
+import random
+import socket
 import logging
 
 # own modules
@@ -21,16 +27,310 @@ import spoke.lib.ip_helper as ip_helper
 from spoke.lib.directory import SpokeLDAP
 from spoke.lib.kv import SpokeKV
 
+# 3rd party modules
+import redis
+
+# Return the Redis type backing a pool ('string' for bitmaps, 'set' or 'none').
+# An exhausted set is removed by Redis, so check the allocated pool as well.
+lua_pool_type = """
+local function pool_type(free, aloc)
+    local kv_type = redis.call('TYPE', free)['ok']
+    if kv_type == 'none' then kv_type = redis.call('TYPE', aloc)['ok'] end
+    return kv_type
+end
+"""
+
+# Claim the address range first to last for subnet member (written as
+# network/mask) in the range index ranges, a sorted set of subnets scored by
+# first address. Indexed subnets never overlap, so only the nearest subnet
+# starting at or before first and the first starting within the range need
+# checking. Returns {'claimed'}, {'present'} if member already holds the
+# range, or {'overlap', subnet} naming the conflicting subnet.
+lua_claim = """
+local function claim(ranges, first, last, member)
+    if redis.call('ZSCORE', ranges, member) then return {'present'} end
+    local before = redis.call('ZREVRANGEBYSCORE', ranges, first, '-inf',
+                              'WITHSCORES', 'LIMIT', 0, 1)
+    if #before > 0 then
+        local mask = tonumber(string.match(before[1], '/(%d+)$'))
+        if tonumber(before[2]) + 2^(32 - mask) - 1 >= first then
+            return {'overlap', before[1]}
+        end
+    end
+    local after = redis.call('ZRANGEBYSCORE', ranges, first, last,
+                             'LIMIT', 0, 1)
+    if #after > 0 then return {'overlap', after[1]} end
+    redis.call('ZADD', ranges, first, member)
+    return {'claimed'}
+end
+"""
+
+# Return the pool type and the free and allocated counts of a subnet.
+lua_counts = lua_pool_type + """
+local function counts(free, aloc)
+    local kv_type = pool_type(free, aloc)
+    if kv_type == 'string' then
+        return kv_type, redis.call('BITCOUNT', free), 
+               redis.call('BITCOUNT', aloc)
+    end
+    return kv_type, redis.call('SCARD', free), redis.call('SCARD', aloc)
+end
+"""
+
+# Count the free (KEYS[1]) and allocated (KEYS[2]) addresses of a subnet,
+# changing nothing. Returns the pool type and the two counts.
+lua_count = lua_counts + """
+local kv_type, free_count, aloc_count = counts(KEYS[1], KEYS[2])
+return {kv_type, free_count, aloc_count}
+"""
+
+# Record the free (KEYS[1]) and allocated (KEYS[2]) counts of a subnet against
+# field ARGV[1] of the subnet registry hashes (KEYS[3-5]). With metadata
+# ARGV[2] the subnet is registered too; without it (an empty string) only a
+# registered subnet's counts are updated. Returns 1 if recorded, else 0.
+lua_register = lua_counts + """
+local index, index_free, index_aloc = KEYS[3], KEYS[4], KEYS[5]
+local field, meta = ARGV[1], ARGV[2]
+local kv_type, free_count, aloc_count = counts(KEYS[1], KEYS[2])
+if free_count + aloc_count == 0 then return 0 end
+if meta ~= '' then
+    redis.call('HSET', index, field, meta)
+elseif redis.call('HEXISTS', index, field) == 0 then
+    return 0
+end
+redis.call('HSET', index_free, field, free_count)
+redis.call('HSET', index_aloc, field, aloc_count)
+return 1
+"""
+
+# Reserve ARGV[1] addresses in a single server side step. Either all of them
+# are moved from the free (KEYS[1]) to the allocated (KEYS[2]) pool or none
+# are. ARGV[2] is the allocation policy, ARGV[3] the subnet size and ARGV[4] a
+# random seed. Next-fit keeps its position in KEYS[3]. The counts held in the
+# subnet registry (KEYS[4-6]) under field ARGV[5] are updated to match.
+# Returns the pool mode and the reserved addresses (bitmap pools return bit
+# offsets) or nil if there are too few free addresses.
+lua_reserve = lua_pool_type + """
+local free, aloc, cursor = KEYS[1], KEYS[2], KEYS[3]
+local index, index_free, index_aloc = KEYS[4], KEYS[5], KEYS[6]
+local number, policy = tonumber(ARGV[1]), ARGV[2]
+local size, seed = tonumber(ARGV[3]), tonumber(ARGV[4])
+local field = ARGV[5]
+-- SPOP is non deterministic, replicate its effects rather than the script
+if redis.replicate_commands then redis.replicate_commands() end
+local kv_type = pool_type(free, aloc)
+local function register(number)
+    if redis.call('HEXISTS', index, field) == 1 then
+        redis.call('HINCRBY', index_free, field, -number)
+        redis.call('HINCRBY', index_aloc, field, number)
+    end
+end
+-- First free bit at or after offset, or -1. BITPOS only takes a byte
+-- offset so walk any leading partial byte bit by bit.
+local function next_free(offset)
+    while offset < size and offset % 8 ~= 0 do
+        if redis.call('GETBIT', free, offset) == 1 then return offset end
+        offset = offset + 1
+    end
+    if offset >= size then return -1 end
+    offset = redis.call('BITPOS', free, 1, math.floor(offset / 8))
+    if offset >= size then return -1 end
+    return offset
+end
+local offer = {}
+if kv_type == 'string' then
+    if redis.call('BITCOUNT', free) < number then return nil end
+    local offset = 0
+    if policy == 'next-fit' then
+        offset = tonumber(redis.call('GET', cursor) or 0)
+    elseif policy == 'random' then
+        math.randomseed(seed)
+    end
+    for i = 1, number do
+        if policy == 'random' then offset = math.random(0, size - 1) end
+        local found = next_free(offset)
+        if found < 0 then found = next_free(0) end
+        redis.call('SETBIT', free, found, 0)
+        redis.call('SETBIT', aloc, found, 1)
+        offer[i] = found
+        offset = found + 1
+    end
+    if policy == 'next-fit' then redis.call('SET', cursor, offset) end
+    register(number)
+    return {'bitmap', offer}
+end
+-- Set pools have no order, so they can only hand out random addresses
+if policy ~= 'random' then return {'unsupported', {}} end
+if redis.call('SCARD', free) < number then return nil end
+offer = redis.call('SPOP', free, number)
+-- Keep unpack() well inside the Lua stack limit
+local unpack = unpack or table.unpack
+for i = 1, #offer, 1000 do
+    redis.call('SADD', aloc, unpack(offer, i, math.min(i + 999, #offer)))
+end
+register(number)
+return {'set', offer}
+"""
+
+# Claim the address range ARGV[1] to ARGV[2] for subnet ARGV[3] in the range
+# index KEYS[1]. Returns the claim status, as claim() does.
+lua_claim_range = lua_claim + """
+return claim(KEYS[1], tonumber(ARGV[1]), tonumber(ARGV[2]), ARGV[3])
+"""
+
+# Walk the free addresses of a subnet as runs of consecutive offsets. Bitmaps
+# are read in order with BITPOS, set members are converted to offsets from
+# network and sorted inside the script so nothing crosses the wire.
+lua_free_runs = lua_pool_type + """
+-- First offset at or after offset whose free bit equals bit, or size
+local function next_bit(free, size, bit, offset)
+    while offset < size and offset % 8 ~= 0 do
+        if redis.call('GETBIT', free, offset) == bit then return offset end
+        offset = offset + 1
+    end
+    if offset >= size then return size end
+    offset = redis.call('BITPOS', free, bit, math.floor(offset / 8))
+    if offset < 0 or offset > size then return size end
+    return offset
+end
+-- Call visit(start, stop) for each free run [start, stop) in ascending
+-- order until it returns true. Returns the number of free addresses seen.
+local function free_runs(kv_type, free, size, network, visit)
+    if kv_type == 'string' then
+        local offset = next_bit(free, size, 1, 0)
+        while offset < size do
+            local stop = next_bit(free, size, 0, offset)
+            if visit(offset, stop) then return end
+            offset = next_bit(free, size, 1, stop)
+        end
+        return
+    end
+    local offsets = {}
+    for i, ip in ipairs(redis.call('SMEMBERS', free)) do
+        local a, b, c, d = string.match(ip, '^(%d+)%.(%d+)%.(%d+)%.(%d+)$')
+        offsets[i] = ((tonumber(a) * 256 + tonumber(b)) * 256 +
+                      tonumber(c)) * 256 + tonumber(d) - network
+    end
+    table.sort(offsets)
+    local start = 1
+    for i = 2, #offsets + 1 do
+        if offsets[i] ~= offsets[i - 1] + 1 then
+            if visit(offsets[start], offsets[i - 1] + 1) then return end
+            start = i
+        end
+    end
+end
+"""
+
+# Summarise the free space of a subnet without returning its members. KEYS
+# are the free and allocated pools, ARGV the subnet size and the integer
+# value of its network address. Each free run is split into the largest
+# aligned CIDR blocks it holds. Returns the pool type, free and allocated
+# counts, the number and longest length of free runs and a flat list of
+# prefix, free block count pairs.
+lua_stats = lua_free_runs + """
+local free, aloc = KEYS[1], KEYS[2]
+local size, network = tonumber(ARGV[1]), tonumber(ARGV[2])
+local kv_type = pool_type(free, aloc)
+local blocks, runs, largest = {}, 0, 0
+free_runs(kv_type, free, size, network, function(start, stop)
+    runs = runs + 1
+    if stop - start > largest then largest = stop - start end
+    while start < stop do
+        local bits = 0
+        while start % 2^(bits + 1) == 0 and start + 2^(bits + 1) <= stop do
+            bits = bits + 1
+        end
+        blocks[bits] = (blocks[bits] or 0) + 1
+        start = start + 2^bits
+    end
+end)
+local free_count, aloc_count
+if kv_type == 'string' then
+    free_count = redis.call('BITCOUNT', free)
+    aloc_count = redis.call('BITCOUNT', aloc)
+else
+    free_count = redis.call('SCARD', free)
+    aloc_count = redis.call('SCARD', aloc)
+end
+local summary = {}
+for bits = 32, 0, -1 do
+    if blocks[bits] then
+        summary[#summary + 1] = 32 - bits
+        summary[#summary + 1] = blocks[bits]
+    end
+end
+return {kv_type, free_count, aloc_count, runs, largest, summary}
+"""
+
+# Reserve ARGV[3] consecutive addresses starting on a multiple of ARGV[4]
+# (the lowest such block that is entirely free) in a single server side
+# step. KEYS are the free and allocated pools and the subnet registry hashes,
+# ARGV[1] and ARGV[2] the subnet size and integer network address and
+# ARGV[5] the registry field. Returns the offset of the first address of the
+# block or nil if there is no room.
+lua_reserve_block = lua_free_runs + """
+local free, aloc = KEYS[1], KEYS[2]
+local index, index_free, index_aloc = KEYS[3], KEYS[4], KEYS[5]
+local size, network = tonumber(ARGV[1]), tonumber(ARGV[2])
+local length, align = tonumber(ARGV[3]), tonumber(ARGV[4])
+local field = ARGV[5]
+-- SMEMBERS is non deterministic, replicate effects rather than the script
+if redis.replicate_commands then redis.replicate_commands() end
+local kv_type = pool_type(free, aloc)
+local found
+free_runs(kv_type, free, size, network, function(start, stop)
+    local first = math.ceil(start / align) * align
+    if first + length <= stop then
+        found = first
+        return true
+    end
+end)
+if not found then return nil end
+if kv_type == 'string' then
+    for offset = found, found + length - 1 do
+        redis.call('SETBIT', free, offset, 0)
+        redis.call('SETBIT', aloc, offset, 1)
+    end
+else
+    local unpack = unpack or table.unpack
+    local ips = {}
+    for offset = found, found + length - 1 do
+        local n = network + offset
+        ips[#ips + 1] = string.format('%d.%d.%d.%d', math.floor(n / 16777216),
+            math.floor(n / 65536) % 256, math.floor(n / 256) % 256, n % 256)
+    end
+    for i = 1, #ips, 1000 do
+        local last = math.min(i + 999, #ips)
+        redis.call('SREM', free, unpack(ips, i, last))
+        redis.call('SADD', aloc, unpack(ips, i, last))
+    end
+end
+if redis.call('HEXISTS', index, field) == 1 then
+    redis.call('HINCRBY', index_free, field, -length)
+    redis.call('HINCRBY', index_aloc, field, length)
+end
+return found
+"""
+
 class SpokeSubnet(SpokeKV):
     
     """Provide CRUD methods to subnet objects."""
     
-    def __init__(self, ip=None, mask=None, dc=None):   
+    def __init__(self, ip=None, mask=None, dc=None, policy=None):   
         """Get config, setup logging and Redis connection."""
         SpokeKV.__init__(self)
         self.config = config.setup()
         self.log = logging.getLogger(__name__)
         self.max_mask = 16 # This is the largest network we can work with
+        self.bitmap_max_mask = 8 # Largest network held as a bitmap (2MB)
+        self.pool_modes = ['set', 'bitmap']
+        self.alloc_policies = ['random', 'lowest', 'next-fit']
+        self.populate_chunk = 4096 # Addresses per SADD when populating
+        self.populate_depth = 16 # SADDs per pipeline round trip
+        self.kv_index = self.config.get('IP', 'ip_subnet_index', 'spoke:subnets')
+        self.kv_index_free = '%s:free' % self.kv_index
+        self.kv_index_aloc = '%s:aloc' % self.kv_index
         # Check our subnet is well formatted in dotted decimal
         if ip and mask:
             common.validate_ip_address(ip)
@@ -48,62 +348,164 @@ class SpokeSubnet(SpokeKV):
             self.network = self.subnet.network()
             self.mask = self.subnet.mask
         
+            self.dc = dc
             if dc is not None:
                 self.kv_name = dc + str(self.network)
                 self.kv_free = '%s:%s:%s:free' % (dc, self.network, self.mask)
                 self.kv_aloc = '%s:%s:%s:aloc' % (dc, self.network, self.mask)
+                self.kv_cursor = '%s:%s:%s:cursor' % (dc, self.network, self.mask)
+                self.kv_sync = '%s:%s:%s:ldap_sync' % (dc, self.network, self.mask)
+                self.kv_ranges = '%s:%s:ranges' % (self.kv_index, dc)
             else:
                 self.kv_name = str(self.network)
                 self.kv_free = '%s:%s:free' % (self.network, self.mask)
                 self.kv_aloc = '%s:%s:aloc' % (self.network, self.mask)
+                self.kv_cursor = '%s:%s:cursor' % (self.network, self.mask)
+                self.kv_sync = '%s:%s:ldap_sync' % (self.network, self.mask)
+                self.kv_ranges = '%s:ranges' % self.kv_index
             self.ip_ldap_enabled = self.config.get('IP', 'ip_ldap_enabled', False)
             self.ip_ldap_attr = self.config.get('IP', 'ip_ldap_attr', 'dhcpStatements')
             self.ip_ldap_key = self.config.get('IP', 'ip_ldap_key', 'fixed-address')
             self.ip_ldap_search_base = self.config.get('IP', 'ip_ldap_search_base', False)
+            self.ip_pool_mode = self.config.get('IP', 'ip_pool_mode', 'set')
+            self.kv_field = '%s/%s' % (self.kv_name, self.mask)
+            self.kv_range = '%s/%s' % (self.network, self.mask)
+            self.reserve_script = self.KV.register_script(lua_reserve)
+            self.count_script = self.KV.register_script(lua_count)
+            self.register_script = self.KV.register_script(lua_register)
+            self.stats_script = self.KV.register_script(lua_stats)
+            self.block_script = self.KV.register_script(lua_reserve_block)
+            self.claim_script = self.KV.register_script(lua_claim_range)
+            if self.ip_pool_mode not in self.pool_modes:
+                msg = 'IP pool mode must be one of %s' % self.pool_modes
+                raise error.ConfigError(msg)
+            if policy is None:
+                policy = self.config.get('IP', 'ip_alloc_policy', 'random')
+            if policy not in self.alloc_policies:
+                msg = 'IP allocation policy must be one of %s' % \
+                                                        self.alloc_policies
+                raise error.InputError(msg)
+            # Set pools have no order; catch this before a subnet is created
+            if policy != 'random' and self.ip_pool_mode != 'bitmap':
+                msg = 'Allocation policy %s requires ip_pool_mode bitmap' % \
+                                                                        policy
+                raise error.InputError(msg)
+            self.alloc_policy = policy
         else:
             (self.network, self.mask) = (None, None)
 
-    def _populate_from_ldap(self):
-        """Create a list of allocated IP addresses from LDAP"""
+    def _search_ldap_ips(self, since=None):
+        """Search LDAP for IP addresses allocated within our subnet.
+        
+        Return a set of subnet offsets and the latest modifyTimestamp seen.
+        If since is given, only entries modified at or after it are read."""
         if not self.ip_ldap_search_base:
             msg = 'LDAP enabled but no LDAP search base defined'
             raise error.ConfigError(msg)
-        # Do LDAP search and populate allocated IP address store
         ldap = SpokeLDAP()
         dn = self.ip_ldap_search_base
         search_scope = 2 # ldap.SCOPE_SUBTREE
         # Filter requires a modified DHCP schema with substr match support
         filter = '%s=%s*' % (self.ip_ldap_attr, self.ip_ldap_key)
-        attr = [self.ip_ldap_attr]
+        if since is not None:
+            filter = '(&(%s)(modifyTimestamp>=%s))' % (filter, since)
+        attr = [self.ip_ldap_attr, 'modifyTimestamp']
         result = ldap._get_object(dn, search_scope, filter, attr)
-        if result['data'] == []:
+        network = long(self.network)
+        offsets = set()
+        mark = since
+        for (dn, attrs) in result['data']:
+            for stamp in attrs.get('modifyTimestamp', []):
+                if mark is None or stamp > mark:
+                    mark = stamp
+            for entry in attrs.get(self.ip_ldap_attr, []):
+                # Remove the string prefix
+                value = entry.split()
+                if len(value) != 2 or value[0] != self.ip_ldap_key:
+                    continue
+                try:
+                    ip = ip_helper.ip_to_int(value[1])
+                except ValueError:
+                    self.log.debug('Ignoring invalid IP address %s' % value[1])
+                    continue
+                # Check if ip address is in our subnet
+                if ip in self.subnet:
+                    offsets.add(ip - network)
+        return (offsets, mark)
+
+    def _populate_from_ldap(self):
+        """Create a list of allocated IP addresses from LDAP"""
+        (offsets, self.ldap_mark) = self._search_ldap_ips()
+        if not offsets:
             msg = 'No reserved IP addresses found in LDAP'
             self.log.debug(msg)
             return True
-        # Loop through our result and build a set of allocated addresses
-        for item in result['data']:
-        # Fetch the value of the IP Address attribute
-            entry = item[1][self.ip_ldap_attr][0]
-            # Remove the string prefix
-            ip = entry.split(' ')[1]           
-            # Check if ip address is in our subnet
-            if self.subnet.has_key(ip):
-                self.aloc_ips.add(ip)
-        msg = 'Found %s IP addreses in LDAP' % len(self.aloc_ips)
+        self.aloc_offsets.update(offsets)
+        self.aloc_ips.update(self._offsets_to_ips(offsets))
+        msg = 'Found %s IP addreses in LDAP' % len(offsets)
         self.log.debug(msg)
                 
+    def _get_pool_mode(self):
+        """Return the storage mode of an existing subnet (or the default)."""
+        # An exhausted set is removed by Redis, so check both keys
+        pipe = self.KV.pipeline(transaction=False)
+        pipe.type(self.kv_free)
+        pipe.type(self.kv_aloc)
+        for kv_type in pipe.execute():
+            if kv_type == 'string':
+                return 'bitmap'
+            elif kv_type == 'set':
+                return 'set'
+        return self.ip_pool_mode
+
+    def _host_range(self):
+        """Return the first and last + 1 offsets of the host addresses.
+        
+        The network and broadcast addresses are never handed out, except in
+        /31 and /32 subnets which have neither (RFC 3021)."""
+        size = self.subnet.size()
+        if self.mask >= 31:
+            return (0, size)
+        return (1, size - 1)
+
+    def _ip_to_offset(self, ip):
+        """Convert an IP address to its bit offset within the subnet."""
+        n = ip_helper.ip_to_int(ip)
+        if n not in self.subnet:
+            msg = '%s is not within subnet %s/%s' % (ip, self.network, self.mask)
+            raise error.InputError(msg)
+        return n - long(self.network)
+
+    def _offsets_to_ips(self, offsets):
+        """Convert a sequence of bit offsets to a list of IP addresses."""
+        network = long(self.network)
+        return ip_helper.ints_to_ips([network + offset for offset in offsets])
+
     def _populate_aloc_ips(self, aloc_ips=None):
         """Calculate allocated IPs; populate KV store."""
         self.aloc_ips = set()
+        self.aloc_offsets = set() # Allocated IPs within our subnet
+        self.ldap_mark = None
+        network = long(self.network)
         # Add any directly provided allocated IPs
         if aloc_ips:
             for ip in aloc_ips:
                 self.aloc_ips.add(ip)
+                n = ip_helper.ip_to_int(common.validate_ip_address(ip))
+                if n in self.subnet:
+                    self.aloc_offsets.add(n - network)
+                else:
+                    self.log.debug('Ignoring %s, not in subnet' % ip)
         if self.ip_ldap_enabled == 'yes':
             self._populate_from_ldap()  
+            if self.ldap_mark is not None:
+                self.KV.set(self.kv_sync, self.ldap_mark)
             
         if len(self.aloc_ips) == 0:
             return True
+        if self.ip_pool_mode == 'bitmap':
+            # Allocated bits are written along with the free bitmap
+            return True
         # Write set to KV store
         for ip in self.aloc_ips:
             self.KV.sadd(self.kv_aloc, ip)
@@ -111,50 +513,213 @@ class SpokeSubnet(SpokeKV):
         self.log.debug(msg)
         return True
     
-    def _populate_free_ips(self):
-        """Populate KV store with all free IP within a given subnet."""
-        all_ips = set()
-        # /8 network takes 1h 9m (2Ghz CPU and 4GB RAM); produces DB of 220MB
+    def _iter_free_offsets(self):
+        """Yield the offset of each free IP in the subnet, lowest first.
+        
+        Offsets are generated on demand and the (usually short) sorted list
+        of allocated offsets is used to skip over reserved addresses, along
+        with the network and broadcast."""
+        (start, last) = self._host_range()
+        for stop in sorted(self.aloc_offsets) + [last]:
+            for offset in xrange(start, stop):
+                yield offset
+            start = max(start, stop + 1)
+
+    def _populate_free_ips(self, progress=None):
+        """Populate KV store with all free IP within a given subnet.
+        
+        Free addresses are streamed to Redis in pipelined chunks so memory
+        use does not grow with the size of the subnet. If given, progress
+        is called as progress(written, total) after each round trip."""
+        if self.ip_pool_mode == 'bitmap':
+            return self._populate_free_bitmap(progress)
+        # /16 network is 64k set members; a /8 would be a DB of over 1GB
         if self.mask < self.max_mask:
             msg = 'Subnets larger than %s must be created manually' % self.mask
             raise error.InputError(msg)
-        for ip in self.subnet:
-            all_ips.add(str(ip))
-        self.free_ips = all_ips - self.aloc_ips
-            
-        for free_ip in self.free_ips:
-            self.KV.sadd(self.kv_free, free_ip)
-        # Remove the network and broadcast addresses
-        self.KV.srem(self.kv_free, self.subnet.network())
-        self.KV.srem(self.kv_free, self.subnet.broadcast())
+        (first, last) = self._host_range()
+        total = last - first
+        self.free_count = 0
+        pipe = self.KV.pipeline(transaction=False)
+        chunk = []
+        for offset in self._iter_free_offsets():
+            chunk.append(offset)
+            if len(chunk) < self.populate_chunk:
+                continue
+            pipe.sadd(self.kv_free, *self._offsets_to_ips(chunk))
+            self.free_count += len(chunk)
+            chunk = []
+            if len(pipe) >= self.populate_depth:
+                pipe.execute()
+                if progress is not None:
+                    progress(self.free_count, total)
+        if chunk:
+            pipe.sadd(self.kv_free, *self._offsets_to_ips(chunk))
+            self.free_count += len(chunk)
+        pipe.execute()
+        if progress is not None:
+            progress(self.free_count, total)
         msg = 'KV store %s populated with %s free IP addresses' % \
-            (self.kv_free, len(self.free_ips))
+            (self.kv_free, self.free_count)
+        self.log.debug(msg)
+        return True
+
+    def _populate_free_bitmap(self, progress=None):
+        """Populate KV store with a bitmap of free IPs (one bit per address).
+        
+        Bit n of the free bitmap is set when network address + n is free;
+        bit n of the allocated bitmap is set when it is reserved. A /8 is
+        a 2MB string and is written in a handful of SETRANGE calls."""
+        if self.mask < self.bitmap_max_mask:
+            msg = 'Subnets larger than %s must be created manually' % \
+                                                        self.bitmap_max_mask
+            raise error.InputError(msg)
+        size = self.subnet.size()
+        chunk = 65536 # bytes written per SETRANGE
+        (full_bytes, tail_bits) = divmod(size, 8)
+        pipe = self.KV.pipeline(transaction=False)
+        for start in xrange(0, full_bytes, chunk):
+            length = min(chunk, full_bytes - start)
+            pipe.setrange(self.kv_free, start, '\xff' * length)
+        if tail_bits:
+            # Subnets smaller than 8 addresses only fill the high bits
+            pipe.setrange(self.kv_free, full_bytes,
+                          chr((0xff << (8 - tail_bits)) & 0xff))
+        # Remove the network and broadcast addresses
+        (first, last) = self._host_range()
+        if first > 0:
+            pipe.setbit(self.kv_free, 0, 0)
+            pipe.setbit(self.kv_free, size - 1, 0)
+        for offset in self.aloc_offsets:
+            pipe.setbit(self.kv_free, offset, 0)
+            pipe.setbit(self.kv_aloc, offset, 1)
+        pipe.bitcount(self.kv_free)
+        self.free_count = pipe.execute()[-1]
+        if progress is not None:
+            progress(self.free_count, last - first)
+        msg = 'KV store %s populated with a bitmap of %s free IP addresses' % \
+            (self.kv_free, self.free_count)
         self.log.debug(msg)
         return True
     
     def _release_ip(self, ip):
         """Release an IP from the pool of allocated IPs"""
         ip = common.validate_ip_address(ip)
-        self.KV.srem(self.kv_aloc, ip)
-        self.KV.sadd(self.kv_free, ip)
+        offset = self._ip_to_offset(ip)
+        (first, last) = self._host_range()
+        if offset < first or offset >= last:
+            msg = '%s is the network or broadcast address of %s/%s' % \
+                                                (ip, self.network, self.mask)
+            raise error.InputError(msg)
+        if self._get_pool_mode() == 'bitmap':
+            pipe = self.KV.pipeline(transaction=True)
+            pipe.setbit(self.kv_aloc, offset, 0)
+            pipe.setbit(self.kv_free, offset, 1)
+            pipe.execute()
+        else:
+            pipe = self.KV.pipeline(transaction=True)
+            pipe.srem(self.kv_aloc, ip)
+            pipe.sadd(self.kv_free, ip)
+            pipe.execute()
+        self._update_registry()
         return True
 
     def _reserve_ip(self, number):
         """Reserve an IP from the pool of free IPs"""
-        common.is_number(number)
+        if not common.is_integer(number):
+            msg = 'Number of IP addresses to reserve must be an integer'
+            raise error.InputError(msg)
         number = int(number)
-        if number > self.KV.scard(self.kv_free):
+        if number < 1:
+            msg = 'Number of IP addresses to reserve must be at least 1'
+            raise error.InputError(msg)
+        keys = [self.kv_free, self.kv_aloc, self.kv_cursor, self.kv_index,
+                self.kv_index_free, self.kv_index_aloc]
+        args = [number, self.alloc_policy, self.subnet.size(),
+                random.randint(0, 2**31), self.kv_field]
+        reserved = self.reserve_script(keys=keys, args=args)
+        if reserved is None:
             msg = 'Fewer than %s free IP addresses in the subnet store %s' % \
             (number, self.kv_free)
             raise error.InsufficientResource(msg)
-        offer = []
-        for i in range(number):
-            ip = self.KV.spop(self.kv_free)
-            offer.append(ip)
-            self.KV.sadd(self.kv_aloc, ip)
+        (mode, offer) = reserved
+        if mode == 'unsupported':
+            msg = 'Allocation policy %s requires a bitmap pool' % \
+                                                        self.alloc_policy
+            raise error.InputError(msg)
+        if mode == 'bitmap':
+            offer = self._offsets_to_ips(offer)
         return offer
     
-    def create(self, aloc_ips=None):
+    def _reserve_block(self, number=None, prefix=None):
+        """Reserve a contiguous block of IPs from the pool of free IPs."""
+        if (number is None) == (prefix is None):
+            msg = 'Please specify either a number of IPs or a prefix'
+            raise error.InputError(msg)
+        size = self.subnet.size()
+        if prefix is not None:
+            if not common.is_integer(prefix):
+                msg = 'Block prefix must be an integer'
+                raise error.InputError(msg)
+            prefix = int(prefix)
+            if prefix <= self.mask or prefix > 32:
+                msg = 'Block prefix must be between %s and 32' % (self.mask + 1)
+                raise error.InputError(msg)
+            length = align = 2 ** (32 - prefix)
+        else:
+            if not common.is_integer(number):
+                msg = 'Number of IP addresses to reserve must be an integer'
+                raise error.InputError(msg)
+            length = int(number)
+            align = 1
+            if length < 1 or length > size:
+                msg = 'Number of IP addresses to reserve must be between ' \
+                      '1 and %s' % size
+                raise error.InputError(msg)
+        keys = [self.kv_free, self.kv_aloc, self.kv_index, self.kv_index_free,
+                self.kv_index_aloc]
+        args = [size, long(self.network), length, align, self.kv_field]
+        start = self.block_script(keys=keys, args=args)
+        if start is None:
+            msg = 'No block of %s free IP addresses in the subnet store %s' % \
+            (length, self.kv_free)
+            raise error.InsufficientResource(msg)
+        return self._offsets_to_ips(xrange(start, start + length))
+
+    def _claim_range(self, present_ok=False):
+        """Reserve our address range in the range index; raise AlreadyExists
+        on overlap, or if the range is already ours unless present_ok.
+        
+        A concurrent create of the same subnet passes the exists check in
+        create, so only the claim tells which of the two got there first."""
+        first = long(self.network)
+        last = first + self.subnet.size() - 1
+        status = self.claim_script(keys=[self.kv_ranges],
+                                   args=[first, last, self.kv_range])
+        if status[0] == 'present' and not present_ok:
+            msg = 'Subnet %s/%s already exists' % (self.kv_name, str(self.mask))
+            raise error.AlreadyExists(msg)
+        if status[0] == 'overlap':
+            conflict = status[1]
+            if self.dc is not None:
+                conflict = '%s (dc %s)' % (conflict, self.dc)
+            msg = 'Subnet %s/%s overlaps existing subnet %s' % \
+                                        (self.network, self.mask, conflict)
+            raise error.AlreadyExists(msg)
+
+    def _update_registry(self, register=False):
+        """Record our free and allocated counts in the subnet registry,
+        registering the subnet too if register; return True if recorded."""
+        meta = ''
+        if register:
+            meta = json.dumps({'name': self.kv_name, 'dc': self.dc,
+                               'network': str(self.network), 
+                               'mask': self.mask})
+        keys = [self.kv_free, self.kv_aloc, self.kv_index, self.kv_index_free,
+                self.kv_index_aloc]
+        return self.register_script(keys=keys, args=[self.kv_field, meta]) == 1
+
+    def create(self, aloc_ips=None, progress=None):
         """Create subnet kv stores; populate with IPs; return True."""
         if not (self.network and self.mask):
             msg = 'Please specify ip and mask'
@@ -164,11 +729,17 @@ class SpokeSubnet(SpokeKV):
             msg = 'Subnet %s/%s already exists' % (self.kv_name, str(self.mask))
             raise error.AlreadyExists(msg)      
         
-        self._populate_aloc_ips(aloc_ips)
-        self._populate_free_ips()
+        self._claim_range()
+        try:
+            self._populate_aloc_ips(aloc_ips)
+            self._populate_free_ips(progress)
+        except:
+            self.KV.zrem(self.kv_ranges, self.kv_range)
+            raise
+        self._update_registry(register=True)
         
         msg = 'Created subnet %s/%s with %s free and %s reserved IPs' \
-        % (self.kv_name, str(self.mask), len(self.free_ips), len(self.aloc_ips))
+        % (self.kv_name, str(self.mask), self.free_count, len(self.aloc_ips))
         self.log.debug(msg)
         result = self.get()
         if result['exit_code'] == 0 and result['count'] == 1:
@@ -179,30 +750,43 @@ class SpokeSubnet(SpokeKV):
             raise error.NotFound(msg)
         return result
     
+    def _get_all(self):
+        """Retrieve all registered subnets; return results list."""
+        pipe = self.KV.pipeline(transaction=False)
+        pipe.hgetall(self.kv_index)
+        pipe.hgetall(self.kv_index_free)
+        pipe.hgetall(self.kv_index_aloc)
+        (index, index_free, index_aloc) = pipe.execute()
+        data = []
+        for field in sorted(index):
+            meta = json.loads(index[field])
+            attributes = {}
+            attributes['free'] = [int(index_free.get(field, 0))]
+            attributes['aloc'] = [int(index_aloc.get(field, 0))]
+            attributes['mask'] = [meta['mask']]
+            if meta['dc'] is not None:
+                attributes['dc'] = [str(meta['dc'])]
+            data.append((str(meta['name']), attributes))
+        data.extend(SpokeSubnet6()._get_all()['data'])
+        result = common.process_results(data, 'Subnet')
+        self.log.debug('Result: %s' % result)
+        return result
+
     def get(self):
         """Retrieve subnet information; return results list."""
         if not (self.network and self.mask): # Retrive all subnets
-            data = self.KV.keys()
-            result = common.process_results(data, 'Subnet')
-            self.log.debug('Result: %s' % result)
-            return result
+            return self._get_all()
         data = []
         obj = self.kv_name
+        (kv_type, free, aloc) = self.count_script(keys=[self.kv_free, 
+                                                        self.kv_aloc])
         attributes = {}
-        attributes['free'] = [self.KV.scard(self.kv_free)]
-        attributes['aloc'] = [self.KV.scard(self.kv_aloc)]
+        attributes['free'] = [free]
+        attributes['aloc'] = [aloc]
         if attributes['free'] == [0] and attributes ['aloc'] == [0]:
             result = common.process_results(data, 'Subnet')
             self.log.debug('Result: %s' % result)
             return result
-        try:
-            free = attributes['free'][0]
-        except KeyError:
-            free = 0
-        try:
-            aloc = attributes['aloc'][0]
-        except KeyError:
-            aloc = 0
         msg = 'Subnet %s/%s found; %s free and %s pre-allocated IP addresses' % \
                 (self.kv_name, str(self.mask), free, aloc)
         self.log.debug(msg)
@@ -212,6 +796,58 @@ class SpokeSubnet(SpokeKV):
         self.log.debug('Result: %s' % result)
         return result
             
+    def _get_stats(self, pipe):
+        """Queue a stats script call for this subnet on pipeline pipe."""
+        keys = [self.kv_free, self.kv_aloc]
+        args = [self.subnet.size(), long(self.network)]
+        self.stats_script(keys=keys, args=args, client=pipe)
+
+    def _process_stats(self, name, stats):
+        """Turn a stats script reply into a (name, attributes) result item."""
+        (kv_type, free, aloc, runs, largest, summary) = stats
+        size = self.subnet.size()
+        # The network and broadcast addresses are never free, leave them out
+        (first, last) = self._host_range()
+        hosts = last - first
+        attributes = {}
+        attributes['free'] = [free]
+        attributes['aloc'] = [aloc]
+        attributes['size'] = [size]
+        attributes['utilisation'] = [round(100.0 * (hosts - free) / hosts, 2)]
+        attributes['free_runs'] = [runs]
+        attributes['largest_free_run'] = [largest]
+        attributes['free_blocks'] = [dict(('/%s' % summary[i], summary[i + 1])
+                                          for i in range(0, len(summary), 2))]
+        return (name, attributes)
+
+    def stats(self):
+        """Report utilisation and fragmentation; return results list.
+        
+        Works on this subnet, or on every registered subnet if no network
+        was given. For each, free_runs and largest_free_run describe runs of
+        consecutive free addresses and free_blocks counts the aligned free
+        CIDR blocks by prefix. Everything is computed inside Redis."""
+        if self.network and self.mask:
+            subnets = [self]
+        else:
+            subnets = []
+            for meta in self.KV.hvals(self.kv_index):
+                meta = json.loads(meta)
+                subnets.append(SpokeSubnet(meta['network'], meta['mask'],
+                                           meta['dc']))
+        pipe = self.KV.pipeline(transaction=False)
+        for subnet in subnets:
+            subnet._get_stats(pipe)
+        data = []
+        for (subnet, stats) in zip(subnets, pipe.execute()):
+            if stats[1] == 0 and stats[2] == 0:
+                continue # Not created, or deleted since it was registered
+            data.append(subnet._process_stats(subnet.kv_name, stats))
+        data.sort()
+        result = common.process_results(data, 'Subnet')
+        self.log.debug('Result: %s' % result)
+        return result
+
     def modify(self, reserve=False, release=False):
         """Reserve or release IP address from Subnet"""
         if not (self.network and self.mask):
@@ -236,6 +872,75 @@ class SpokeSubnet(SpokeKV):
             self.log.debug('Result: %s' % result)
             return result
         
+    def reserve_block(self, number=None, prefix=None):
+        """Reserve a contiguous block of IPs from Subnet; return results.
+        
+        Either number consecutive IPs or an aligned block of the given
+        prefix length (e.g. 28) is found and claimed in one atomic step."""
+        if not (self.network and self.mask):
+            msg = 'Please specify ip and mask'
+            raise error.InputError(msg)
+        offer = self._reserve_block(number, prefix)
+        result = common.process_results(offer)
+        result['msg'] = 'Reserved ip block %s-%s from %s' % \
+                                        (offer[0], offer[-1], self.kv_name)
+        self.log.debug('Result: %s' % result)
+        return result
+
+    def sync(self):
+        """Reserve IPs allocated in LDAP since the last sync; return results.
+        
+        Only entries modified since the stored high water mark are read, so
+        addresses freed by deleting an LDAP entry are not released."""
+        if not (self.network and self.mask):
+            msg = 'Please specify ip and mask'
+            raise error.InputError(msg)
+        if self.ip_ldap_enabled != 'yes':
+            msg = 'LDAP sync requested but ip_ldap_enabled is not yes'
+            raise error.ConfigError(msg)
+        if self.get()['data'] == []:
+            msg = 'Subnet %s/%s not found, cannot sync' % \
+                                                (self.kv_name, str(self.mask))
+            raise error.NotFound(msg)
+        since = self.KV.get(self.kv_sync)
+        (offsets, mark) = self._search_ldap_ips(since)
+        pipe = self.KV.pipeline(transaction=True)
+        if self._get_pool_mode() == 'bitmap':
+            for offset in offsets:
+                pipe.setbit(self.kv_free, offset, 0)
+                pipe.setbit(self.kv_aloc, offset, 1)
+        else:
+            for ip in self._offsets_to_ips(offsets):
+                pipe.srem(self.kv_free, ip)
+                pipe.sadd(self.kv_aloc, ip)
+        if mark is not None:
+            pipe.set(self.kv_sync, mark)
+        pipe.execute()
+        self._update_registry()
+        result = self.get()
+        result['msg'] = 'Synced %s ip(s) from LDAP to %s' % \
+                                                (len(offsets), self.kv_name)
+        self.log.debug('Result: %s' % result)
+        return result
+
+    def register(self):
+        """Register a subnet created before the subnet registry and range
+        index existed; return results. A subnet overlapping one already
+        indexed raises AlreadyExists and is left unregistered."""
+        if not (self.network and self.mask):
+            msg = 'Please specify ip and mask'
+            raise error.InputError(msg)
+        result = self.get()
+        if result['data'] == []:
+            msg = 'Subnet %s/%s not found, cannot register' % \
+                                                (self.kv_name, str(self.mask))
+            raise error.NotFound(msg)
+        self._claim_range(present_ok=True)
+        self._update_registry(register=True)
+        result['msg'] = 'Registered %s:' % result['type']
+        self.log.debug('Result: %s' % result)
+        return result
+
     def delete(self):
         """Delete subnet kv stores; return True."""
         if not (self.network and self.mask):
@@ -245,8 +950,13 @@ class SpokeSubnet(SpokeKV):
             msg = "cannot delete as already missing"
             raise error.NotFound, msg
         # Delete kv stores
-        self.KV.delete(self.kv_aloc)
-        self.KV.delete(self.kv_free)
+        pipe = self.KV.pipeline(transaction=True)
+        pipe.delete(self.kv_aloc, self.kv_free, self.kv_cursor, self.kv_sync)
+        pipe.hdel(self.kv_index, self.kv_field)
+        pipe.hdel(self.kv_index_free, self.kv_field)
+        pipe.hdel(self.kv_index_aloc, self.kv_field)
+        pipe.zrem(self.kv_ranges, self.kv_range)
+        pipe.execute()
         result = self.get()
         if result['exit_code'] == 3 and result['count'] == 0:
             result['msg'] = "Deleted %s:" % result['type']
@@ -254,3 +964,410 @@ class SpokeSubnet(SpokeKV):
         else:
             msg = 'Delete operation returned OK, but object still there?'
             raise error.SearchError(msg)
+
+class SpokeSubnet6(SpokeKV):
+    
+    """Provide CRUD methods to IPv6 subnet objects.
+    
+    The address space is never enumerated. Allocated addresses are kept in
+    a sorted set of fixed width hex strings (so lexical order is address
+    order) and new ones come from a counter, so the cost of an allocation
+    does not depend on the size of the subnet. Released addresses go to a
+    freed set and are handed out again first; once the counter runs past
+    the end of the subnet the allocated set is scanned for gaps. Schemes are:
+    sequential - hand out network + 1, + 2, ...
+    hashed - hand out addresses scattered across the subnet by hashing the
+             counter, so they can not be guessed from their neighbours.
+    delegate - hand out whole prefixes (e.g. /64s from a /48) in order."""
+    
+    def __init__(self, ip=None, mask=None, dc=None, scheme=None):
+        """Get config, setup logging and Redis connection."""
+        SpokeKV.__init__(self)
+        self.config = config.setup()
+        self.log = logging.getLogger(__name__)
+        self.schemes = ['sequential', 'hashed', 'delegate']
+        self.max_attempts = 64 # Rounds of hashed picks before giving up
+        self.kv_index = self.config.get('IP', 'ip_subnet_index', 'spoke:subnets')
+        self.kv_index6 = '%s:ip6' % self.kv_index
+        self.dc = dc
+        self.delegate_prefix = int(self.config.get('IP', 'ip6_delegate_prefix',
+                                                   64))
+        if scheme is None:
+            scheme = self.config.get('IP', 'ip6_alloc_scheme', 'sequential')
+        if scheme not in self.schemes:
+            msg = 'IPv6 allocation scheme must be one of %s' % self.schemes
+            raise error.InputError(msg)
+        self.scheme = scheme
+        if not (ip and mask):
+            (self.network, self.mask) = (None, None)
+            return
+        if not common.is_integer(mask):
+            msg = 'IPv6 subnet mask must be an integer'
+            raise error.InputError(msg)
+        self.mask = int(mask)
+        if self.mask < 0 or self.mask > 127:
+            msg = 'IPv6 subnet mask must be between 0 and 127'
+            raise error.InputError(msg)
+        host_bits = 128 - self.mask
+        self.first = self._to_int(ip) >> host_bits << host_bits
+        self.network = ip_helper.int_to_ip6(self.first)
+        self.kv_name = self.network
+        if dc is not None:
+            self.kv_name = dc + self.network
+        base = '%s/%s' % (self.kv_name, self.mask)
+        self.kv_field = base
+        self.kv_meta = '%s:meta' % base
+        self.kv_aloc = '%s:aloc' % base
+        self.kv_freed = '%s:freed' % base
+        self.kv_ranges = '%s:ranges6' % self.kv_index
+        if dc is not None:
+            self.kv_ranges = '%s:%s:ranges6' % (self.kv_index, dc)
+        self.kv_range = '%032x/%s' % (self.first, self.mask)
+
+    def _to_int(self, ip):
+        """Convert an IPv6 address to an integer; raise InputError."""
+        try:
+            return ip_helper.ip6_to_int(str(ip))
+        except (socket.error, ValueError):
+            msg = '%s is not a valid IPv6 address' % ip
+            raise error.InputError(msg)
+
+    def _get_meta(self):
+        """Return the stored scheme of this subnet, or raise NotFound."""
+        scheme = self.KV.hget(self.kv_meta, 'scheme')
+        if scheme is None:
+            msg = 'Subnet %s/%s not found' % (self.kv_name, self.mask)
+            raise error.NotFound(msg)
+        return scheme
+
+    def _unit(self, scheme):
+        """Return the bits handed out per allocation under scheme."""
+        if scheme == 'delegate':
+            return 128 - self.delegate_prefix
+        return 0
+
+    def _claim_range(self):
+        """Reserve our range in the IPv6 range index; raise on overlap.
+        
+        Members are hex/mask so the index sorts by first address; only the
+        nearest neighbours either side need checking."""
+        last = self.first + 2 ** (128 - self.mask) - 1
+        start = '%032x' % self.first
+        while True:
+            pipe = self.KV.pipeline(transaction=True)
+            try:
+                pipe.watch(self.kv_ranges)
+                before = pipe.zrevrangebylex(self.kv_ranges, '(' + start, '-',
+                                             0, 1)
+                after = pipe.zrangebylex(self.kv_ranges, '[' + start, '+', 0, 1)
+                for member in before + after:
+                    if member == self.kv_range:
+                        msg = 'Subnet %s/%s already exists' % \
+                                                    (self.kv_name, self.mask)
+                        raise error.AlreadyExists(msg)
+                    (hx, mask) = member.split('/')
+                    other = long(hx, 16)
+                    other_last = other + 2 ** (128 - int(mask)) - 1
+                    if other <= last and self.first <= other_last:
+                        conflict = '%s/%s' % (ip_helper.int_to_ip6(other), mask)
+                        if self.dc is not None:
+                            conflict = '%s (dc %s)' % (conflict, self.dc)
+                        msg = 'Subnet %s/%s overlaps existing subnet %s' % \
+                                            (self.network, self.mask, conflict)
+                        raise error.AlreadyExists(msg)
+                pipe.multi()
+                pipe.zadd(self.kv_ranges, {self.kv_range: 0})
+                pipe.execute()
+                return
+            except redis.WatchError:
+                continue
+            finally:
+                pipe.reset()
+
+    def create(self, aloc_ips=None):
+        """Create subnet kv stores; return results list."""
+        if not (self.network and self.mask):
+            msg = 'Please specify ip and mask'
+            raise error.InputError(msg)
+        if self.KV.exists(self.kv_meta):
+            msg = 'Subnet %s/%s already exists' % (self.kv_name, self.mask)
+            raise error.AlreadyExists(msg)
+        if self.scheme == 'delegate' and self.mask >= self.delegate_prefix:
+            msg = 'Delegating subnets must be larger than /%s' % \
+                                                        self.delegate_prefix
+            raise error.InputError(msg)
+        unit = self._unit(self.scheme)
+        aloc = {}
+        for ip in aloc_ips or []:
+            n = self._to_int(ip)
+            if n >> (128 - self.mask) != self.first >> (128 - self.mask):
+                self.log.debug('Ignoring %s, not in subnet' % ip)
+                continue
+            aloc['%032x' % (n >> unit << unit)] = 0
+        self._claim_range()
+        meta = json.dumps({'name': self.kv_name, 'dc': self.dc,
+                           'network': self.network, 'mask': self.mask})
+        pipe = self.KV.pipeline(transaction=True)
+        pipe.hmset(self.kv_meta, {'scheme': self.scheme, 'counter': 0})
+        if aloc:
+            pipe.zadd(self.kv_aloc, aloc)
+        pipe.hset(self.kv_index6, self.kv_field, meta)
+        pipe.execute()
+        result = self.get()
+        result['msg'] = "Created %s:" % result['type']
+        return result
+
+    def _get_all(self):
+        """Retrieve all IPv6 subnets; return results list."""
+        data = []
+        for meta in sorted(self.KV.hvals(self.kv_index6)):
+            meta = json.loads(meta)
+            subnet = SpokeSubnet6(meta['network'], meta['mask'], meta['dc'])
+            data.extend(subnet.get()['data'])
+        result = common.process_results(data, 'Subnet')
+        self.log.debug('Result: %s' % result)
+        return result
+
+    def get(self):
+        """Retrieve subnet information; return results list."""
+        if not (self.network and self.mask):
+            return self._get_all()
+        data = []
+        pipe = self.KV.pipeline(transaction=False)
+        pipe.hget(self.kv_meta, 'scheme')
+        pipe.zcard(self.kv_aloc)
+        (scheme, aloc) = pipe.execute()
+        if scheme is not None:
+            unit = self._unit(scheme)
+            # The subnet-router anycast address (offset 0) is never handed out
+            total = 2 ** (128 - self.mask - unit) - (unit == 0 and 1 or 0)
+            attributes = {'free': [total - aloc], 'aloc': [aloc],
+                          'mask': [self.mask], 'scheme': [scheme]}
+            data.append((self.kv_name, attributes))
+        result = common.process_results(data, 'Subnet')
+        self.log.debug('Result: %s' % result)
+        return result
+
+    def _candidates(self, scheme, number):
+        """Return number new candidate offsets from the subnet counter."""
+        unit = self._unit(scheme)
+        slots = 2 ** (128 - self.mask - unit)
+        last = self.KV.hincrby(self.kv_meta, 'counter', number)
+        counters = xrange(last - number + 1, last + 1)
+        if scheme == 'hashed':
+            offsets = []
+            for counter in counters:
+                key = '%s:%s' % (self.kv_range, counter)
+                offset = long(hashlib.sha1(key).hexdigest(), 16) % slots
+                offsets.append(offset)
+            return offsets
+        if scheme == 'sequential':
+            offsets = list(counters) # Counters start at 1, skipping anycast 0
+        else:
+            offsets = [counter - 1 for counter in counters]
+        if offsets[-1] >= slots:
+            return None
+        return offsets
+
+    def _claim(self, members):
+        """Add members to the allocated set; return those that were free."""
+        pipe = self.KV.pipeline(transaction=False)
+        for member in members:
+            pipe.zadd(self.kv_aloc, {member: 0}, nx=True)
+        return [member for (member, added) in zip(members, pipe.execute())
+                if added]
+
+    def _scan(self, scheme, number):
+        """Return up to number unallocated offsets, lowest first, found by
+        walking the allocated set for gaps."""
+        unit = self._unit(scheme)
+        slots = 2 ** (128 - self.mask - unit)
+        offsets = []
+        expected = unit == 0 and 1 or 0 # Skip subnet-router anycast
+        start = '-'
+        while len(offsets) < number and expected < slots:
+            members = self.KV.zrangebylex(self.kv_aloc, start, '+', 0, 1000)
+            if not members:
+                break
+            for member in members:
+                offset = (long(member, 16) - self.first) >> unit
+                while expected < offset and len(offsets) < number:
+                    offsets.append(expected)
+                    expected += 1
+                expected = max(expected, offset + 1)
+            start = '(' + members[-1]
+        while expected < slots and len(offsets) < number:
+            offsets.append(expected)
+            expected += 1
+        return offsets
+
+    def _reserve(self, number):
+        """Reserve number addresses (or prefixes); all or nothing."""
+        if not common.is_integer(number):
+            msg = 'Number of IP addresses to reserve must be an integer'
+            raise error.InputError(msg)
+        number = int(number)
+        if number < 1:
+            msg = 'Number of IP addresses to reserve must be at least 1'
+            raise error.InputError(msg)
+        scheme = self._get_meta()
+        unit = self._unit(scheme)
+        # Released addresses first, then new ones from the counter
+        offer = self._claim(self.KV.spop(self.kv_freed, number) or [])
+        for attempt in xrange(self.max_attempts):
+            if len(offer) == number:
+                break
+            offsets = self._candidates(scheme, number - len(offer))
+            if offsets is None:
+                break
+            members = ['%032x' % (self.first + (offset << unit))
+                       for offset in offsets if offset or unit]
+            offer.extend(self._claim(members))
+        if len(offer) < number:
+            # The counter has run out (or hashing keeps colliding)
+            offsets = self._scan(scheme, number - len(offer))
+            offer.extend(self._claim(['%032x' % (self.first + (offset << unit))
+                                      for offset in offsets]))
+        if len(offer) < number:
+            if offer:
+                pipe = self.KV.pipeline(transaction=True)
+                pipe.zrem(self.kv_aloc, *offer)
+                pipe.sadd(self.kv_freed, *offer)
+                pipe.execute()
+            msg = 'Fewer than %s free addresses in subnet %s/%s' % \
+                                            (number, self.kv_name, self.mask)
+            raise error.InsufficientResource(msg)
+        offer = [ip_helper.int_to_ip6(long(member, 16)) for member in offer]
+        if unit:
+            offer = ['%s/%s' % (ip, self.delegate_prefix) for ip in offer]
+        return offer
+
+    def _release(self, ip):
+        """Return an address (or delegated prefix) to the subnet."""
+        scheme = self._get_meta()
+        n = self._to_int(str(ip).split('/')[0])
+        if n >> (128 - self.mask) != self.first >> (128 - self.mask):
+            msg = '%s is not within subnet %s/%s' % (ip, self.network, self.mask)
+            raise error.InputError(msg)
+        unit = self._unit(scheme)
+        member = '%032x' % (n >> unit << unit)
+        if self.KV.zrem(self.kv_aloc, member):
+            self.KV.sadd(self.kv_freed, member)
+        return True
+
+    def modify(self, reserve=False, release=False):
+        """Reserve or release IPv6 addresses (or prefixes) from Subnet"""
+        if not (self.network and self.mask):
+            msg = 'Please specify ip and mask'
+            raise error.InputError(msg)
+        if not reserve and not release:
+            msg = 'You must specify if you wish to reserve or release an IP'
+            raise error.InputError(msg)
+        if reserve and release:
+            msg = 'You cannot simultaneously reserve and release an IP'
+            raise error.InputError(msg)
+        if reserve:
+            offer = self._reserve(reserve)
+            result = common.process_results(offer)
+            result['msg'] = 'Reserved ip(s) %s from %s' % (offer, self.kv_name)
+            self.log.debug('Result: %s' % result)
+            return result
+        self._release(release)
+        result = self.get()
+        result['msg'] = 'Returned %s ip(s) to %s' % (release, self.kv_name)
+        self.log.debug('Result: %s' % result)
+        return result
+
+    def delete(self):
+        """Delete subnet kv stores; return results list."""
+        if not (self.network and self.mask):
+            msg = 'Please specify ip and mask'
+            raise error.InputError(msg)
+        if self.get()['data'] == []:
+            msg = "cannot delete as already missing"
+            raise error.NotFound, msg
+        pipe = self.KV.pipeline(transaction=True)
+        pipe.delete(self.kv_meta, self.kv_aloc, self.kv_freed)
+        pipe.hdel(self.kv_index6, self.kv_field)
+        pipe.zrem(self.kv_ranges, self.kv_range)
+        pipe.execute()
+        result = self.get()
+        result['msg'] = "Deleted %s:" % result['type']
+        return result
+
+class SpokeSubnetLocator(SpokeKV):
+    
+    """Find the managed subnet(s) an IP address belongs to."""
+    
+    def __init__(self, dhcp=False):
+        """Get config, setup logging and Redis connection; load subnets.
+        
+        Subnets come from the KV subnet registry and, if dhcp is True, from
+        the DHCP subnet entries in LDAP. They are held in a prefix trie so
+        each lookup takes at most one step per bit of address."""
+        SpokeKV.__init__(self)
+        self.config = config.setup()
+        self.log = logging.getLogger(__name__)
+        self.kv_index = self.config.get('IP', 'ip_subnet_index', 'spoke:subnets')
+        self.kv_index6 = '%s:ip6' % self.kv_index
+        self.trie = ip_helper.PrefixTrie()
+        self.subnets = {} # (network, mask, version) -> list of result items
+        self._load_kv_subnets()
+        if dhcp:
+            self._load_dhcp_subnets()
+        for ((network, mask, version), items) in self.subnets.items():
+            self.trie.add(network, mask, items, version)
+        self.log.debug('Loaded %s subnet prefixes' % len(self.subnets))
+
+    def _add(self, network, mask, name, attributes):
+        """Record a subnet under its (normalised) network and mask."""
+        subnet = ip_helper.Network(network, int(mask))
+        key = (long(subnet.network()), subnet.mask, subnet.v)
+        attributes['network'] = [str(subnet.network())]
+        attributes['mask'] = [subnet.mask]
+        self.subnets.setdefault(key, []).append((name, attributes))
+
+    def _load_kv_subnets(self):
+        """Load the IPv4 and IPv6 subnets registered in the KV store."""
+        pipe = self.KV.pipeline(transaction=False)
+        pipe.hvals(self.kv_index)
+        pipe.hvals(self.kv_index6)
+        (index, index6) = pipe.execute()
+        for meta in index + index6:
+            meta = json.loads(meta)
+            attributes = {'source': ['kv']}
+            if meta['dc'] is not None:
+                attributes['dc'] = [str(meta['dc'])]
+            self._add(str(meta['network']), meta['mask'], str(meta['name']),
+                      attributes)
+
+    def _load_dhcp_subnets(self):
+        """Load the DHCP subnets held in LDAP."""
+        ldap = SpokeLDAP()
+        dn = self.config.get('DHCP', 'dhcp_basedn')
+        search_scope = 2 # ldap.SCOPE_SUBTREE
+        filter = '(objectClass=dhcpSubnet)'
+        attr = ['cn', 'dhcpNetMask']
+        result = ldap._get_object(dn, search_scope, filter, attr)
+        for (dn, attrs) in result['data']:
+            try:
+                network = common.validate_ip_address(attrs['cn'][0])
+                mask = int(attrs['dhcpNetMask'][0])
+            except (KeyError, ValueError, error.InputError):
+                self.log.debug('Ignoring malformed DHCP subnet %s' % dn)
+                continue
+            self._add(network, mask, dn, {'source': ['dhcp']})
+
+    def get(self, ip):
+        """Find the most specific subnet(s) containing ip; return results."""
+        try:
+            match = self.trie.match(ip_helper.IP(str(ip)))
+        except (ValueError, AssertionError):
+            msg = '%s is not a valid IP address' % ip
+            raise error.InputError(msg)
+        data = []
+        if match is not None:
+            data = match[1]
+        result = common.process_results(data, 'Subnet')
+        self.log.debug('Result: %s' % result)
+        return result
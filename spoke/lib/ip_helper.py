@@ -31,17 +31,184 @@
 
 __version__ = '0.2a'
 
-import types, socket
+import re, sys, types, socket, struct
+
+# Strict dotted decimal: four bytes of 0-255, none with a leading zero
+_octet = r'(25[0-5]|2[0-4][0-9]|1[0-9]{2}|[1-9]?[0-9])'
+_dotquad = re.compile(r'^(%s\.){3}%s\Z' % (_octet, _octet))
+
+def ip_to_int(dq):
+    '''
+    Convert an IPv4 dotquad to an integer.
+
+    Only strict dotted decimal is taken; the octal, hex and shorthand forms
+    inet_aton would also accept raise ValueError.
+    '''
+    if not _dotquad.match(dq):
+        raise ValueError, "%r: IPv4 address invalid" % dq
+    return struct.unpack('!I', socket.inet_aton(dq))[0]
+
+def int_to_ip(n):
+    '''
+    Convert an integer to an IPv4 dotquad.
+    '''
+    return socket.inet_ntoa(struct.pack('!I', n))
+
+def ip6_to_int(hx):
+    '''
+    Convert an IPv6 address (any notation) to an integer.
+    '''
+    high, low = struct.unpack('!QQ', socket.inet_pton(socket.AF_INET6, hx))
+    return high << 64 | low
+
+def int_to_ip6(n):
+    '''
+    Convert an integer to a compressed IPv6 address.
+
+    >>> int_to_ip6(ip6_to_int('2001:0db8:0000::0001'))
+    '2001:db8::1'
+    '''
+    packed = struct.pack('!QQ', n >> 64, n & 0xffffffffffffffff)
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+def ips_to_ints(dqs):
+    '''
+    Convert a sequence of IPv4 dotquads to a list of integers in one pass.
+
+    >>> ips_to_ints(['10.0.0.1', '10.0.0.2'])
+    [167772161, 167772162]
+    '''
+    dqs = list(dqs)
+    for dq in dqs:
+        if not _dotquad.match(dq):
+            raise ValueError, "%r: IPv4 address invalid" % dq
+    aton = socket.inet_aton
+    packed = ''.join([aton(dq) for dq in dqs])
+    return list(struct.unpack('!%dI' % (len(packed) / 4), packed))
+
+def ints_to_ips(ns):
+    '''
+    Convert a sequence of integers to a list of IPv4 dotquads in one pass.
+
+    >>> ints_to_ips([167772161, 167772162])
+    ['10.0.0.1', '10.0.0.2']
+    '''
+    ns = list(ns)
+    packed = struct.pack('!%dI' % len(ns), *ns)
+    ntoa = socket.inet_ntoa
+    return [ntoa(packed[i:i+4]) for i in xrange(0, len(packed), 4)]
+
+def _count(start, stop, step=1):
+    '''
+    Lazy xrange that also copes with IPv6 sized (long) bounds.
+    '''
+    if stop <= sys.maxint and start <= sys.maxint:
+        for n in xrange(start, stop, step):
+            yield n
+        return
+    n = start
+    while (step > 0 and n < stop) or (step < 0 and n > stop):
+        yield n
+        n += step
+
+_EMPTY = object() # Marks trie nodes which hold no value
+
+class PrefixTrie(object):
+    '''
+    Binary trie of IPv4 and IPv6 prefixes for longest prefix matching.
+    Inserts and lookups take one step per bit of prefix.
+
+    >>> trie = PrefixTrie()
+    >>> trie.insert('10.0.0.0/8', 'ten')
+    >>> trie.insert('10.1.0.0/16', 'ten-one')
+    >>> trie.match('10.1.2.3')
+    (16, 'ten-one')
+    >>> trie.matches('10.1.2.3')
+    [(8, 'ten'), (16, 'ten-one')]
+    >>> '192.168.0.1' in trie
+    False
+    '''
+
+    __slots__ = ('_roots',)
+
+    _bits = {4: 32, 6: 128}
+
+    def __init__(self):
+        # Each node is [zero child, one child, value]
+        self._roots = {4: [None, None, _EMPTY], 6: [None, None, _EMPTY]}
+
+    def add(self, n, mask, value, version=4):
+        '''
+        Store value against the prefix of integer address n and length mask.
+        '''
+        l = self._bits[version]
+        node = self._roots[version]
+        for i in xrange(l - 1, l - 1 - mask, -1):
+            bit = (n >> i) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, _EMPTY]
+            node = node[bit]
+        node[2] = value
+
+    def insert(self, prefix, value):
+        '''
+        Store value against a prefix, given as an IP/Network or a string in
+        CIDR notation.
+        '''
+        if not isinstance(prefix, IP):
+            prefix = IP(prefix)
+        self.add(prefix.ip, prefix.mask, value, prefix.v)
+
+    def _walk(self, n, version):
+        '''
+        Yield (prefix length, value) for each stored prefix covering n,
+        shortest first.
+        '''
+        l = self._bits[version]
+        node = self._roots[version]
+        mask = 0
+        while node is not None:
+            if node[2] is not _EMPTY:
+                yield (mask, node[2])
+            if mask == l:
+                break
+            node = node[(n >> (l - 1 - mask)) & 1]
+            mask += 1
+
+    def match_int(self, n, version=4):
+        '''
+        Longest stored prefix covering integer address n, as
+        (prefix length, value), or None.
+        '''
+        match = None
+        for match in self._walk(n, version):
+            pass
+        return match
+
+    def match(self, ip):
+        '''
+        Longest stored prefix covering ip, as (prefix length, value), or None.
+        '''
+        if not isinstance(ip, IP):
+            ip = IP(ip)
+        return self.match_int(ip.ip, ip.v)
+
+    def matches(self, ip):
+        '''
+        All stored prefixes covering ip, as (prefix length, value) tuples,
+        shortest first.
+        '''
+        if not isinstance(ip, IP):
+            ip = IP(ip)
+        return list(self._walk(ip.ip, ip.v))
+
+    def __contains__(self, ip):
+        return self.match(ip) is not None
 
 class IP(object):
 
-    # Hex-to-Bin conversion masks
-    _bitmask = {
-        '0': '0000', '1': '0001', '2': '0010', '3': '0011',
-        '4': '0100', '5': '0101', '6': '0110', '7': '0111',
-        '8': '1000', '9': '1001', 'a': '1010', 'b': '1011',
-        'c': '1100', 'd': '1101', 'e': '1110', 'f': '1111'
-        }
+    # The dotquad (dq) is only formatted when first asked for
+    __slots__ = ('ip', 'mask', 'v', '_dq')
 
     # IP range specific information, see IANA allocations.
     _range = {
@@ -93,23 +260,20 @@ class IP(object):
             }
         }
 
+
     def __init__(self, ip, mask=None, version=0):
         self.mask = mask
         self.v = 0
+        self._dq = None
         # Parse input
         if isinstance(ip, IP):
             self.ip = ip.ip
-            self.dq = ip.dq
+            self._dq = ip._dq
             self.v = ip.v
             self.mask = ip.mask
         elif type(ip) in [types.IntType, types.LongType]:
             self.ip = long(ip)
-            if self.ip <= 0xffffffff:
-                self.v = version or 4
-                self.dq = self._itodq(ip)
-            else:
-                self.v = version or 4
-                self.dq = self._itodq(ip)
+            self.v = version or 4
         else:
             # If string is in CIDR notation
             if '/' in ip:
@@ -124,21 +288,29 @@ class IP(object):
             self.mask = self.v == 4 and 32 or 128
         # Validate subnet size
         if self.v == 6:
-            self.dq = self._itodq(self.ip)
+            self._dq = None # Normalised to full hextets by _itodq
             if self.mask < 0 or self.mask > 128:
                 raise ValueError, "IPv6 subnet size must be between 0 and 128"
         elif self.v == 4:
             if self.mask < 0 or self.mask > 32:
                 raise ValueError, "IPv4 subnet size must be between 0 and 32"
 
+    def _get_dq(self):
+        if self._dq is None:
+            self._dq = self._itodq(self.ip)
+        return self._dq
+
+    def _set_dq(self, dq):
+        self._dq = dq
+
+    dq = property(_get_dq, _set_dq)
+
     def bin(self):
         '''
         Full-length binary representation of the IP address.
         '''
-        h = hex(self.ip).lower().rstrip('l')
-        b = ''.join(self._bitmask[x] for x in h[2:])
         l = self.v == 4 and 32 or 128
-        return ''.join('0' for x in xrange(len(b), l)) + b
+        return format(self.ip, '0%db' % l)
 
     def hex(self):
         '''
@@ -159,12 +331,10 @@ class IP(object):
         '''
         Show IANA allocation information for the current IP address.
         '''
-        b = self.bin()
-        l = self.v == 4 and 32 or 128
-        for i in range(len(b), 0, -1):
-            if self._range[self.v].has_key(b[:i]):
-                return self._range[self.v][b[:i]]
-        return 'UNKNOWN'
+        match = _range_trie.match_int(self.ip, self.v)
+        if match is None:
+            return 'UNKNOWN'
+        return match[1]
  
     def _dqtoi(self, dq):
         '''
@@ -223,12 +393,13 @@ class IP(object):
         # IPv4
         if '.' in dq:
             q = dq.split('.')
-            if len(q) > 4:
-                raise ValueError, "%r: IPv4 address invalid: more than 4 bytes" % dq
+            if len(q) != 4:
+                raise ValueError, "%r: IPv4 address invalid: expected 4 bytes" % dq
             for x in q:
-                if 0 > int(x) > 255:
+                if not x.isdigit() or int(x) > 255:
                     raise ValueError, "%r: IPv4 address invalid: bytes should be between 0 and 255" % dq
             self.v = 4
+            # Bytes are always decimal, leading zeros or not
             return long(q[0])<<24 | long(q[1])<<16 | long(q[2])<<8 | long(q[3])
     
         raise ValueError, "Invalid address input"
@@ -238,7 +409,7 @@ class IP(object):
         Convert long to dotquad or hextet.
         '''
         if self.v == 4:
-            return '.'.join(map(str, [(n>>24) & 0xff, (n>>16) & 0xff, (n>>8) & 0xff, n & 0xff]))
+            return int_to_ip(n & 0xffffffff)
         else:
             n = '%032x' % n
             return ':'.join(n[4*x:4*x+4] for x in xrange(0, 8))
@@ -298,22 +469,34 @@ class IP(object):
 class Network(IP):
     '''
     Network slice calculations.
+
+    Derived addresses are calculated once and cached, so a Network should
+    not be modified after it is created.
     '''
 
+    __slots__ = ('_mask_int', '_netmask', '_network', '_broadcast')
+
+    def __init__(self, ip, mask=None, version=0):
+        IP.__init__(self, ip, mask, version)
+        l = self.v == 4 and 32 or 128
+        self._mask_int = ((1L << l) - 1) >> (l - self.mask) << (l - self.mask)
+        self._netmask = self._network = self._broadcast = None
+
     def netmask(self):
         '''
         Network netmask derived from subnet size.
         '''
-        if self.version() == 4:
-            return IP((0xffffffffL >> (32-self.mask)) << (32-self.mask), version=self.version())
-        else:
-            return IP((0xffffffffffffffffffffffffffffffffL >> (128-self.mask)) << (128-self.mask), version=self.version())
+        if self._netmask is None:
+            self._netmask = IP(self._mask_int, version=self.version())
+        return self._netmask
 
     def network(self):
         '''
         Network address.
         '''
-        return IP(self.ip & long(self.netmask()), version=self.version())
+        if self._network is None:
+            self._network = IP(self.ip & self._mask_int, version=self.version())
+        return self._network
     
     def broadcast(self):
         '''
@@ -321,10 +504,10 @@ class Network(IP):
         '''
         # XXX: IPv6 doesn't have a broadcast address, but it's used for other 
         #      calculations such as <Network.host_last>.
-        if self.version() == 4:
-            return IP(long(self.network()) | (0xffffffff - long(self.netmask())), version=self.version())
-        else:
-            return IP(long(self.network()) | (0xffffffffffffffffffffffffffffffffL - long(self.netmask())), version=self.version())
+        if self._broadcast is None:
+            last = (self.ip & self._mask_int) + self.size() - 1
+            self._broadcast = IP(last, version=self.version())
+        return self._broadcast
 
     def host_first(self):
         '''
@@ -344,20 +527,33 @@ class Network(IP):
 
     def in_network(self, other):
         '''
-        Check if the given IP address is within this network.
+        Check if the given IP address (or network) is within this network.
+
+        >>> Network('192.0.2.42/24').in_network('192.0.2.1')
+        True
+        >>> Network('192.0.2.0/24').in_network('192.0.2.128/25')
+        True
         '''
-        other = Network(other)
-        return long(other) >= long(self) and long(other) < long(self) + self.size() - other.size() + 1
+        if not isinstance(other, IP):
+            other = IP(other)
+        size = 2 ** ((other.v == 4 and 32 or 128) - other.mask)
+        first = self.ip & self._mask_int
+        return first <= other.ip and other.ip + size <= first + self.size()
 
     def __contains__(self, ip):
         '''
-        Check if the given ip is part of the network.
+        Check if the given ip is part of the network. Integers are compared
+        directly, without creating an IP object.
 
         >>> '192.0.2.42' in Network('192.0.2.0/24')
         True
         >>> '192.168.2.42' in Network('192.0.2.0/24')
         False
+        >>> 3221225985 in Network('192.0.2.0/24')
+        True
         '''
+        if type(ip) in (types.IntType, types.LongType):
+            return 0 <= ip - (self.ip & self._mask_int) < self.size()
         return self.in_network(ip)
 
     def __lt__(self, other):
@@ -383,9 +579,68 @@ class Network(IP):
         192.168.114.2
         192.168.114.3
         '''
-        #for ip in [IP(long(self)+x) for x in xrange(0, self.size())]:
-        for ip in [IP(long(self.network())+x) for x in xrange(0, self.size())]:
-            yield ip
+        v = self.version()
+        for n in self.iter_range():
+            yield IP(n, version=v)
+
+    def __getitem__(self, index):
+        '''
+        Address at an offset within the network, without iterating to it.
+        Slices return a generator of addresses.
+
+        >>> str(Network('192.168.114.0/24')[10])
+        '192.168.114.10'
+        >>> str(Network('192.168.114.0/24')[-1])
+        '192.168.114.255'
+        >>> [str(ip) for ip in Network('192.168.114.0/24')[4:8:2]]
+        ['192.168.114.4', '192.168.114.6']
+        '''
+        v = self.version()
+        size = self.size()
+        if isinstance(index, slice):
+            if index.step is not None and index.step < 0:
+                raise ValueError, "Negative slice steps are not supported"
+            start, stop = index.start, index.stop
+            if start is None:
+                start = 0
+            elif start < 0:
+                start = max(start + size, 0)
+            if stop is None or stop > size:
+                stop = size
+            elif stop < 0:
+                stop = max(stop + size, 0)
+            return (IP(n, version=v) for n in
+                    self.iter_range(start, stop, index.step or 1))
+        if index < 0:
+            index += size
+        if index < 0 or index >= size:
+            raise IndexError, "Network index out of range"
+        return IP(self.ip & self._mask_int | index, version=v)
+
+    def iter_range(self, start=0, stop=None, step=1):
+        '''
+        Lazily generate the integer addresses at offsets start to stop
+        (exclusive) within the network.
+
+        >>> ints_to_ips(Network('192.168.114.0/30').iter_range(1, 3))
+        ['192.168.114.1', '192.168.114.2']
+        '''
+        if stop is None or stop > self.size():
+            stop = self.size()
+        network = self.ip & self._mask_int
+        return _count(network + start, network + stop, step)
+
+    def iter_hosts(self):
+        '''
+        Lazily generate the integer addresses usable by hosts, that is all
+        but the network and broadcast addresses (/31 and /32 have none).
+
+        >>> ints_to_ips(Network('192.168.114.0/30').iter_hosts())
+        ['192.168.114.1', '192.168.114.2']
+        '''
+        if self.size() <= 2:
+            return self.iter_range()
+        return self.iter_range(1, self.size() - 1)
 
     def has_key(self, ip):
         '''
@@ -405,6 +660,14 @@ class Network(IP):
         '''
         return 2 ** ((self.version() == 4 and 32 or 128) - self.mask)
 
+# IP._range as a trie, for IP.info()
+_range_trie = PrefixTrie()
+for _v, _ranges in IP._range.items():
+    for _prefix, _name in _ranges.items():
+        _l = PrefixTrie._bits[_v]
+        _range_trie.add(long(_prefix, 2) << (_l - len(_prefix)), len(_prefix),
+                        _name, _v)
+
 if __name__ == '__main__':
     tests = [
         ('192.168.114.42', 23, ['192.168.0.1', '192.168.114.128', '10.0.0.1']),
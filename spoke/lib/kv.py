@@ -1,8 +1,13 @@
 """Provides Key-Value store access and management.
 
 Classes:
+SpokeKVConn - Redis server connection backed by a shared connection pool.
 SpokeKV - extends redis with several convenience classes.
 
+Functions:
+setup - instantiate (once only) and return the shared Redis connection.
+reset - disconnect and discard the shared Redis connection.
+
 Exceptions:
 RedisError - raised on failed Redis actions.
 """
@@ -32,27 +37,87 @@ def setup():
         kvLDAP = SpokeKVConn()  
     return kvLDAP
 
+def reset():
+    """Disconnect the shared connection pool; the next setup() rebuilds it."""
+    global kvLDAP
+    if kvLDAP is not None:
+        kvLDAP.pool.disconnect()
+    kvLDAP = None
+
 class SpokeKVConn:
     
     """Class representing Redis server connection."""
     
     def __init__(self):
-        """Bind to Redis server, return an redis connection object."""
+        """Bind to Redis server, return an redis connection object.
+        
+        All SpokeKV instances in a process share one connection pool, so a
+        long running process (e.g. a salt minion) keeps its connections
+        warm between requests. kv_min_connections are opened up front."""
         self.config = config.setup()
         self.log = logging.getLogger(__name__)
-        self.kv_host = self.config.get('KV', 'kv_host')
-        self.kv_port = int(self.config.get('KV', 'kv_port', 6379))
+        self.kv_unix_socket = self.config.get('KV', 'kv_unix_socket', False)
+        if self.kv_unix_socket:
+            self.kv_host = self.kv_unix_socket
+            self.kv_port = None
+        else:
+            self.kv_host = self.config.get('KV', 'kv_host')
+            self.kv_port = int(self.config.get('KV', 'kv_port', 6379))
         self.kv_db = self.config.get('KV', 'kv_db', '0')
+        self.kv_max_connections = int(self.config.get('KV', 
+                                                'kv_max_connections', 16))
+        self.kv_min_connections = int(self.config.get('KV', 
+                                                'kv_min_connections', 0))
+        self.kv_pool_timeout = int(self.config.get('KV', 'kv_pool_timeout', 20))
+        self.kv_socket_timeout = self.config.get('KV', 'kv_socket_timeout',
+                                                 False)
+        self.kv_socket_keepalive = self.config.get('KV', 'kv_socket_keepalive',
+                                                   'yes')
+        self.kv_health_check_interval = int(self.config.get('KV', 
+                                            'kv_health_check_interval', 0))
+        pool_args = {'db': self.kv_db,
+                     'max_connections': self.kv_max_connections,
+                     'timeout': self.kv_pool_timeout}
+        if self.kv_unix_socket:
+            pool_args['connection_class'] = redis.UnixDomainSocketConnection
+            pool_args['path'] = self.kv_unix_socket
+        else:
+            pool_args['host'] = self.kv_host
+            pool_args['port'] = self.kv_port
+            pool_args['socket_keepalive'] = self.kv_socket_keepalive == 'yes'
+        if self.kv_socket_timeout:
+            pool_args['socket_timeout'] = float(self.kv_socket_timeout)
+        if self.kv_health_check_interval:
+            # Only understood by redis-py 3.3 and later
+            pool_args['health_check_interval'] = self.kv_health_check_interval
         try:
-            self.KV = redis.StrictRedis(host=self.kv_host, port=self.kv_port,
-                                         db=self.kv_db)
+            # Callers wait for a free connection rather than fail when the
+            # pool is exhausted.
+            self.pool = redis.BlockingConnectionPool(**pool_args)
+            self.KV = redis.StrictRedis(connection_pool=self.pool)
             # We have to query something to know if the connection is good
-            self.KV.keys()
+            self.KV.ping()
+            self._warm(self.kv_min_connections)
         except redis.exceptions.ConnectionError:
             msg = 'Connection to Redis server %s:%s as %s failed' % \
                 (self.kv_host, self.kv_port, self.kv_db)
             trace = traceback.format_exc()
             raise error.RedisError(msg, trace)
+        self.log.debug('Connected to Redis server %s:%s (pool of %s)' % 
+                       (self.kv_host, self.kv_port, self.kv_max_connections))
+
+    def _warm(self, number):
+        """Open number connections and return them to the pool."""
+        number = min(number, self.kv_max_connections)
+        connections = []
+        try:
+            for i in range(number):
+                connection = self.pool.get_connection('PING')
+                connection.connect()
+                connections.append(connection)
+        finally:
+            for connection in connections:
+                self.pool.release(connection)
 
 class SpokeKV:
     
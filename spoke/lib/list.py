@@ -55,8 +55,8 @@ class SpokeMailingList(SpokeLDAP):
         
     def _get_org(self, org_name):
         """Retrieve our org object."""
-        org = SpokeOrg()
-        result = org.get(org_name)
+        result = self._resolve('org', org_name,
+                               lambda: SpokeOrg().get(org_name))
         if result['data'] == []:
             msg = "Can't find org %s" % org_name
             raise error.NotFound(msg)          
@@ -171,8 +171,8 @@ class SpokeMailingListMember(SpokeLDAP):
         return list_address
     
     def _get_list(self, org_name, list_address):
-        list = SpokeMailingList(org_name)
-        result = list.get(list_address)
+        result = self._resolve('list', (org_name, list_address),
+                lambda: SpokeMailingList(org_name).get(list_address))
         if result['data'] == []:
             msg = "Can't find mailing list %s in %s" % (list_address, org_name)
             self.log.error(msg)
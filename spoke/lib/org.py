@@ -13,7 +13,15 @@ import logging
 # own modules
 import spoke.lib.error as error
 import spoke.lib.config as config
-from spoke.lib.directory import SpokeLDAP
+from spoke.lib.directory import SpokeLDAP, NO_ATTRS
+
+def _child_entry(container_attr, container_class, org_dn, child_name):
+    """Return the dn and dn_info of an org child container."""
+    dn = '%s=%s,%s' % (container_attr, child_name, org_dn)
+    dn_attr = { 'objectClass': ['top', container_class],
+                   container_attr: [child_name] }
+    dn_info = [(k, v) for (k, v) in dn_attr.items()]
+    return (dn, dn_info)
 
 class SpokeOrg(SpokeLDAP):
     
@@ -37,9 +45,16 @@ class SpokeOrg(SpokeLDAP):
                                 'org_def_children', 'people,groups,dns,hosts')
         self.org_children = self.org_def_children.split(',')
         self.org_suffix_attr = self.config.get('ATTR_MAP', 'org_suffix', 'aenetAccountSuffix')
+        # All an org holds, and all that modify and the org lookups need
+        self.projection = ['objectClass', self.org_attr, self.org_suffix_attr]
             
     def create(self, org_name, org_children=None, suffix=None):
-        """Create organisation (+containers); return organisation object."""
+        """Create organisation (+containers); return organisation object.
+        
+        The org and its containers are created together: if any of them
+        fails, the error raised names each one that failed and none are
+        left behind (without LDAP transactions, those created are deleted
+        again)."""
         dn = self.org_attr + '=' + org_name + ',' + self.base_dn
         if org_children is None:
             org_children = self.org_children
@@ -53,12 +68,16 @@ class SpokeOrg(SpokeLDAP):
         dn_info = [(k, v) for (k, v) in dn_attr.items()] 
         msg = 'Creating %s with attributes %s' % (dn, dn_info)
         self.log.debug(msg)
-        result = self._create_object(dn, dn_info)         
-        # Add any children
+        # The org and its children go as one unit, in a transaction where
+        # the server supports them
+        children = []
         for child_name in org_children:
-            child = SpokeOrgChild(org_name)
-            child.create(child_name)
-        filter = '%s=%s' % (self.org_attr, org_name)
+            children.append(('add', 'create') + 
+                            _child_entry(self.container_attr, 
+                                         self.container_class, dn, child_name))
+        results = self._write_unit([[('add', 'create', dn, dn_info)], 
+                                    children])
+        result = results[0]
         self.log.debug('Result: %s' % result)
         return result
     
@@ -104,24 +123,29 @@ class SpokeOrg(SpokeLDAP):
         self._modify_attributes(dn, new_attrs, old_attrs)
         
     def delete(self, org_name, org_children=None):
-        """Delete an organisation; return True."""
+        """Delete an organisation; return True.
+        
+        Without LDAP transactions a failure may leave the delete partial:
+        containers already deleted are not restored."""
         if org_children is None:
             org_children = self.org_children
-        # First delete any children
-        for child_name in org_children:
-            child = SpokeOrgChild(org_name)
-            try:
-                child.delete(child_name)
-            except error.NotFound:
-                pass          
-        # Now delete the parent org
         dn = self.org_attr + '=' + org_name + ',' + self.base_dn
+        # One search finds which of the children are there to delete
+        filter = '(|%s)' % ''.join(['(%s=%s)' % (self.container_attr, name)
+                                    for name in org_children])
+        children = []
+        if org_children:
+            found = self._get_object(dn, 1, filter, NO_ATTRS)['data']
+            children = [('delete', 'delete', child_dn, None) 
+                        for (child_dn, attrs) in found]
         msg = 'Deleting %s' % dn
         self.log.debug(msg)
-        result = self._delete_object(dn)
+        results = self._write_unit([children, 
+                                    [('delete', 'delete', dn, None)]])
+        result = results[-1]
         self.log.debug('Result: %s' % result)
         return result
-    
+        
 class SpokeOrgChild(SpokeLDAP):
     
     """Provide CRUD methods to LDAP organisation child container objects."""
@@ -143,11 +167,12 @@ class SpokeOrgChild(SpokeLDAP):
         self.container_attr = self.config.get('ATTR_MAP', 'container_attr', 'ou')
         self.container_class = self.config.get('ATTR_MAP', \
                                         'container_class', 'organizationalUnit')
+        self.projection = ['objectClass', self.container_attr]
             
     def _get_org(self, org_name):
         """Retrieve our org object."""
-        org = SpokeOrg()
-        result = org.get(org_name)
+        result = self._resolve('org', org_name,
+                               lambda: SpokeOrg().get(org_name))
         if result == []:
             msg = "Can't find org %s" % org_name
             self.log.error(msg)
@@ -155,11 +180,9 @@ class SpokeOrgChild(SpokeLDAP):
         return result
 
     def create(self, child_name):
-        org_dn = self.org_dn
-        dn = self.container_attr + '=' + child_name + ',' + org_dn
-        dn_attr = { 'objectClass': ['top', self.container_class],
-                       self.container_attr: [child_name] }
-        dn_info = [(k, v) for (k, v) in dn_attr.items()]
+        (dn, dn_info) = _child_entry(self.container_attr, 
+                                     self.container_class, self.org_dn, 
+                                     child_name)
         msg = 'Creating %s with attributes %s' % (dn, dn_info)
         self.log.debug(msg)
         result = self._create_object(dn, dn_info)
@@ -44,8 +44,8 @@ class SpokeUser(SpokeLDAP):
         
     def _get_org(self, org_name):
         """Retrieve our org object."""
-        org = SpokeOrg()
-        result = org.get(org_name)
+        result = self._resolve('org', org_name,
+                               lambda: SpokeOrg().get(org_name))
         if result['data'] == []:
             msg = "Can't find org %s" % org_name
             self.log.error(msg)
@@ -106,6 +106,11 @@ class SpokeUser(SpokeLDAP):
         self.log.debug('Result: %s' % result)
         return result
             
+    def iter_users(self):
+        """Yield every user account in the org, a page at a time."""
+        filter = '%s=*' % self.user_key
+        return self._iter_objects(self.org_dn, self.search_scope, filter)
+            
     def delete(self, first, last=None):
         """Delete a user account; return True."""
         self._gen_user_info(first, last)
@@ -44,8 +44,8 @@ class SpokeSVN(SpokeLDAP):
         
     def _get_user(self, org_name, user_id):
         """Retrieve a user object."""
-        user = SpokeUser(org_name)
-        result = user.get(user_id, unique=True)
+        result = self._resolve('user', (org_name, user_id),
+                lambda: SpokeUser(org_name).get(user_id, unique=True))
         if result['data'] == []:
             msg = "Can't find user %s with org %s" % (user_id, org_name)
             self.log.error(msg)
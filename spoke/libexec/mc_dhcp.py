@@ -35,15 +35,15 @@ if __name__ == '__main__':
             ip = request['data']['ip']
             try:
                 mc.info('Creating host %s' % hostname)
-                host.create(hostname)
+                mc.data = host.create_host(hostname, mac, ip)
             except error.AlreadyExists:
                 mc.info('Host %s already exists' % hostname)
-            mc.info('Adding DHCP attributes for host %s' % hostname)
-            attr = SpokeDHCPAttr(server, group, hostname)
-            attr.create("dhcpHWAddress", "ethernet %s" % mac )
-            attr.create("dhcpStatements", "fixed-address %s" %ip )
-            attr.create("dhcpOption", "host-name \"%s\"" %hostname )
-            mc.data = host.get(hostname)
+                mc.info('Adding DHCP attributes for host %s' % hostname)
+                attr = SpokeDHCPAttr(server, group, hostname)
+                attr.create("dhcpHWAddress", "ethernet %s" % mac )
+                attr.create("dhcpStatements", "fixed-address %s" %ip )
+                attr.create("dhcpOption", "host-name \"%s\"" %hostname )
+                mc.data = host.get(hostname)
         except error.SpokeError, e:
             mc.fail(e.msg, e.exit_code)
     elif request['action'] == 'search':
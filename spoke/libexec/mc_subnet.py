@@ -15,8 +15,11 @@ if __name__ == '__main__':
     mc = mc.MCollectiveAction()
     log = logger.setup('main', verbose=False, quiet=True)
     request = mc.request()
-    network = request['data']['network']
-    mask = request['data']['mask']
+    try:
+        network = request['data']['network']
+        mask = request['data']['mask']
+    except KeyError:
+        (network, mask) = (None, None) # Stats on all subnets
     try:
         dc = request['data']['dc']
     except KeyError:
@@ -29,14 +32,37 @@ if __name__ == '__main__':
         ip = request['data']['ip']
     except KeyError:
         ip = None
+    try:
+        policy = request['data']['policy']
+    except KeyError:
+        policy = None
+    try:
+        prefix = request['data']['prefix']
+    except KeyError:
+        prefix = None
     if request['action'] == 'search':
         try:
             mc.data = SpokeSubnet(network, mask, dc).get()['data']
         except Exception as e:
             mc.fail(e.msg, e.exit_code)
+    elif request['action'] == 'stats':
+        try:
+            mc.data = SpokeSubnet(network, mask, dc).stats()['data']
+        except Exception as e:
+            mc.fail(e.msg, e.exit_code)
     elif request['action'] == 'reserve':
         try:
-            mc.data = SpokeSubnet(network, mask, dc).modify(reserve=qty)['data']
+            subnet = SpokeSubnet(network, mask, dc, policy)
+            mc.data = subnet.modify(reserve=qty)['data']
+        except Exception as e:
+            mc.fail(e.msg, e.exit_code)
+    elif request['action'] == 'reserve_block':
+        try:
+            subnet = SpokeSubnet(network, mask, dc)
+            if prefix is not None:
+                mc.data = subnet.reserve_block(prefix=prefix)['data']
+            else:
+                mc.data = subnet.reserve_block(number=qty)['data']
         except Exception as e:
             mc.fail(e.msg, e.exit_code)
     elif request['action'] == 'release':
@@ -74,14 +74,13 @@ def reservation_create(host_name, mac, ip, dhcp_server=None, dhcp_group=None):
         from spoke.lib.dhcp import SpokeDHCPAttr
         host = SpokeDHCPHost(dhcp_server, dhcp_group)
         try:
-            host.create(host_name)
+            result = host.create_host(host_name, mac, ip)
         except error.AlreadyExists:
-            pass
-        attr = SpokeDHCPAttr(dhcp_server, dhcp_group, host_name)
-        attr.create("dhcpHWAddress", "ethernet %s" % mac)
-        attr.create("dhcpStatements", "fixed-address %s" % ip)
-        attr.create("dhcpOption", "host-name \"%s\"" % host_name)
-        result = host.get(host_name)
+            attr = SpokeDHCPAttr(dhcp_server, dhcp_group, host_name)
+            attr.create("dhcpHWAddress", "ethernet %s" % mac)
+            attr.create("dhcpStatements", "fixed-address %s" % ip)
+            attr.create("dhcpOption", "host-name \"%s\"" % host_name)
+            result = host.get(host_name)
     except error.SpokeError as e:
         result = common.handle_error(e)
     return result
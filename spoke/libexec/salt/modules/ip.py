@@ -14,6 +14,7 @@ try:
     import spoke.lib.error as error
     import spoke.lib.config as config
     import spoke.lib.common as common
+    import spoke.lib.kv as kv
     from spoke.lib.ip import SpokeSubnet
     has_ip = True
 except (ImportError, error.SpokeError) as e:
@@ -32,6 +33,20 @@ def __virtual__():
     return False
 
 
+def __init__(opts):
+    '''
+    Open the shared Redis connection pool when the minion loads the module,
+    so jobs run in the minion process reuse its warm connections
+    '''
+    if not has_ip or not opts.get('SPOKE.config'):
+        return
+    try:
+        _spoke_config(opts['SPOKE.config'])
+        kv.setup()
+    except (SaltInvocationError, error.SpokeError) as e:
+        log.debug('Redis connection pool not opened at load: {0}'.format(e))
+
+
 def _salt_config(name):
     value = __opts__['SPOKE.{0}'.format(name)]
     if not value:
@@ -59,6 +74,16 @@ def search(network, mask):
     return result
 
 
+def stats(network=None, mask=None):
+    try:
+        conf = _spoke_config(_salt_config('config'))
+        subnet = SpokeSubnet(ip=network, mask=mask, dc=None)
+        result = subnet.stats()
+    except error.SpokeError as e:
+        result = common.handle_error(e)
+    return result
+
+
 def create(network, mask):
     try:
         conf = _spoke_config(_salt_config('config'))
@@ -79,16 +104,26 @@ def delete(network, mask):
     return result
 
 
-def reserve(network, mask, qty):
+def reserve(network, mask, qty, policy=None):
     try:
         conf = _spoke_config(_salt_config('config'))
-        subnet = SpokeSubnet(ip=network, mask=mask, dc=None)
+        subnet = SpokeSubnet(ip=network, mask=mask, dc=None, policy=policy)
         result = subnet.modify(release=None, reserve=qty)
     except error.SpokeError as e:
         result = common.handle_error(e)
     return result
 
 
+def reserve_block(network, mask, qty=None, prefix=None):
+    try:
+        conf = _spoke_config(_salt_config('config'))
+        subnet = SpokeSubnet(ip=network, mask=mask, dc=None)
+        result = subnet.reserve_block(number=qty, prefix=prefix)
+    except error.SpokeError as e:
+        result = common.handle_error(e)
+    return result
+
+
 def release(network, mask, ip):
     try:
         conf = _spoke_config(_salt_config('config'))
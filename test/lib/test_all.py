@@ -9,6 +9,8 @@ import test_dns
 import test_email
 import test_host
 import test_ip
+import test_ip_helper
+import test_kv
 import test_list
 import test_logger
 import test_org
@@ -29,6 +31,8 @@ if __name__ == '__main__':
                             test_loader.loadTestsFromModule(test_user),
                             
                             test_loader.loadTestsFromModule(test_org),
+                            test_loader.loadTestsFromModule(test_ip_helper),
+                            test_loader.loadTestsFromModule(test_kv),
                             test_loader.loadTestsFromModule(test_logger),
                             test_loader.loadTestsFromModule(test_config)
                             ])
@@ -2,7 +2,11 @@
 TODO match tests to full results object instead of just result['data']
 TODO match delete tests to results object instead of True/False."""
 # core modules
+import os
+import shutil
+import tempfile
 import unittest
+import StringIO
 # own modules
 import spoke.lib.error as error
 import spoke.lib.config as config
@@ -13,6 +17,8 @@ from spoke.lib.dhcp import SpokeDHCPSubnet
 from spoke.lib.dhcp import SpokeDHCPGroup
 from spoke.lib.dhcp import SpokeDHCPHost
 from spoke.lib.dhcp import SpokeDHCPAttr
+from spoke.lib.dhcp import SpokeDHCPConf
+from spoke.lib.dhcp import read_hosts
 
 class SpokeDHCPTest(unittest.TestCase):
     
@@ -101,6 +107,13 @@ class SpokeDHCPTest(unittest.TestCase):
         self.assertEqual(result, expected_result)
         dhcp.delete(dhcp_server)
         
+    def test_get_dhcp_server_projection(self):
+        """Fetch DHCP server; return only the attributes server lookups
+        use."""
+        dhcp = SpokeDHCPServer()
+        result = dhcp.get(self.dhcp_server)['data'][0][1]
+        self.assertEqual(sorted(result), sorted(dhcp.projection))
+        
     def test_get_missing_dhcp_server(self):
         """Fetch missing DHCP server; return empty list."""
         dhcp_server = 'testgetmissing.dhcp.server.local'
@@ -463,6 +476,47 @@ class SpokeDHCPTest(unittest.TestCase):
         host = SpokeDHCPHost(self.dhcp_server, self.dhcp_group)
         self.assertRaises(error.InputError, host.create, dhcp_host)
         
+    def test_create_dhcp_host_with_reservation(self):
+        """Create DHCP host with MAC, IP and hostname; return results object."""
+        dhcp_host = 'testcreatehostres'
+        mac = '02:00:00:38:00:00'
+        ip = '10.0.0.1'
+        host = SpokeDHCPHost(self.dhcp_server, self.dhcp_group)
+        result = host.create_host(dhcp_host, mac, ip)['data']
+        service_name = self.dhcp_server + self.dhcp_conf_suffix
+        group_base_dn = 'cn=%s,cn=%s,%s' % (self.dhcp_group, service_name,
+                                            self.base_dn)
+        dn = 'cn=%s,%s' % (dhcp_host, group_base_dn)
+        dn_info = {'objectClass': ['top', self.dhcp_host_class,
+                                   self.dhcp_options_class],
+                   'cn': [dhcp_host],
+                   'dhcpHWAddress': ['ethernet %s' % mac],
+                   'dhcpStatements': ['fixed-address %s' % ip],
+                   'dhcpOption': ['host-name "%s"' % dhcp_host]}
+        expected_result = [(dn, dn_info)]
+        self.assertEqual(result, expected_result)
+        host.delete(dhcp_host)
+
+    def test_create_dhcp_host_with_invalid_mac(self):
+        """Create DHCP host with an invalid MAC; raise InputError."""
+        host = SpokeDHCPHost(self.dhcp_server, self.dhcp_group)
+        self.assertRaises(error.InputError, host.create_host,
+                          'testinvalidmachost', '02:00:00:38', '10.0.0.1')
+
+    def test_create_dhcp_hosts_from_csv(self):
+        """Create DHCP hosts from CSV; return a result or error per host."""
+        hosts = StringIO.StringIO('testimporthost1,02:00:00:38:00:01,10.0.0.1\n'
+                                  'testimporthost2,invalid,10.0.0.2\n'
+                                  'testimporthost1,02:00:00:38:00:01,10.0.0.1\n')
+        host = SpokeDHCPHost(self.dhcp_server, self.dhcp_group)
+        results = list(host.create_hosts(read_hosts(hosts)))
+        self.assertEqual([name for (name, result) in results],
+                ['testimporthost1', 'testimporthost2', 'testimporthost1'])
+        self.assertEqual(results[0][1]['count'], 1)
+        self.assertTrue(isinstance(results[1][1], error.InputError))
+        self.assertTrue(isinstance(results[2][1], error.AlreadyExists))
+        host.delete('testimporthost1')
+
     def test_get_dhcp_host(self):
         """Fetch DHCP host; return True."""
         dhcp_host = 'testgethost'
@@ -480,6 +534,19 @@ class SpokeDHCPTest(unittest.TestCase):
         self.assertEqual(result, expected_result)
         host.delete(dhcp_host)
         
+    def test_get_dhcp_host_with_reservation(self):
+        """Fetch a DHCP host with a reservation; return the MAC and IP
+        statements the MCollective agent reads."""
+        dhcp_host = 'testgetreservation'
+        mac = '00:11:22:33:44:55'
+        ip = '10.0.0.5'
+        host = SpokeDHCPHost(self.dhcp_server, self.dhcp_group)
+        host.create_host(dhcp_host, mac, ip)
+        attrs = host.get(dhcp_host)['data'][0][1]
+        self.assertEqual(attrs[self.dhcp_mac_attr][0].split()[1], mac)
+        self.assertEqual(attrs['dhcpStatements'][0].split()[1], ip)
+        host.delete(dhcp_host)
+        
     def test_get_missing_dhcp_host(self):
         """Fetch missing DHCP host; return empty list."""
         dhcp_host = 'testgetmissinghost'
@@ -721,3 +788,53 @@ class SpokeDHCPTest(unittest.TestCase):
         dhcp_host = 'missinghost'
         self.assertRaises(error.NotFound, SpokeDHCPAttr, 
                           self.dhcp_server, self.dhcp_group, dhcp_host)
+
+    def test_export_dhcp_conf(self):
+        """Export DHCP service; write dhcpd.conf and a fragment for the
+        group, including one for its host."""
+        conf_dir = tempfile.mkdtemp()
+        conf = SpokeDHCPConf(self.dhcp_server, conf_dir)
+        result = conf.export()
+        group_file = os.path.join(conf_dir, 'group-%s.conf' % self.dhcp_group)
+        host_file = os.path.join(conf_dir, 'group-%s.host-%s.conf' % 
+                                 (self.dhcp_group, self.dhcp_host))
+        expected_result = [os.path.join(conf_dir, 'dhcpd.conf'), group_file,
+                           host_file]
+        self.assertEqual(result['data'], expected_result)
+        self.assertTrue('include "%s";' % group_file in
+                        open(expected_result[0]).read())
+        self.assertTrue('include "%s";' % host_file in open(group_file).read())
+        self.assertTrue('host %s {' % self.dhcp_host in 
+                        open(host_file).read())
+        shutil.rmtree(conf_dir)
+
+    def test_export_unchanged_dhcp_conf(self):
+        """Export DHCP service twice; rewrite only the changed host's
+        fragment."""
+        conf_dir = tempfile.mkdtemp()
+        conf = SpokeDHCPConf(self.dhcp_server, conf_dir)
+        conf.export()
+        self.assertEqual(conf.export()['data'], [])
+        dhcp_option = 'domain-name "acme.local"'
+        attr = SpokeDHCPAttr(self.dhcp_server, self.dhcp_group, self.dhcp_host)
+        attr.create(self.dhcp_option_attr, dhcp_option)
+        host_file = os.path.join(conf_dir, 'group-%s.host-%s.conf' % 
+                                 (self.dhcp_group, self.dhcp_host))
+        self.assertEqual(conf.export()['data'], [host_file])
+        shutil.rmtree(conf_dir)
+
+    def test_export_deleted_host(self):
+        """Export DHCP service after deleting a host; remove its fragment
+        and rewrite its group's."""
+        conf_dir = tempfile.mkdtemp()
+        conf = SpokeDHCPConf(self.dhcp_server, conf_dir)
+        conf.export()
+        host = SpokeDHCPHost(self.dhcp_server, self.dhcp_group)
+        host.delete(self.dhcp_host)
+        group_file = os.path.join(conf_dir, 'group-%s.conf' % self.dhcp_group)
+        host_file = os.path.join(conf_dir, 'group-%s.host-%s.conf' % 
+                                 (self.dhcp_group, self.dhcp_host))
+        self.assertEqual(conf.export()['data'], [group_file, host_file])
+        self.assertFalse(os.path.exists(host_file))
+        host.create(self.dhcp_host)
+        shutil.rmtree(conf_dir)
@@ -139,6 +139,17 @@ class SpokeDNSTest(unittest.TestCase):
         expected_result = [(dn, dn_info)]
         self.assertEqual(result, expected_result)
         
+    def test_get_dns_zone_with_records(self):
+        """Retrieve a DNS zone holding NS records; return the records as
+        well as the zone attributes."""
+        ns0 = 'ns0.aethernet.local'
+        ns = SpokeDNSNS(self.org_name, self.dns_zone_name)
+        ns.create('NS', ns0)
+        zone = SpokeDNSZone(self.org_name, self.dns_zone_name)
+        result = zone.get()['data'][0][1]
+        self.assertEqual(result['zoneName'], [self.dns_zone_name])
+        self.assertEqual(result[self.dns_ns_attr], [ns0 + '.'])
+        
     def test_get_missing_dns_zone(self):
         """Retrieve a missing DNS zone; return empty list."""
         dns_zone = 'testgetmissing.dhcp.server.local'
@@ -149,6 +149,20 @@ class SpokeEmailTest(unittest.TestCase):
         result = acc.get(self.email_addr)['data']
         self.assertEqual(result, expected_result)
         
+    def test_get_user_with_email_account(self):
+        """Retrieve a user with an email account; return the attributes
+        an email account lookup checks."""
+        user = SpokeUser(self.org_name)
+        result = user.get(self.first, self.last)['data'][0][1]
+        for object_class in [self.imap_class, self.smtp_class]:
+            self.assertTrue(object_class in result['objectClass'])
+        for attr in [self.imap_mailbox, self.imap_domain, self.imap_enable,
+                     self.imap_partition, self.smtp_destination, 
+                     self.smtp_enable, self.smtp_pri_address]:
+            self.assertTrue(attr in result)
+        acc = SpokeEmailAccount(self.org_name, self.user_id)
+        self.assertEqual(acc.get(self.email_addr)['count'], 1)
+        
     def test_get_missing_email_account(self):
         """Retrieve a missing email account; return empty list."""
         acc = SpokeEmailAccount(self.org_name, self.user_id)
@@ -149,6 +149,16 @@ class SpokeHostTest(unittest.TestCase):
         expected_data = [1]
         self.assertEquals(result['data'], expected_data)
 
+    def test_next_free_uuid_projection(self):
+        """Look up the next free uuid entry; return only its classes and
+        the uuid attribute."""
+        next_uuid_class = self.config.get('UUID', 'next_uuid_class')
+        next_uuid = SpokeHostUUID()
+        attrs = next_uuid.next_uuid_attrs
+        self.assertTrue(next_uuid_class in attrs['objectClass'])
+        self.assertEqual(attrs[self.next_uuid_attr], [str(self.next_uuid_start)])
+        self.assertEqual(sorted(attrs), sorted(next_uuid.projection))
+
     def test_increment_and_get_multiple_next_free_uuid(self):
         """Get next 4 free uuids; return uuids as list of integers."""
         next_uuid = SpokeHostUUID()
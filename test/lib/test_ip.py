@@ -5,7 +5,7 @@ import unittest
 import spoke.lib.error as error
 import spoke.lib.config as config
 import spoke.lib.log as logger
-from spoke.lib.ip import SpokeSubnet
+from spoke.lib.ip import SpokeSubnet, SpokeSubnet6, SpokeSubnetLocator
 
 class SpokeIPTest(unittest.TestCase):
 
@@ -24,10 +24,13 @@ class SpokeIPTest(unittest.TestCase):
         self.ip_ldap_key = self.config.get('IP', 'ip_ldap_key')
         
     def setUp(self): 
+        # Tests switch pool mode; tearDown puts it back even if they fail
+        self.ip_pool_mode = self.config.get('IP', 'ip_pool_mode', 'set')
         sub = SpokeSubnet(self.subnet, self.mask)
         sub.create()
 
     def tearDown(self):
+        self.config.set('IP', 'ip_pool_mode', self.ip_pool_mode)
         sub = SpokeSubnet(self.subnet, self.mask)
         sub.delete()
     
@@ -168,11 +171,11 @@ class SpokeIPTest(unittest.TestCase):
         subnet = '172.16.2.1'
         network = '172.16.2.0'
         mask = '30'
-        expected_result = [(network, {'free': [1], 'aloc': [2]})]
+        expected_result = [(network, {'free': [1], 'aloc': [1]})]
         sub = SpokeSubnet(subnet, mask)
         sub.create()
         sub.modify(reserve=2)
-        result = sub.modify(release='172.16.1.2')['data']
+        result = sub.modify(release='172.16.2.2')['data']
         self.assertEqual(result, expected_result)
         sub.delete()
     
@@ -183,6 +186,476 @@ class SpokeIPTest(unittest.TestCase):
         sub = SpokeSubnet(ip, mask)
         sub.create()
         sub.modify(reserve=2)
-        sub.modify(release='172.16.1.2')
-        self.assertTrue(sub.modify(release='172.16.1.2'))
+        sub.modify(release='172.16.2.2')
+        self.assertTrue(sub.modify(release='172.16.2.2'))
+        sub.delete()
+
+    def test_create_bitmap_subnet(self):
+        """Create a subnet in bitmap mode; return results object."""
+        self.config.set('IP', 'ip_pool_mode', 'bitmap')
+        subnet = '10.0.0.0'
+        mask = 30
+        expected_result = [(subnet, {'aloc': [0], 'free': [2]})]
+        sub = SpokeSubnet(subnet, mask)
+        result = sub.create()['data']
+        self.assertEqual(result, expected_result)
+        sub.delete()
+
+    def test_create_large_bitmap_subnet(self):
+        """Create a /8 subnet in bitmap mode; return results object."""
+        self.config.set('IP', 'ip_pool_mode', 'bitmap')
+        subnet = '10.0.0.0'
+        mask = 8
+        expected_result = [(subnet, {'aloc': [0], 'free': [16777214]})]
+        sub = SpokeSubnet(subnet, mask)
+        result = sub.create()['data']
+        self.assertEqual(result, expected_result)
+        sub.delete()
+
+    def test_create_bitmap_subnet_with_aloc_ips(self):
+        """Create a bitmap subnet with allocated ips; verify free/aloc."""
+        self.config.set('IP', 'ip_pool_mode', 'bitmap')
+        subnet = '10.0.0.0'
+        mask = 29
+        aloc_ips = ['10.0.0.1', '10.0.0.2', '192.168.0.1']
+        expected_result = [(subnet, {'aloc': [2], 'free': [4]})]
+        sub = SpokeSubnet(subnet, mask)
+        result = sub.create(aloc_ips)['data']
+        self.assertEqual(result, expected_result)
+        sub.delete()
+
+    def test_reserve_release_bitmap_ip(self):
+        """Reserve then release an ip from a bitmap subnet; verify free/aloc."""
+        self.config.set('IP', 'ip_pool_mode', 'bitmap')
+        subnet = '10.0.0.0'
+        mask = 30
+        expected_result = [(subnet, {'free': [2], 'aloc': [0]})]
+        sub = SpokeSubnet(subnet, mask)
+        sub.create()
+        offer = sub.modify(reserve=2)['data']
+        self.assertEqual(sorted(offer), ['10.0.0.1', '10.0.0.2'])
+        self.assertRaises(error.InsufficientResource, sub.modify, reserve=1)
+        sub.modify(release='10.0.0.1')
+        result = sub.modify(release='10.0.0.2')['data']
+        self.assertEqual(result, expected_result)
+        sub.delete()
+
+    def test_release_bitmap_ip_outside_subnet(self):
+        """Release an ip outside a bitmap subnet; raise InputError."""
+        self.config.set('IP', 'ip_pool_mode', 'bitmap')
+        subnet = '10.0.0.0'
+        mask = 30
+        sub = SpokeSubnet(subnet, mask)
+        sub.create()
+        self.assertRaises(error.InputError, sub.modify, release='10.0.1.1')
+        sub.delete()
+
+    def test_release_reserved_or_outside_set_ip(self):
+        """Release network, broadcast or outside ips from a set subnet;
+        raise InputError and leave the subnet untouched."""
+        subnet = '10.0.0.0'
+        mask = 30
+        expected_result = [(subnet, {'free': [2], 'aloc': [0]})]
+        sub = SpokeSubnet(subnet, mask)
+        sub.create()
+        for ip in ['10.0.0.0', '10.0.0.3', '10.0.1.1']:
+            self.assertRaises(error.InputError, sub.modify, release=ip)
+        self.assertEqual(sub.get()['data'], expected_result)
+        sub.delete()
+
+    def test_release_reserved_or_outside_bitmap_ip(self):
+        """Release network, broadcast or outside ips from a bitmap subnet;
+        raise InputError and leave the subnet untouched."""
+        self.config.set('IP', 'ip_pool_mode', 'bitmap')
+        subnet = '10.0.0.0'
+        mask = 30
+        expected_result = [(subnet, {'free': [2], 'aloc': [0]})]
+        sub = SpokeSubnet(subnet, mask)
+        sub.create()
+        for ip in ['10.0.0.0', '10.0.0.3', '10.0.1.1']:
+            self.assertRaises(error.InputError, sub.modify, release=ip)
+        self.assertEqual(sub.get()['data'], expected_result)
+        sub.delete()
+
+    def test_create_point_to_point_subnet(self):
+        """Create /31 subnets in both modes; both addresses are free."""
+        subnet = '10.0.0.0'
+        mask = 31
+        expected_result = [(subnet, {'aloc': [0], 'free': [2]})]
+        for mode in ['set', 'bitmap']:
+            self.config.set('IP', 'ip_pool_mode', mode)
+            sub = SpokeSubnet(subnet, mask)
+            result = sub.create()['data']
+            self.assertEqual(result, expected_result)
+            sub.modify(reserve=1)
+            sub.modify(release='10.0.0.0')
+            sub.delete()
+
+    def test_bulk_reserve_ips_from_subnet(self):
+        """Reserve many ips in one call; return unique ips and verify aloc."""
+        ip = '172.16.6.0'
+        mask = '24'
+        expected_result = [(ip, {'free': [54], 'aloc': [200]})]
+        sub = SpokeSubnet(ip, mask)
+        sub.create()
+        offer = sub.modify(reserve=200)['data']
+        self.assertEqual(len(set(offer)), 200)
+        result = sub.get()['data']
+        self.assertEqual(result, expected_result)
+        sub.delete()
+
+    def test_bulk_reserve_is_all_or_nothing(self):
+        """Reserve more ips than are free; raise and leave subnet untouched."""
+        ip = '172.16.7.0'
+        mask = '29'
+        expected_result = [(ip, {'free': [6], 'aloc': [0]})]
+        sub = SpokeSubnet(ip, mask)
+        sub.create()
+        self.assertRaises(error.InsufficientResource, sub.modify, reserve=7)
+        result = sub.get()['data']
+        self.assertEqual(result, expected_result)
+        sub.delete()
+
+    def test_create_subnet_reports_progress(self):
+        """Create a /16 subnet with a progress callback; verify final count."""
+        ip = '10.20.0.0'
+        mask = 16
+        reports = []
+        def progress(written, total):
+            reports.append((written, total))
+        sub = SpokeSubnet(ip, mask)
+        sub.create(progress=progress)
+        self.assertEqual(reports[-1], (65534, 65534))
+        sub.delete()
+
+    def test_reserve_lowest_free_ips(self):
+        """Reserve ips with the lowest policy; return lowest free ips."""
+        self.config.set('IP', 'ip_pool_mode', 'bitmap')
+        ip = '10.0.0.0'
+        mask = 28
+        expected_result = ['10.0.0.1', '10.0.0.3', '10.0.0.4']
+        sub = SpokeSubnet(ip, mask, policy='lowest')
+        sub.create(['10.0.0.2'])
+        result = sub.modify(reserve=3)['data']
+        self.assertEqual(result, expected_result)
+        sub.delete()
+
+    def test_reserve_next_fit_ips(self):
+        """Reserve ips with the next-fit policy; continue from last offer."""
+        self.config.set('IP', 'ip_pool_mode', 'bitmap')
+        ip = '10.0.0.0'
+        mask = 28
+        sub = SpokeSubnet(ip, mask, policy='next-fit')
+        sub.create()
+        sub.modify(reserve=2)
+        sub.modify(release='10.0.0.1')
+        result = sub.modify(reserve=1)['data']
+        self.assertEqual(result, ['10.0.0.3'])
+        sub.delete()
+
+    def test_lowest_policy_with_set_pool(self):
+        """Create a subnet object with the lowest or next-fit policy in set
+        pool mode; raise InputError before any subnet is created."""
+        self.config.set('IP', 'ip_pool_mode', 'set')
+        for policy in ['lowest', 'next-fit']:
+            self.assertRaises(error.InputError, SpokeSubnet, '10.0.0.0', 28,
+                              None, policy)
+        self.assertEqual(SpokeSubnet('10.0.0.0', 28).get()['data'], [])
+
+    def test_reserve_lowest_from_set_pool(self):
+        """Reserve ips with the lowest policy from a subnet created as a set;
+        raise InputError."""
+        ip = '10.0.0.0'
+        mask = 28
+        sub = SpokeSubnet(ip, mask)
+        sub.create()
+        self.config.set('IP', 'ip_pool_mode', 'bitmap')
+        sub = SpokeSubnet(ip, mask, policy='lowest')
+        self.assertRaises(error.InputError, sub.modify, reserve=1)
+        sub.delete()
+
+    def test_invalid_allocation_policy(self):
+        """Create a subnet object with unknown policy; raise InputError."""
+        self.assertRaises(error.InputError, SpokeSubnet, '10.0.0.0', 28,
+                          None, 'best-fit')
+
+    def test_sync_subnet_from_ldap(self):
+        """Sync a subnet from LDAP; store the LDAP high water mark."""
+        ip = '10.0.0.0'
+        mask = 28
+        sub = SpokeSubnet(ip, mask)
+        sub.create()
+        result = sub.sync()
+        self.assertEqual(result['exit_code'], 0)
+        sub.delete()
+
+    def test_sync_missing_subnet(self):
+        """Sync a subnet which does not exist; raise NotFound."""
+        ip = '10.0.0.0'
+        mask = 28
+        sub = SpokeSubnet(ip, mask)
+        self.assertRaises(error.NotFound, sub.sync)
+
+    def test_get_all_subnets(self):
+        """Get all subnets; return registered subnets with ip counts."""
+        ip = '10.0.0.0'
+        mask = 30
+        dc = 'dc1'
+        sub = SpokeSubnet(ip, mask, dc)
+        sub.create()
+        sub.modify(reserve=1)
+        expected_result = (dc + ip, {'free': [1], 'aloc': [1], 'mask': [30],
+                                     'dc': [dc]})
+        result = SpokeSubnet().get()['data']
+        self.assertTrue(expected_result in result)
+        sub.modify(release='10.0.0.1')
+        sub.modify(release='10.0.0.2')
+        expected_result[1]['free'] = [2]
+        expected_result[1]['aloc'] = [0]
+        self.assertTrue(expected_result in SpokeSubnet().get()['data'])
+        sub.delete()
+        result = SpokeSubnet().get()['data']
+        self.assertFalse(expected_result in result)
+
+    def test_get_subnet_stats(self):
+        """Get subnet stats; return free runs and aligned free blocks."""
+        ip = '10.0.0.0'
+        mask = 28
+        for mode in ['set', 'bitmap']:
+            self.config.set('IP', 'ip_pool_mode', mode)
+            sub = SpokeSubnet(ip, mask)
+            sub.create(['10.0.0.4'])
+            (name, result) = sub.stats()['data'][0]
+            self.assertEqual(result['free'], [13])
+            self.assertEqual(result['free_runs'], [2])
+            self.assertEqual(result['largest_free_run'], [10])
+            self.assertEqual(result['free_blocks'], [{'/32': 3, '/31': 3,
+                                                      '/30': 1}])
+            sub.delete()
+
+    def test_get_subnet_utilisation(self):
+        """Get stats of empty and half used /30s; count usable hosts only."""
+        ip = '10.0.0.0'
+        mask = 30
+        for mode in ['set', 'bitmap']:
+            self.config.set('IP', 'ip_pool_mode', mode)
+            sub = SpokeSubnet(ip, mask)
+            sub.create()
+            result = sub.stats()['data'][0][1]
+            self.assertEqual(result['utilisation'], [0.0])
+            self.assertEqual(result['size'], [4])
+            sub.modify(reserve=1)
+            result = sub.stats()['data'][0][1]
+            self.assertEqual(result['utilisation'], [50.0])
+            sub.delete()
+
+    def test_reserve_block_of_ips(self):
+        """Reserve consecutive and aligned blocks; return contiguous ips."""
+        ip = '10.0.0.0'
+        mask = 26
+        for mode in ['set', 'bitmap']:
+            self.config.set('IP', 'ip_pool_mode', mode)
+            sub = SpokeSubnet(ip, mask)
+            sub.create(['10.0.0.3'])
+            result = sub.reserve_block(prefix=29)['data']
+            self.assertEqual(result, ['10.0.0.%s' % i for i in range(8, 16)])
+            result = sub.reserve_block(number=4)['data']
+            self.assertEqual(result, ['10.0.0.%s' % i for i in range(4, 8)])
+            self.assertRaises(error.InsufficientResource, sub.reserve_block,
+                              number=63)
+            self.assertEqual(sub.get()['data'][0][1]['aloc'], [13])
+            sub.delete()
+
+    def test_reserve_block_with_invalid_size(self):
+        """Reserve a block with a non numeric prefix or number; raise
+        InputError."""
+        ip = '10.0.0.0'
+        mask = 26
+        sub = SpokeSubnet(ip, mask)
+        sub.create()
+        self.assertRaises(error.InputError, sub.reserve_block, prefix='abc')
+        self.assertRaises(error.InputError, sub.reserve_block, prefix='28.5')
+        self.assertRaises(error.InputError, sub.reserve_block, number='x')
+        self.assertRaises(error.InputError, sub.modify, reserve='x')
+        self.assertEqual(sub.get()['data'][0][1]['aloc'], [0])
+        sub.delete()
+
+    def test_locate_ip_in_most_specific_subnet(self):
+        """Locate an ip in nested subnets; return the longest prefix match."""
+        outer = SpokeSubnet('10.0.0.0', 16)
+        outer.create()
+        inner = SpokeSubnet('10.0.4.0', 24, 'dc1')
+        inner.create()
+        locator = SpokeSubnetLocator()
+        result = locator.get('10.0.4.20')['data']
+        self.assertEqual(result, [('dc110.0.4.0', {'network': ['10.0.4.0'],
+                                   'mask': [24], 'source': ['kv'],
+                                   'dc': ['dc1']})])
+        result = locator.get('10.0.5.20')['data']
+        self.assertEqual(result[0][0], '10.0.0.0')
+        self.assertEqual(locator.get('10.1.0.1')['count'], 0)
+        inner.delete()
+        outer.delete()
+
+    def test_locate_ipv6_address(self):
+        """Locate an IPv6 address; return the IPv6 subnet holding it."""
+        sub = SpokeSubnet6('2001:db8::', 64, 'dc1')
+        sub.create()
+        v4 = SpokeSubnet('10.0.0.0', 24)
+        v4.create()
+        locator = SpokeSubnetLocator()
+        result = locator.get('2001:db8::20')['data']
+        self.assertEqual([name for (name, attrs) in result], [sub.kv_name])
+        self.assertEqual(result[0][1]['mask'], [64])
+        self.assertEqual(result[0][1]['dc'], ['dc1'])
+        self.assertEqual(locator.get('2001:db9::1')['count'], 0)
+        # 10.0.0.0/24 and ::a00:0/120 have the same bits; keep them apart
+        self.assertEqual(locator.get('::a00:1')['count'], 0)
+        v4.delete()
+        sub.delete()
+
+    def test_get_all_subnets_with_ipv6(self):
+        """Get all subnets; return IPv6 subnets alongside IPv4 ones."""
+        sub = SpokeSubnet('10.0.0.0', 30)
+        sub.create()
+        sub6 = SpokeSubnet6('2001:db8::', 64)
+        sub6.create()
+        result = SpokeSubnet().get()['data']
+        names = [name for (name, attrs) in result]
+        self.assertTrue('10.0.0.0' in names)
+        self.assertTrue(sub6.kv_name in names)
+        sub6.delete()
+        sub.delete()
+
+    def test_create_overlapping_subnet(self):
+        """Create subnets inside and around an existing one; raise error."""
+        sub = SpokeSubnet('10.0.0.0', 24)
+        sub.create()
+        self.assertRaises(error.AlreadyExists,
+                          SpokeSubnet('10.0.0.128', 25).create)
+        self.assertRaises(error.AlreadyExists,
+                          SpokeSubnet('10.0.0.0', 16).create)
+        other = SpokeSubnet('10.0.1.0', 24)
+        other.create()
+        other.delete()
+        sub.delete()
+
+    def test_create_subnet_twice(self):
+        """Create a subnet twice, the second while the first is still
+        claiming it; raise SpokeError and leave the first claim alone."""
+        sub = SpokeSubnet('10.0.0.0', 24)
+        self.assertRaises(error.SpokeError, 
+                          SpokeSubnet(self.subnet, self.mask).create)
+        sub._claim_range() # A create in progress, yet to populate its pool
+        self.assertRaises(error.SpokeError, SpokeSubnet('10.0.0.0', 24).create)
+        self.assertNotEqual(sub.KV.zscore(sub.kv_ranges, sub.kv_range), None)
+        sub.KV.zrem(sub.kv_ranges, sub.kv_range)
+
+    def test_get_subnet_is_read_only(self):
+        """Get a subnet stored without a registry entry; leave it out of
+        the registry and range index."""
+        legacy = SpokeSubnet('10.0.5.0', 24)
+        legacy.KV.sadd(legacy.kv_free, '10.0.5.1')
+        self.assertEqual(legacy.get()['data'][0][1]['free'], [1])
+        self.assertFalse(legacy.KV.hexists(legacy.kv_index, legacy.kv_field))
+        self.assertEqual(legacy.KV.zscore(legacy.kv_ranges, legacy.kv_range),
+                         None)
+        legacy.delete()
+
+    def test_register_subnet_created_before_range_index(self):
+        """Register subnets stored without a range index entry; register
+        those which do not overlap an indexed subnet, else raise
+        AlreadyExists."""
+        sub = SpokeSubnet('10.0.0.0', 24)
+        sub.create()
+        overlapping = SpokeSubnet('10.0.0.128', 25)
+        overlapping.KV.sadd(overlapping.kv_free, '10.0.0.129')
+        legacy = SpokeSubnet('10.0.5.0', 24)
+        legacy.KV.sadd(legacy.kv_free, '10.0.5.1')
+        self.assertRaises(error.AlreadyExists, overlapping.register)
+        self.assertEqual(legacy.register()['data'][0][1]['free'], [1])
+        names = [name for (name, attrs) in SpokeSubnet().get()['data']]
+        self.assertFalse('10.0.0.128' in names)
+        self.assertTrue('10.0.5.0' in names)
+        result = SpokeSubnetLocator().get('10.0.0.129')['data']
+        self.assertEqual([name for (name, attrs) in result], ['10.0.0.0'])
+        self.assertRaises(error.AlreadyExists,
+                          SpokeSubnet('10.0.5.0', 25).create)
+        self.assertRaises(error.NotFound, SpokeSubnet('10.0.9.0', 24).register)
+        overlapping.delete()
+        legacy.delete()
+        sub.delete()
+
+    def test_reserve_ipv6_sequential(self):
+        """Reserve ips from an IPv6 /64; return consecutive addresses."""
+        sub = SpokeSubnet6('2001:db8::', 64)
+        sub.create(['2001:db8::2'])
+        result = sub.modify(reserve=2)['data']
+        self.assertEqual(result, ['2001:db8::1', '2001:db8::3'])
+        self.assertEqual(sub.get()['data'][0][1]['aloc'], [3])
+        sub.delete()
+
+    def test_reserve_ipv6_hashed(self):
+        """Reserve ips with the hashed scheme; return unique addresses."""
+        sub = SpokeSubnet6('2001:db8::', 64, scheme='hashed')
+        sub.create()
+        result = sub.modify(reserve=10)['data']
+        self.assertEqual(len(set(result)), 10)
+        sub.delete()
+
+    def test_delegate_ipv6_prefixes(self):
+        """Delegate prefixes from a /48; return /64 prefixes in order."""
+        sub = SpokeSubnet6('2001:db8::', 48, scheme='delegate')
+        sub.create()
+        result = sub.modify(reserve=2)['data']
+        self.assertEqual(result, ['2001:db8::/64', '2001:db8:0:1::/64'])
+        sub.modify(release='2001:db8::/64')
+        self.assertEqual(sub.get()['data'][0][1]['aloc'], [1])
+        sub.delete()
+
+    def test_reuse_released_ipv6_addresses(self):
+        """Fill an IPv6 subnet, release and reserve again; reuse the freed
+        addresses rather than raise InsufficientResource."""
+        sub = SpokeSubnet6('2001:db8::', 126)
+        sub.create()
+        result = sub.modify(reserve=3)['data']
+        self.assertEqual(result, ['2001:db8::1', '2001:db8::2', '2001:db8::3'])
+        self.assertRaises(error.InsufficientResource, sub.modify, reserve=1)
+        sub.modify(release='2001:db8::2')
+        self.assertRaises(error.InsufficientResource, sub.modify, reserve=2)
+        self.assertEqual(sub.modify(reserve=1)['data'], ['2001:db8::2'])
+        self.assertEqual(sub.get()['data'][0][1]['free'], [0])
+        sub.delete()
+
+    def test_reuse_released_ipv6_prefixes(self):
+        """Delegate every prefix, release two and delegate again; return
+        the released prefixes."""
+        sub = SpokeSubnet6('2001:db8::', 62, scheme='delegate')
+        sub.create()
+        sub.modify(reserve=4)
+        self.assertRaises(error.InsufficientResource, sub.modify, reserve=1)
+        sub.modify(release='2001:db8::/64')
+        sub.modify(release='2001:db8:0:2::/64')
+        result = sub.modify(reserve=2)['data']
+        self.assertEqual(sorted(result), ['2001:db8:0:2::/64', 
+                                          '2001:db8::/64'])
+        sub.delete()
+
+    def test_reserve_whole_small_hashed_ipv6_subnet(self):
+        """Reserve every address of a small hashed subnet; fall back to
+        scanning for the addresses hashing keeps missing."""
+        sub = SpokeSubnet6('2001:db8::', 125, scheme='hashed')
+        sub.create(['2001:db8::5'])
+        result = sub.modify(reserve=6)['data']
+        self.assertEqual(sorted(result), ['2001:db8::%s' % i 
+                                          for i in [1, 2, 3, 4, 6, 7]])
+        self.assertRaises(error.InsufficientResource, sub.modify, reserve=1)
+        sub.delete()
+
+    def test_create_overlapping_ipv6_subnet(self):
+        """Create an IPv6 subnet inside an existing one; raise error."""
+        sub = SpokeSubnet6('2001:db8::', 48)
+        sub.create()
+        self.assertRaises(error.AlreadyExists,
+                          SpokeSubnet6('2001:db8:0:1::', 64).create)
         sub.delete()
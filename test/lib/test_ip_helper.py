@@ -0,0 +1,128 @@
+"""Tests Spoke ip_helper.py module."""
+# core modules
+import unittest
+# own modules
+import spoke.lib.ip_helper as ip_helper
+
+class SpokeIPHelperTest(unittest.TestCase):
+
+    """A Class for testing the Spoke ip_helper.py module."""
+    
+    def test_ips_to_ints(self):
+        """Convert a list of dotted quads; return list of integers."""
+        ips = ['0.0.0.0', '10.0.0.1', '255.255.255.255']
+        expected_result = [0, 167772161, 4294967295]
+        self.assertEqual(ip_helper.ips_to_ints(ips), expected_result)
+
+    def test_ints_to_ips(self):
+        """Convert a list of integers; return list of dotted quads."""
+        ints = [0, 167772161, 4294967295]
+        expected_result = ['0.0.0.0', '10.0.0.1', '255.255.255.255']
+        self.assertEqual(ip_helper.ints_to_ips(ints), expected_result)
+
+    def test_empty_batch(self):
+        """Convert empty lists; return empty lists."""
+        self.assertEqual(ip_helper.ips_to_ints([]), [])
+        self.assertEqual(ip_helper.ints_to_ips([]), [])
+
+    def test_invalid_ipv4_address(self):
+        """Parse an IPv4 address with a byte over 255; raise ValueError."""
+        self.assertRaises(ValueError, ip_helper.IP, '10.0.0.256')
+
+    def test_ip_to_int_strict(self):
+        """Convert octal, hex and shorthand dotted quads; raise ValueError."""
+        for ip in ['192.168.010.1', '192.168.0x0a.1', '10.1', '10.0.0.1 ']:
+            self.assertRaises(ValueError, ip_helper.ip_to_int, ip)
+            self.assertRaises(ValueError, ip_helper.ips_to_ints, [ip])
+
+    def test_ipv4_leading_zero(self):
+        """Parse an IPv4 address with a leading zero byte; read it as
+        decimal."""
+        ip = ip_helper.IP('192.168.010.1')
+        self.assertEqual(long(ip), ip_helper.ip_to_int('192.168.10.1'))
+        self.assertTrue('192.168.10.5' in 
+                        ip_helper.Network('192.168.010.0/24'))
+
+    def test_ipv4_hex_and_shorthand(self):
+        """Parse hex and shorthand IPv4 bytes; raise ValueError."""
+        self.assertRaises(ValueError, ip_helper.IP, '192.168.0x0a.1')
+        self.assertRaises(ValueError, ip_helper.IP, '10.1')
+
+    def test_ipv4_info(self):
+        """Get IANA information for IPv4 addresses; return range names."""
+        self.assertEqual(ip_helper.IP('172.16.5.4').info(), 'PRIVATE RFC1918')
+        self.assertEqual(ip_helper.IP('224.0.0.5').info(), 'CLASS D LINKLOCAL')
+        self.assertEqual(ip_helper.IP('8.8.8.8').info(), 'UNKNOWN')
+
+    def test_ipv6_info(self):
+        """Get IANA information for IPv6 addresses; return range names."""
+        self.assertEqual(ip_helper.IP('::1').info(), 'LOOPBACK')
+        self.assertEqual(ip_helper.IP('fe80::1').info(), 'LINKLOCAL')
+
+    def test_bin(self):
+        """Get binary representation; return zero padded string."""
+        self.assertEqual(ip_helper.IP('10.0.0.1').bin(), 
+                         '00001010000000000000000000000001')
+        self.assertEqual(len(ip_helper.IP('::1').bin()), 128)
+
+    def test_network_iter_is_lazy(self):
+        """Iterate a /8 network; return first address without building it."""
+        first = iter(ip_helper.Network('10.0.0.0', 8)).next()
+        self.assertEqual(str(first), '10.0.0.0')
+
+    def test_network_iter_hosts(self):
+        """Iterate hosts; return all but network and broadcast addresses."""
+        net = ip_helper.Network('192.168.0.0', 29)
+        expected_result = ['192.168.0.%s' % i for i in range(1, 7)]
+        self.assertEqual(ip_helper.ints_to_ips(net.iter_hosts()),
+                         expected_result)
+
+    def test_network_iter_range(self):
+        """Iterate a range of offsets; return addresses from the offset."""
+        net = ip_helper.Network('10.0.0.0', 16)
+        expected_result = ['10.0.1.0', '10.0.1.1']
+        self.assertEqual(ip_helper.ints_to_ips(net.iter_range(256, 258)),
+                         expected_result)
+
+    def test_network_getitem(self):
+        """Index and slice a network; return addresses at those offsets."""
+        net = ip_helper.Network('10.0.0.0', 16)
+        self.assertEqual(str(net[513]), '10.0.2.1')
+        self.assertEqual(str(net[-1]), '10.0.255.255')
+        self.assertEqual([str(ip) for ip in net[1:3]], ['10.0.0.1', '10.0.0.2'])
+        self.assertRaises(IndexError, net.__getitem__, 65536)
+
+    def test_network_derived_addresses_cached(self):
+        """Get network and broadcast twice; return the same objects."""
+        net = ip_helper.Network('10.1.2.3', 22)
+        self.assertEqual(str(net.network()), '10.1.0.0')
+        self.assertEqual(str(net.broadcast()), '10.1.3.255')
+        self.assertTrue(net.network() is net.network())
+        self.assertTrue(net.broadcast() is net.broadcast())
+
+    def test_network_contains_integer(self):
+        """Check integer membership; compare against the network address."""
+        net = ip_helper.Network('10.1.2.3', 22)
+        self.assertTrue(ip_helper.ip_to_int('10.1.0.1') in net)
+        self.assertFalse(ip_helper.ip_to_int('10.1.4.0') in net)
+        self.assertTrue('10.1.0.1' in net)
+
+    def test_ip_has_no_instance_dict(self):
+        """Set an unknown attribute on an IP; raise AttributeError."""
+        ip = ip_helper.IP('10.0.0.1')
+        self.assertRaises(AttributeError, setattr, ip, 'foo', 1)
+
+    def test_prefix_trie_longest_match(self):
+        """Match addresses against nested prefixes; return most specific."""
+        trie = ip_helper.PrefixTrie()
+        trie.insert('10.0.0.0/8', 'ten')
+        trie.insert('10.1.0.0/16', 'ten-one')
+        trie.insert('2001:db8::/32', 'doc')
+        self.assertEqual(trie.match('10.1.2.3'), (16, 'ten-one'))
+        self.assertEqual(trie.match('10.2.0.1'), (8, 'ten'))
+        self.assertEqual(trie.match('2001:db8::1'), (32, 'doc'))
+        self.assertEqual(trie.match('192.168.0.1'), None)
+        self.assertFalse('11.0.0.1' in trie)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+"""Tests Spoke kv.py module."""
+# core modules
+import unittest
+# own modules
+import spoke.lib.error as error
+import spoke.lib.config as config
+import spoke.lib.log as logger
+import spoke.lib.kv as kv
+from spoke.lib.kv import SpokeKV
+
+# 3rd party modules
+import redis
+
+class SpokeKVTest(unittest.TestCase):
+
+    """A Class for testing the Spoke kv.py module."""
+
+    def __init__(self, methodName):
+        """Setup config data."""
+        unittest.TestCase.__init__(self, methodName)
+        common_config = '../../contrib/spoke.conf'
+        custom_config = '/tmp/spoke.conf'
+        config_files = (common_config, custom_config)
+        self.config = config.setup(config_files)
+        self.log = logger.log_to_console()
+        self.options = ['kv_port', 'kv_max_connections', 'kv_min_connections',
+                        'kv_pool_timeout', 'kv_health_check_interval']
+
+    def setUp(self):
+        # Tests change pool options; tearDown puts them back even if they fail
+        self.saved = dict((option, self.config.get('KV', option, False))
+                          for option in self.options)
+        kv.reset()
+
+    def tearDown(self):
+        for (option, value) in self.saved.items():
+            if value is False:
+                self.config.remove_option('KV', option)
+            else:
+                self.config.set('KV', option, value)
+        kv.reset()
+
+    def test_setup_shares_pool(self):
+        """Setup twice and create SpokeKV objects; return one shared pool."""
+        conn = kv.setup()
+        self.assertTrue(kv.setup() is conn)
+        self.assertTrue(SpokeKV().KV.connection_pool is conn.pool)
+        self.assertTrue(SpokeKV().KV.connection_pool is conn.pool)
+
+    def test_pool_from_config(self):
+        """Setup with pool options; return a blocking pool built from them."""
+        self.config.set('KV', 'kv_max_connections', '4')
+        self.config.set('KV', 'kv_pool_timeout', '5')
+        conn = kv.setup()
+        self.assertTrue(isinstance(conn.pool, redis.BlockingConnectionPool))
+        self.assertEqual(conn.pool.max_connections, 4)
+        self.assertEqual(conn.pool.timeout, 5)
+
+    def test_warm_pool(self):
+        """Setup with kv_min_connections; open that many connections."""
+        self.config.set('KV', 'kv_min_connections', '3')
+        conn = kv.setup()
+        self.assertEqual(len(conn.pool._connections), 3)
+        for connection in conn.pool._connections:
+            self.assertTrue(connection._sock is not None)
+
+    def test_warm_pool_capped_at_max(self):
+        """Setup with more min than max connections; open max connections."""
+        self.config.set('KV', 'kv_max_connections', '2')
+        self.config.set('KV', 'kv_min_connections', '8')
+        conn = kv.setup()
+        self.assertEqual(len(conn.pool._connections), 2)
+
+    def test_health_check_interval(self):
+        """Setup with a health check interval; pass it to each connection."""
+        self.config.set('KV', 'kv_health_check_interval', '30')
+        conn = kv.setup()
+        connection = conn.pool.get_connection('PING')
+        try:
+            self.assertEqual(connection.health_check_interval, 30)
+        finally:
+            conn.pool.release(connection)
+        self.assertTrue(conn.KV.ping())
+
+    def test_reset(self):
+        """Reset the shared pool; disconnect it and build a new one."""
+        self.config.set('KV', 'kv_min_connections', '1')
+        conn = kv.setup()
+        connections = list(conn.pool._connections)
+        kv.reset()
+        self.assertTrue(kv.kvLDAP is None)
+        for connection in connections:
+            self.assertTrue(connection._sock is None)
+        self.assertFalse(kv.setup() is conn)
+        self.assertTrue(kv.setup().KV.ping())
+
+    def test_reset_without_setup(self):
+        """Reset before any setup; return quietly."""
+        kv.reset()
+        kv.reset()
+        self.assertTrue(kv.kvLDAP is None)
+
+    def test_connection_failure(self):
+        """Setup against a closed port; raise RedisError."""
+        self.config.set('KV', 'kv_port', '1')
+        self.assertRaises(error.RedisError, kv.setup)
+        self.assertTrue(kv.kvLDAP is None)
+
+if __name__ == "__main__":
+    unittest.main()
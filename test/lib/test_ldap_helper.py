@@ -1,11 +1,915 @@
 """Tests Spoke ldap.py module."""
 # core modules
+import copy
+import time
+import collections
+import fnmatch
 import unittest
+import threading
 # own modules
 import spoke.lib.error as error
 import spoke.lib.config as config
 import spoke.lib.log as logger
 import spoke.lib.directory as directory
+import spoke.lib.kv as kv
+
+# 3rd party modules
+import ldap
+import ldap.ldapobject
+import fakeredis
+
+class FakeControl(object):
+    
+    """Response control, as python-ldap decodes it."""
+    
+    def __init__(self, controlType, **kwargs):
+        self.controlType = controlType
+        self.__dict__.update(kwargs)
+
+class FakeLDAPObject(object):
+    
+    """Stand-in for ReconnectLDAPObject serving an in-memory directory.
+    
+    Entries are shared by every connection, as they would be on a server;
+    calls records the name of each operation run."""
+    
+    opened = [] # Every connection made, oldest first
+    extensions = [] # Root DSE supportedExtension
+    entries = collections.OrderedDict() # Lower cased dn -> (dn, attrs)
+    calls = []
+    attrlists = [] # Attribute list of each search
+    refuse_txn = False # Refuse Start Transaction though it is listed
+    txns = {} # Transaction id -> queued (msgid, op, dn, modlist)
+    
+    def __init__(self, uri, **kwargs):
+        self.uri = uri
+        self.alive = True
+        self.unbound = False
+        self.msgid = 0
+        self.results = {} # msgid -> result3 tuple or exception
+        self.cookies = set() # Paged search state is kept per connection
+        FakeLDAPObject.opened.append(self)
+        
+    def simple_bind_s(self, who, cred): pass
+    
+    def start_tls_s(self): pass
+    
+    def whoami_s(self):
+        if not self.alive:
+            raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+        return ''
+    
+    def unbind_s(self):
+        self.unbound = True
+        
+    def _parse(self, f, i):
+        """Parse the filter starting at f[i]; return (node, next index)."""
+        i += 1
+        if f[i] in '&|!':
+            (op, subs) = (f[i], [])
+            i += 1
+            while f[i] == '(':
+                (sub, i) = self._parse(f, i)
+                subs.append(sub)
+            return ((op, subs), i + 1)
+        j = f.index(')', i)
+        (attr, value) = f[i:j].split('=', 1)
+        return (('=', attr.lower(), value.lower()), j + 1)
+    
+    def _match(self, node, attrs):
+        """Return True if attrs match the parsed filter node."""
+        if node[0] == '&':
+            return all(self._match(sub, attrs) for sub in node[1])
+        if node[0] == '|':
+            return any(self._match(sub, attrs) for sub in node[1])
+        if node[0] == '!':
+            return not self._match(node[1][0], attrs)
+        values = [v.lower() for (k, vs) in attrs.items() if k.lower() == node[1]
+                  for v in vs]
+        return [v for v in values if fnmatch.fnmatchcase(v, node[2])] != []
+    
+    def _project(self, dn, attrs, attrlist):
+        """Return (dn, attrs) holding only the attributes in attrlist."""
+        if attrlist is None or '*' in attrlist:
+            return (dn, copy.deepcopy(attrs))
+        wanted = [attr.lower() for attr in attrlist]
+        return (dn, dict((k, list(v)) for (k, v) in attrs.items()
+                         if k.lower() in wanted))
+    
+    def _search(self, base, scope, filterstr, attrlist):
+        self.calls.append('search')
+        self.attrlists.append(attrlist)
+        if base == '':
+            return [('', {'supportedExtension': list(self.extensions)})]
+        base = base.lower()
+        if base not in self.entries:
+            raise ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+        if not filterstr.startswith('('):
+            filterstr = '(%s)' % filterstr
+        node = self._parse(filterstr, 0)[0]
+        found = []
+        for key in self.entries: # In the order added, as a server would
+            if scope == ldap.SCOPE_BASE and key != base:
+                continue
+            if scope == ldap.SCOPE_ONELEVEL and \
+                                    key.split(',', 1)[-1] != base:
+                continue
+            if key != base and not key.endswith(',' + base):
+                continue
+            (dn, attrs) = self.entries[key]
+            if self._match(node, attrs):
+                found.append(self._project(dn, attrs, attrlist))
+        return found
+    
+    def search_s(self, base, scope, filterstr='(objectClass=*)',
+                 attrlist=None, attrsonly=0):
+        return self._search(base, scope, filterstr, attrlist)
+    
+    def search_ext(self, base, scope, filterstr='(objectClass=*)',
+                   attrlist=None, attrsonly=0, serverctrls=None):
+        if not self.alive:
+            raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+        try:
+            found = self._search(base, scope, filterstr, attrlist)
+        except ldap.LDAPError, e:
+            return self._reply(e)
+        rctrls = []
+        for ctrl in serverctrls or []:
+            if ctrl.controlType != directory.SimplePagedResultsControl.controlType:
+                continue
+            if ctrl.cookie and ctrl.cookie not in self.cookies:
+                msg = {'desc': 'paged results cookie is invalid'}
+                return self._reply(ldap.UNWILLING_TO_PERFORM(msg))
+            start = int(ctrl.cookie or 0)
+            end = start + ctrl.size
+            cookie = ''
+            if end < len(found):
+                cookie = str(end)
+                self.cookies.add(cookie)
+            found = found[start:end]
+            rctrls.append(FakeControl(ctrl.controlType, size=0, cookie=cookie))
+        return self._reply((ldap.RES_SEARCH_RESULT, found, None, rctrls))
+    
+    def _values(self, values):
+        if values is None:
+            return []
+        if not isinstance(values, list):
+            return [values]
+        return list(values)
+    
+    def _apply(self, op, dn, modlist=None):
+        """Apply a write; return the entry before and after it."""
+        self.calls.append(op)
+        key = dn.lower()
+        before = self.entries.get(key)
+        if op == 'add':
+            if before is not None:
+                raise ldap.ALREADY_EXISTS({'desc': 'Already exists'})
+            if key.split(',', 1)[-1] not in self.entries:
+                raise ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+            attrs = dict((attr, self._values(values)) 
+                         for (attr, values) in modlist)
+            self.entries[key] = (dn, attrs)
+            return (None, (dn, copy.deepcopy(attrs)))
+        if before is None:
+            raise ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+        if op == 'delete':
+            for other in self.entries:
+                if other.endswith(',' + key):
+                    raise ldap.NOT_ALLOWED_ON_NONLEAF({'desc': 'Has children'})
+            del self.entries[key]
+            return (before, None)
+        attrs = copy.deepcopy(before[1])
+        for (mod, attr, values) in modlist:
+            values = self._values(values)
+            current = attrs.get(attr, [])
+            if mod == ldap.MOD_ADD:
+                for value in values:
+                    if value in current:
+                        raise ldap.TYPE_OR_VALUE_EXISTS({'desc': 'Exists'})
+                attrs[attr] = current + values
+            elif mod == ldap.MOD_DELETE:
+                if attr not in attrs:
+                    raise ldap.NO_SUCH_ATTRIBUTE({'desc': 'No such attribute'})
+                for value in values:
+                    if value not in current:
+                        raise ldap.NO_SUCH_ATTRIBUTE({'desc': 'No such value'})
+                attrs[attr] = [v for v in current if v not in values]
+                if not values or not attrs[attr]:
+                    del attrs[attr]
+            elif values:
+                attrs[attr] = values
+            else:
+                attrs.pop(attr, None)
+        self.entries[key] = (before[0], attrs)
+        return (before, (before[0], copy.deepcopy(attrs)))
+    
+    def add_s(self, dn, modlist):
+        self._apply('add', dn, modlist)
+        
+    def modify_s(self, dn, modlist):
+        self._apply('modify', dn, modlist)
+        
+    def delete_s(self, dn):
+        self._apply('delete', dn)
+        
+    def _reply(self, result):
+        self.msgid += 1
+        self.results[self.msgid] = result
+        return self.msgid
+    
+    def _write_ext(self, op, dn, modlist, serverctrls):
+        for ctrl in serverctrls or []:
+            if ctrl.controlType == directory.TXN_SPEC:
+                self.msgid += 1
+                self.txns[ctrl.encodedControlValue].append((self.msgid, op,
+                                                            dn, modlist))
+                return self.msgid
+        try:
+            (before, after) = self._apply(op, dn, modlist)
+        except ldap.LDAPError, e:
+            return self._reply(e)
+        rctrls = []
+        for ctrl in serverctrls or []:
+            if ctrl.controlType == directory.PreReadControl.controlType:
+                entry = self._project(before[0], before[1], ctrl.attrList)
+            elif ctrl.controlType == directory.PostReadControl.controlType:
+                entry = self._project(after[0], after[1], ctrl.attrList)
+            else:
+                continue
+            rctrls.append(FakeControl(ctrl.controlType, dn=entry[0],
+                                      entry=entry[1]))
+        rtype = {'add': ldap.RES_ADD, 'modify': ldap.RES_MODIFY,
+                 'delete': ldap.RES_DELETE}[op]
+        return self._reply((rtype, [], None, rctrls))
+    
+    def add_ext(self, dn, modlist, serverctrls=None):
+        return self._write_ext('add', dn, modlist, serverctrls)
+    
+    def modify_ext(self, dn, modlist, serverctrls=None):
+        return self._write_ext('modify', dn, modlist, serverctrls)
+    
+    def delete_ext(self, dn, serverctrls=None):
+        return self._write_ext('delete', dn, None, serverctrls)
+    
+    def extop_s(self, extreq):
+        """Start, commit or abort a transaction, all or nothing."""
+        self.calls.append('extop')
+        name = extreq.requestName
+        if name == directory.TXN_START:
+            if name not in self.extensions or self.refuse_txn:
+                raise ldap.UNWILLING_TO_PERFORM({'desc': 'No transactions'})
+            txn_id = 'txn%d' % (len(self.txns) + 1)
+            self.txns[txn_id] = []
+            return (None, txn_id)
+        if name != directory.TXN_END:
+            raise ldap.PROTOCOL_ERROR({'desc': 'Unknown operation'})
+        value = extreq.requestValue
+        txn_id = [txn_id for txn_id in self.txns if value.endswith(txn_id)][0]
+        queued = self.txns.pop(txn_id)
+        if '\x01\x01\x00' in value: # Abort
+            return (None, None)
+        snapshot = copy.deepcopy(FakeLDAPObject.entries)
+        for (msgid, op, dn, modlist) in queued:
+            try:
+                self._apply(op, dn, modlist)
+            except ldap.LDAPError, e:
+                FakeLDAPObject.entries = snapshot
+                self.results[msgid] = e
+                raise e.__class__({'desc': 'Transaction failed'})
+        for (msgid, op, dn, modlist) in queued:
+            rtype = {'add': ldap.RES_ADD, 'modify': ldap.RES_MODIFY,
+                     'delete': ldap.RES_DELETE}[op]
+            self.results[msgid] = (rtype, [], None, [])
+        return (None, None)
+    
+    def abandon(self, msgid):
+        self.results.pop(msgid, None)
+    
+    def result3(self, msgid, all=1, timeout=None):
+        if msgid not in self.results and timeout == 0:
+            raise ldap.TIMEOUT({'desc': 'Timed out'})
+        result = self.results.pop(msgid)
+        if isinstance(result, Exception):
+            raise result
+        (rtype, rdata, rmsgid, rctrls) = result
+        return (rtype, rdata, msgid, rctrls)
+
+class FakeLDAPTestCase(unittest.TestCase):
+    
+    """Base class for tests run against FakeLDAPObject connections."""
+    
+    def __init__(self, methodName):
+        """Setup config data."""
+        unittest.TestCase.__init__(self, methodName)
+        common_config = '../../contrib/spoke.conf'
+        custom_config = '/tmp/spoke.conf'
+        config_files = (common_config, custom_config)
+        self.config = config.setup(config_files)
+        self.log = logger.log_to_console()
+        self.base_dn = self.config.get('LDAP', 'basedn')
+        self.options = {'pool_size': '2', 'pool_timeout': '0.1',
+                        'check_interval': '60', 'thread_affinity': 'no',
+                        'write_verify': 'control'}
+        
+    def setUp(self):
+        # Tests tune the pool and fake its connections; tearDown undoes both
+        self.saved = dict((option, self.config.get('LDAP', option, False))
+                          for option in self.options)
+        for (option, value) in self.options.items():
+            self.config.set('LDAP', option, value)
+        self.reconnect = ldap.ldapobject.ReconnectLDAPObject
+        ldap.ldapobject.ReconnectLDAPObject = FakeLDAPObject
+        self.shared = (directory.hLDAP, directory.hDNCache)
+        directory.hLDAP = directory.hDNCache = None
+        FakeLDAPObject.opened = []
+        FakeLDAPObject.extensions = []
+        FakeLDAPObject.calls = []
+        FakeLDAPObject.attrlists = []
+        FakeLDAPObject.refuse_txn = False
+        FakeLDAPObject.txns = {}
+        FakeLDAPObject.entries = collections.OrderedDict()
+        self.add(self.base_dn, {'objectClass': ['top', 'organizationalUnit']})
+        
+    def tearDown(self):
+        ldap.ldapobject.ReconnectLDAPObject = self.reconnect
+        (directory.hLDAP, directory.hDNCache) = self.shared
+        for (option, value) in self.saved.items():
+            if value is False:
+                self.config.remove_option('LDAP', option)
+            else:
+                self.config.set('LDAP', option, value)
+                
+    def connect(self, write_verify='control'):
+        """Return a SpokeLDAP confirming writes by write_verify."""
+        self.config.set('LDAP', 'write_verify', write_verify)
+        directory.hLDAP = None # A fresh pool
+        return directory.SpokeLDAP()
+    
+    def add(self, dn, attrs):
+        """Put an entry straight into the fake directory."""
+        attrs = copy.deepcopy(attrs)
+        attrs.setdefault('objectClass', ['top'])
+        FakeLDAPObject.entries[dn.lower()] = (dn, attrs)
+        
+    def entry(self, dn):
+        """Return the attributes stored for dn, less objectClass, or None."""
+        entry = FakeLDAPObject.entries.get(dn.lower())
+        if entry is None:
+            return None
+        return dict((k, v) for (k, v) in entry[1].items() 
+                    if k != 'objectClass')
+
+class SpokeLDAPConnTest(FakeLDAPTestCase):
+    
+    """A class for testing the SpokeLDAPConn connection pool."""
+    
+    def idle(self, pool):
+        """Return the open connections waiting in pool."""
+        return [item[0] for item in pool.idle.queue if item is not None]
+    
+    def acquire_in_thread(self, pool):
+        """Acquire a connection from another thread and keep it."""
+        held = []
+        thread = threading.Thread(target=lambda: held.append(pool.acquire()))
+        thread.start()
+        thread.join()
+        return held[0]
+        
+    def test_acquire_from_exhausted_pool(self):
+        """Acquire more connections than the pool holds; raise SpokeLDAPError."""
+        pool = directory.SpokeLDAPConn()
+        first = self.acquire_in_thread(pool)
+        second = self.acquire_in_thread(pool)
+        self.assertFalse(first is second)
+        self.assertRaises(error.SpokeLDAPError, pool.acquire)
+        self.assertEqual(len(FakeLDAPObject.opened), 2)
+        
+    def test_acquire_twice_in_thread(self):
+        """Acquire again while holding a connection; lend the same one and
+        return it to the pool once both are released."""
+        self.config.set('LDAP', 'pool_size', '1')
+        pool = directory.SpokeLDAPConn()
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertTrue(first is second)
+        pool.release(second)
+        self.assertEqual(self.idle(pool), [])
+        pool.release(first)
+        self.assertEqual(self.idle(pool), [first])
+        
+    def test_thread_affinity(self):
+        """Release a connection with thread_affinity; keep it for the
+        thread until release_thread."""
+        self.config.set('LDAP', 'thread_affinity', 'yes')
+        pool = directory.SpokeLDAPConn()
+        conn = pool.acquire()
+        pool.release(conn)
+        self.assertFalse(conn in self.idle(pool))
+        self.assertTrue(pool.acquire() is conn)
+        pool.release(conn)
+        pool.release_thread()
+        self.assertTrue(conn in self.idle(pool))
+        
+    def test_run_under_load(self):
+        """Run from more threads than connections; share the pool safely."""
+        self.config.set('LDAP', 'pool_timeout', '5')
+        pool = directory.SpokeLDAPConn()
+        lock = threading.Lock()
+        busy = set()
+        seen = []
+        clashes = []
+        def work(conn):
+            with lock:
+                if conn in busy: # Lent out twice
+                    clashes.append(conn)
+                busy.add(conn)
+                seen.append(len(busy))
+            time.sleep(0.01)
+            with lock:
+                busy.remove(conn)
+            return conn
+        threads = [threading.Thread(target=pool.run, args=(work,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(seen), 8)
+        self.assertEqual(clashes, [])
+        self.assertTrue(max(seen) <= 2)
+        self.assertEqual(len(FakeLDAPObject.opened), 2)
+        self.assertEqual(len(self.idle(pool)), 2)
+        
+    def test_release_broken_connection(self):
+        """Release a broken connection; drop it and open a new one later."""
+        pool = directory.SpokeLDAPConn()
+        conn = pool.acquire()
+        pool.release(conn, broken=True)
+        self.assertFalse(conn in self.idle(pool))
+        self.assertFalse(pool.acquire() is conn)
+        
+    def test_release_broken_lent_connection(self):
+        """Drop a lent connection as broken; ignore its outer release."""
+        pool = directory.SpokeLDAPConn()
+        outer = pool.acquire()
+        inner = pool.acquire()
+        pool.release(inner, broken=True)
+        pool.release(outer)
+        self.assertEqual(self.idle(pool), [])
+        self.assertEqual(pool.idle.qsize(), 2)
+        
+    def test_acquire_dead_idle_connection(self):
+        """Acquire an idle connection the server dropped; replace it."""
+        self.config.set('LDAP', 'check_interval', '0')
+        pool = directory.SpokeLDAPConn()
+        conn = pool.acquire()
+        pool.release(conn)
+        conn.alive = False
+        time.sleep(0.01)
+        result = pool.acquire()
+        self.assertFalse(result is conn)
+        self.assertTrue(conn.unbound)
+        
+    def test_run_retries_server_down(self):
+        """Run an operation which loses the server once; retry it."""
+        pool = directory.SpokeLDAPConn()
+        calls = []
+        def operation(conn, value):
+            calls.append(conn)
+            if len(calls) == 1:
+                raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+            return value
+        self.assertEqual(pool.run(operation, 'done'), 'done')
+        self.assertEqual(len(calls), 2)
+        self.assertFalse(calls[0] is calls[1])
+        self.assertFalse(calls[0] in self.idle(pool))
+        self.assertTrue(calls[1] in self.idle(pool))
+        
+    def test_run_server_down_twice(self):
+        """Run an operation which loses the server twice; raise SERVER_DOWN."""
+        pool = directory.SpokeLDAPConn()
+        calls = []
+        def operation(conn):
+            calls.append(conn)
+            raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+        self.assertRaises(ldap.SERVER_DOWN, pool.run, operation)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.idle(pool), [])
+        self.assertEqual(pool.idle.qsize(), 2) # Both slots given back
+        
+    def test_run_returns_connection_on_error(self):
+        """Run an operation raising another error; keep the connection."""
+        pool = directory.SpokeLDAPConn()
+        def operation(conn):
+            raise ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+        self.assertRaises(ldap.NO_SUCH_OBJECT, pool.run, operation)
+        self.assertEqual(self.idle(pool), FakeLDAPObject.opened)
+        
+    def test_supports_extended_operation(self):
+        """Ask for offered and missing extended operations; read them once."""
+        FakeLDAPObject.extensions = [directory.TXN_START]
+        pool = directory.SpokeLDAPConn()
+        self.assertTrue(pool.supports(directory.TXN_START))
+        FakeLDAPObject.extensions = []
+        self.assertFalse(pool.supports('1.2.3.4'))
+        self.assertTrue(pool.supports(directory.TXN_START)) # Cached
+        
+class SpokeLDAPFakeTest(FakeLDAPTestCase):
+    
+    """A class for testing SpokeLDAP against an in-memory directory."""
+    
+    def setUp(self):
+        FakeLDAPTestCase.setUp(self)
+        self.dn = 'o=testSpokeLDAPFake,%s' % self.base_dn
+        self.dn_info = [('o', ['testSpokeLDAPFake']),
+                        ('objectClass', ['top', 'organization'])]
+        
+    def searches(self):
+        """Return the number of searches run since the last call."""
+        count = FakeLDAPObject.calls.count('search')
+        FakeLDAPObject.calls = []
+        return count
+    
+    def test_create_object_write_verify(self):
+        """Create an entry in each write_verify mode; return the entry."""
+        expected_result = [(self.dn, {'o': ['testSpokeLDAPFake'],
+                                     'objectClass': ['top', 'organization']})]
+        for (mode, searches) in [('none', 0), ('control', 0), ('search', 1)]:
+            ldap_helper = self.connect(mode)
+            self.searches()
+            result = ldap_helper._create_object(self.dn, self.dn_info)
+            self.assertEqual(result['data'], expected_result)
+            self.assertEqual(result['msg'], 'Created spoke.lib.directory:')
+            self.assertEqual(self.searches(), searches)
+            ldap_helper._delete_object(self.dn)
+            
+    def test_create_attribute_write_verify(self):
+        """Add an attribute value in each write_verify mode; return the
+        attribute as stored, or only the new value in none mode."""
+        for (mode, searches, values) in [('none', 0, ['b']),
+                                         ('control', 0, ['a', 'b']),
+                                         ('search', 1, ['a', 'b'])]:
+            self.add(self.dn, {'description': ['a']})
+            ldap_helper = self.connect(mode)
+            self.searches()
+            dn_info = [(ldap.MOD_ADD, 'description', 'b')]
+            result = ldap_helper._create_object(self.dn, dn_info)
+            self.assertEqual(result['data'], [(self.dn, 
+                                               {'description': values})])
+            self.assertEqual(self.searches(), searches)
+            self.assertEqual(self.entry(self.dn)['description'], ['a', 'b'])
+            
+    def test_create_existing_object(self):
+        """Create an entry twice in each write_verify mode; raise
+        AlreadyExists."""
+        for mode in directory.SpokeLDAP.verify_modes:
+            self.add(self.dn, {'o': ['testSpokeLDAPFake']})
+            ldap_helper = self.connect(mode)
+            self.assertRaises(error.AlreadyExists, ldap_helper._create_object,
+                              self.dn, self.dn_info)
+            
+    def test_delete_object_write_verify(self):
+        """Delete an entry in each write_verify mode; return empty results."""
+        for (mode, searches) in [('none', 0), ('control', 0), ('search', 1)]:
+            self.add(self.dn, {'o': ['testSpokeLDAPFake']})
+            ldap_helper = self.connect(mode)
+            self.searches()
+            result = ldap_helper._delete_object(self.dn)
+            self.assertEqual(result['data'], [])
+            self.assertEqual(result['msg'], 'Deleted spoke.lib.directory:')
+            self.assertEqual(self.searches(), searches)
+            self.assertEqual(self.entry(self.dn), None)
+            
+    def test_modify_attributes_write_verify(self):
+        """Modify an attribute in each write_verify mode; replace its
+        values, leave other attributes alone and return the new values."""
+        for (mode, searches) in [('none', 0), ('control', 0), ('search', 2)]:
+            self.add(self.dn, {'description': ['a', 'b'], 'mail': ['x']})
+            ldap_helper = self.connect(mode)
+            self.searches()
+            result = ldap_helper._modify_attributes(self.dn, 
+                                                    {'description': ['c']})
+            self.assertEqual(result['data'], [(self.dn, 
+                                               {'description': ['c']})])
+            self.assertEqual(self.searches(), searches)
+            self.assertEqual(self.entry(self.dn), {'description': ['c'],
+                                                   'mail': ['x']})
+            
+    def test_modify_attributes_keeps_and_removes_values(self):
+        """Modify with a single value, an unchanged value and an empty
+        value in each write_verify mode; store the same result as the
+        read-then-diff modify did."""
+        for mode in directory.SpokeLDAP.verify_modes:
+            self.add(self.dn, {'description': ['a', 'b'], 'mail': ['x'],
+                               'cn': ['y']})
+            ldap_helper = self.connect(mode)
+            result = ldap_helper._modify_attributes(self.dn, 
+                                {'description': 'c', 'mail': ['x'], 'cn': []})
+            self.assertEqual(result['data'], [(self.dn, {'description': ['c'],
+                                                         'mail': ['x']})])
+            self.assertEqual(self.entry(self.dn), {'description': ['c'],
+                                                   'mail': ['x']})
+            
+    def test_modify_attributes_with_old_attrs(self):
+        """Modify given the old values in each write_verify mode; remove
+        only the values dropped."""
+        for mode in directory.SpokeLDAP.verify_modes:
+            self.add(self.dn, {'description': ['a', 'b'], 'mail': ['x']})
+            ldap_helper = self.connect(mode)
+            ldap_helper._modify_attributes(self.dn, {'description': ['a']},
+                                           {'description': ['a', 'b']})
+            self.assertEqual(self.entry(self.dn), {'description': ['a'],
+                                                   'mail': ['x']})
+            
+    def test_modify_missing_object(self):
+        """Modify a missing entry in each write_verify mode; raise NotFound."""
+        for mode in directory.SpokeLDAP.verify_modes:
+            ldap_helper = self.connect(mode)
+            self.assertRaises(error.NotFound, ldap_helper._modify_attributes,
+                              self.dn, {'description': ['c']})
+            
+    def test_iter_objects_paged(self):
+        """Iterate a search in pages; yield every entry, a page a search."""
+        names = ['testSpokeLDAPPaged%s' % i for i in range(5)]
+        for name in names:
+            self.add('o=%s,%s' % (name, self.base_dn), {'o': [name]})
+        ldap_helper = self.connect()
+        ldap_helper.page_size = 2
+        self.searches()
+        result = [dn for (dn, attrs) in ldap_helper._iter_objects(self.base_dn,
+                                        ldap.SCOPE_SUBTREE, 'o=testSpokeLDAPPaged*')]
+        self.assertEqual(result, ['o=%s,%s' % (name, self.base_dn)
+                                  for name in names])
+        self.assertEqual(self.searches(), 3)
+        
+    def test_iter_objects_with_other_calls(self):
+        """Search and write while iterating a paged search with one pooled
+        connection; lend it rather than wait for it."""
+        self.config.set('LDAP', 'pool_size', '1')
+        names = ['testSpokeLDAPPaged%s' % i for i in range(5)]
+        for name in names:
+            self.add('o=%s,%s' % (name, self.base_dn), {'o': [name]})
+        ldap_helper = self.connect()
+        ldap_helper.page_size = 2
+        result = []
+        for (dn, attrs) in ldap_helper._iter_objects(self.base_dn,
+                                ldap.SCOPE_SUBTREE, 'o=testSpokeLDAPPaged*'):
+            found = ldap_helper._get_object(dn, ldap.SCOPE_BASE)
+            self.assertEqual(found['count'], 1)
+            ldap_helper._modify_attributes(dn, {'description': ['seen']})
+            result.append(dn)
+        self.assertEqual(len(result), 5)
+        self.assertEqual(self.entry(result[-1])['description'], ['seen'])
+        self.assertEqual(ldap_helper.LDAPConn.idle.qsize(), 1)
+        
+    def test_iter_objects_server_down(self):
+        """Iterate a paged search on a connection the server dropped; 
+        search again on a fresh connection and yield every entry."""
+        names = ['testSpokeLDAPPaged%s' % i for i in range(3)]
+        for name in names:
+            self.add('o=%s,%s' % (name, self.base_dn), {'o': [name]})
+        ldap_helper = self.connect()
+        ldap_helper.page_size = 2
+        dead = FakeLDAPObject.opened[-1]
+        dead.alive = False
+        result = ldap_helper._get_object(self.base_dn, ldap.SCOPE_SUBTREE,
+                                         'o=testSpokeLDAPPaged*')
+        self.assertEqual([dn for (dn, attrs) in result['data']],
+                         ['o=%s,%s' % (name, self.base_dn) for name in names])
+        self.assertEqual(len(FakeLDAPObject.opened), 2)
+        self.assertFalse(dead in [item[0] for item in 
+                ldap_helper.LDAPConn.idle.queue if item is not None])
+        
+    def test_iter_objects_closed_early(self):
+        """Stop iterating a paged search; return its connection."""
+        self.config.set('LDAP', 'pool_size', '1')
+        for i in range(5):
+            name = 'testSpokeLDAPPaged%s' % i
+            self.add('o=%s,%s' % (name, self.base_dn), {'o': [name]})
+        ldap_helper = self.connect()
+        ldap_helper.page_size = 2
+        entries = ldap_helper._iter_objects(self.base_dn, ldap.SCOPE_SUBTREE,
+                                            'o=testSpokeLDAPPaged*')
+        entries.next()
+        self.assertEqual(ldap_helper.LDAPConn.idle.qsize(), 0)
+        entries.close()
+        self.assertEqual(ldap_helper.LDAPConn.idle.qsize(), 1)
+        
+    def test_validate_present_entry(self):
+        """Validate an entry which exists, asking only for its dn; pass
+        validate exists and raise AlreadyExists on validate missing."""
+        self.add(self.dn, {'o': ['testSpokeLDAPFake']})
+        ldap_helper = self.connect()
+        ldap_helper.search_scope = ldap.SCOPE_SUBTREE
+        FakeLDAPObject.attrlists = []
+        FakeLDAPObject.refuse_txn = False
+        FakeLDAPObject.txns = {}
+        self.assertTrue(ldap_helper._validate_exists(self.dn))
+        self.assertTrue(ldap_helper._validate_exists(self.base_dn,
+                                                'o=testSpokeLDAPFake'))
+        self.assertRaises(error.AlreadyExists, ldap_helper._validate_missing,
+                          self.dn)
+        self.assertRaises(error.AlreadyExists, ldap_helper._validate_missing,
+                          self.base_dn, 'o=testSpokeLDAPFake')
+        self.assertEqual(FakeLDAPObject.attrlists, [directory.NO_ATTRS] * 4)
+        
+    def test_validate_missing_entry(self):
+        """Validate an entry which is missing, or under a missing parent;
+        raise NotFound on validate exists and pass validate missing."""
+        ldap_helper = self.connect()
+        ldap_helper.search_scope = ldap.SCOPE_SUBTREE
+        orphan = 'o=testSpokeLDAPOrphan,%s' % self.dn
+        for (dn, filter) in [(self.dn, None), (orphan, None),
+                             (self.base_dn, 'o=testSpokeLDAPFake')]:
+            self.assertRaises(error.NotFound, ldap_helper._validate_exists,
+                              dn, filter)
+            self.assertTrue(ldap_helper._validate_missing(dn, filter))
+            
+    def test_validate_exists_unique(self):
+        """Validate a filter matching two entries as unique; raise
+        SearchUniqueError."""
+        for name in ['testSpokeLDAPFake1', 'testSpokeLDAPFake2']:
+            self.add('o=%s,%s' % (name, self.base_dn), {'o': [name]})
+        ldap_helper = self.connect()
+        ldap_helper.search_scope = ldap.SCOPE_SUBTREE
+        filter = 'o=testSpokeLDAPFake*'
+        self.assertTrue(ldap_helper._validate_exists(self.base_dn, filter))
+        self.assertRaises(error.SearchUniqueError, 
+                          ldap_helper._validate_exists, self.base_dn, filter,
+                          unique=True)
+        
+    def test_sent_entry(self):
+        """Build the entry from an add and an attribute add; list the
+        values sent."""
+        ldap_helper = self.connect('none')
+        result = ldap_helper._sent_entry(self.dn, self.dn_info)
+        self.assertEqual(result, (self.dn, {'o': ['testSpokeLDAPFake'],
+                                    'objectClass': ['top', 'organization']}))
+        dn_info = [(ldap.MOD_ADD, 'mail', 'x'), (ldap.MOD_ADD, 'mail', ['y'])]
+        result = ldap_helper._sent_entry(self.dn, dn_info)
+        self.assertEqual(result, (self.dn, {'mail': ['x', 'y']}))
+        
+    def unit(self, names):
+        """Return the stages adding self.dn and containers names under it."""
+        children = []
+        for name in names:
+            dn = 'ou=%s,%s' % (name, self.dn)
+            dn_info = [('ou', [name]), 
+                       ('objectClass', ['top', 'organizationalUnit'])]
+            children.append(('add', 'create', dn, dn_info))
+        return [[('add', 'create', self.dn, self.dn_info)], children]
+    
+    def test_write_unit_transaction(self):
+        """Write a unit where transactions are supported; commit it in one
+        transaction and return a result for each write."""
+        FakeLDAPObject.extensions = [directory.TXN_START]
+        ldap_helper = self.connect()
+        results = ldap_helper._write_unit(self.unit(['people', 'groups']))
+        self.assertEqual(FakeLDAPObject.calls.count('extop'), 2)
+        self.assertEqual(FakeLDAPObject.txns, {})
+        self.assertEqual([result['data'][0][0] for result in results],
+                         [self.dn, 'ou=people,%s' % self.dn, 
+                          'ou=groups,%s' % self.dn])
+        self.assertEqual(self.entry('ou=groups,%s' % self.dn), 
+                         {'ou': ['groups']})
+        
+    def test_write_unit_transaction_refused(self):
+        """Write a unit where the server refuses to start a transaction;
+        pipeline the writes instead."""
+        FakeLDAPObject.extensions = [directory.TXN_START]
+        FakeLDAPObject.refuse_txn = True
+        ldap_helper = self.connect()
+        results = ldap_helper._write_unit(self.unit(['people', 'groups']))
+        self.assertEqual(FakeLDAPObject.calls.count('extop'), 1)
+        self.assertEqual([result['data'][0][0] for result in results],
+                         [self.dn, 'ou=people,%s' % self.dn, 
+                          'ou=groups,%s' % self.dn])
+        self.assertEqual(self.entry('ou=groups,%s' % self.dn), 
+                         {'ou': ['groups']})
+        
+    def test_write_unit_transaction_failure(self):
+        """Write a unit that fails mid-way in a transaction; raise the
+        failed write's error and apply nothing."""
+        FakeLDAPObject.extensions = [directory.TXN_START]
+        ldap_helper = self.connect()
+        self.add('ou=groups,%s' % self.dn, {'ou': ['groups']})
+        try:
+            ldap_helper._write_unit(self.unit(['people', 'groups']))
+            self.fail('AlreadyExists not raised')
+        except error.AlreadyExists, e:
+            self.assertTrue('ou=groups,%s' % self.dn in e.msg)
+        self.assertEqual(self.entry(self.dn), None)
+        self.assertEqual(self.entry('ou=people,%s' % self.dn), None)
+        self.assertEqual(FakeLDAPObject.txns, {})
+        
+    def test_write_unit_pipelined_failure(self):
+        """Write a unit that fails mid-way without transactions; raise an
+        error naming each failed write and delete the entries added."""
+        ldap_helper = self.connect()
+        for name in ['groups', 'dns']:
+            self.add('ou=%s,%s' % (name, self.dn), {'ou': [name]})
+        stages = self.unit(['people', 'groups', 'hosts', 'dns'])
+        try:
+            ldap_helper._write_unit(stages)
+            self.fail('AlreadyExists not raised')
+        except error.AlreadyExists, e:
+            self.assertTrue('ou=groups,%s' % self.dn in e.msg)
+            self.assertTrue('ou=dns,%s' % self.dn in e.msg)
+            self.assertFalse('ou=people,%s' % self.dn in e.msg)
+        self.assertEqual(FakeLDAPObject.calls.count('extop'), 0)
+        self.assertEqual(self.entry('ou=people,%s' % self.dn), None)
+        self.assertEqual(self.entry('ou=hosts,%s' % self.dn), None)
+        self.assertEqual(self.entry('ou=groups,%s' % self.dn), 
+                         {'ou': ['groups']})
+        # The parent keeps the children it already had, so stays too
+        self.assertEqual(self.entry(self.dn), {'o': ['testSpokeLDAPFake']})
+        
+class FakeKVConn(object):
+    
+    """Stand-in for SpokeKVConn holding an in-memory Redis."""
+    
+    def __init__(self):
+        self.KV = fakeredis.FakeStrictRedis()
+
+class SpokeSearchCacheKVTest(FakeLDAPTestCase):
+    
+    """A class for testing the Redis search cache and its watcher."""
+    
+    def setUp(self):
+        FakeLDAPTestCase.setUp(self)
+        self.kv = kv.kvLDAP
+        kv.kvLDAP = FakeKVConn()
+        self.bases = []
+        for name in ['testSpokeCacheA', 'testSpokeCacheB']:
+            dn = 'o=%s,%s' % (name, self.base_dn)
+            self.add(dn, {'o': [name]})
+            self.bases.append(dn)
+        self.ldap_helper = self.connect()
+        self.ldap_helper.search_cache = directory.SpokeSearchCacheKV()
+        
+    def tearDown(self):
+        kv.kvLDAP = self.kv
+        FakeLDAPTestCase.tearDown(self)
+        
+    def search(self, dn):
+        """Search below dn; return the number of LDAP searches run."""
+        FakeLDAPObject.calls = []
+        self.ldap_helper._get_object(dn, ldap.SCOPE_SUBTREE)
+        return FakeLDAPObject.calls.count('search')
+        
+    def test_search_cached(self):
+        """Search a base twice; answer the second search from Redis."""
+        self.assertEqual(self.search(self.bases[0]), 1)
+        self.assertEqual(self.search(self.bases[0]), 0)
+        
+    def test_write_invalidates_base(self):
+        """Write below one cached base; search it and every base above it
+        again, leaving other bases cached."""
+        for dn in [self.base_dn] + self.bases:
+            self.search(dn)
+        self.ldap_helper._modify_attributes(self.bases[0], 
+                                            {'description': ['changed']})
+        self.assertEqual(self.search(self.bases[0]), 1)
+        self.assertEqual(self.search(self.base_dn), 1)
+        self.assertEqual(self.search(self.bases[1]), 0)
+        
+    def test_write_above_invalidates_base(self):
+        """Delete the entry above a cached base; search the base again."""
+        child = 'ou=testSpokeCacheChild,%s' % self.bases[1]
+        self.add(child, {'ou': ['testSpokeCacheChild']})
+        self.search(child)
+        self.search(self.bases[0])
+        self.ldap_helper._delete_object(child)
+        self.ldap_helper._modify_attributes(self.bases[1],
+                                            {'description': ['changed']})
+        self.assertEqual(self.search(child), 1)
+        self.assertEqual(self.search(self.bases[0]), 0)
+        
+    def test_keys_expire(self):
+        """Cache searches; give every key but the generation a TTL."""
+        for dn in [self.base_dn] + self.bases:
+            self.search(dn)
+        self.ldap_helper._modify_attributes(self.bases[0], 
+                                            {'description': ['changed']})
+        self.search(self.bases[0])
+        redis = kv.kvLDAP.KV
+        keys = [key for key in redis.keys('spoke:ldap:*')
+                if key != 'spoke:ldap:generation']
+        self.assertTrue(keys)
+        for key in keys:
+            self.assertTrue(redis.ttl(key) > 0, key)
+            
+    def test_watcher_invalidates_after_refresh(self):
+        """Report a change to the watcher; drop the cached search once the
+        initial refresh is done."""
+        watcher = directory.SpokeLDAPWatcher(self.ldap_helper.search_cache)
+        self.search(self.bases[0])
+        watcher.changed(self.bases[0])
+        self.assertEqual(self.search(self.bases[0]), 0)
+        watcher.refreshed = True
+        watcher.changed(self.bases[0])
+        self.assertEqual(self.search(self.bases[0]), 1)
 
 class SpokeLDAPTest(unittest.TestCase):
     
@@ -126,5 +1030,78 @@ class SpokeLDAPTest(unittest.TestCase):
             dn = '%s,%s' % (org, base_dn)
             self.ldap.LDAP.delete_s(dn)  
         
+    def test_spoke_LDAP_bulk_create_delete(self):
+        """Bulk create and delete return a result or error per entry, in order."""
+        org_names = ['testSpokeLDAPBulk%s' % i for i in range(5)]
+        entries = []
+        for org_name in org_names:
+            dn = 'o=%s,%s' % (org_name, self.base_dn)
+            dn_info = [('o', [org_name]), 
+                       ('objectClass', ['top', 'organization'])]
+            entries.append((dn, dn_info))
+        entries.append(entries[2]) # Duplicate
+        results = self.ldap._create_objects(entries)
+        for result in results[:5]:
+            self.assertEqual(result['exit_code'], 0)
+        self.assertTrue(isinstance(results[5], error.AlreadyExists))
+        dns = [dn for (dn, dn_info) in entries[:5]]
+        dns.insert(1, 'o=testSpokeLDAPBulkMissing,%s' % self.base_dn)
+        results = self.ldap._delete_objects(dns)
+        self.assertTrue(isinstance(results[1], error.NotFound))
+        for result in results[:1] + results[2:]:
+            self.assertEqual(result['exit_code'], 3)
+        
+    def test_spoke_LDAP_iter_objects_paged(self):
+        """Paged iteration yields every entry across several pages."""
+        org_names = ['testSpokeLDAPPaged%s' % i for i in range(5)]
+        for org_name in org_names:
+            dn = 'o=%s,%s' % (org_name, self.base_dn)
+            dn_attributes = [('o', [org_name]), 
+                             ('objectClass', ['top', 'organization'])]
+            self.ldap.LDAP.add_s(dn, dn_attributes)
+        self.ldap.page_size = 2
+        search_filter = 'o=testSpokeLDAPPaged*'
+        result = [dn for (dn, attrs) in self.ldap._iter_objects(self.base_dn,
+                                            self.search_scope, search_filter)]
+        expected_result = ['o=%s,%s' % (org_name, self.base_dn) 
+                           for org_name in org_names]
+        self.assertEqual(sorted(result), expected_result)
+        for dn in expected_result:
+            self.ldap.LDAP.delete_s(dn)
+        
+    def test_spoke_LDAP_dn_cache_invalidated_on_delete(self):
+        """Resolved objects are cached until a write to their dn."""
+        org_name = 'testSpokeLDAPDNCache'
+        dn = 'o=%s,%s' % (org_name, self.base_dn)
+        dn_attributes = [('o', [org_name]), 
+                         ('objectClass', ['top', 'organization'])]
+        self.ldap._create_object(dn, dn_attributes)
+        lookup = lambda: self.ldap._get_object(dn, 0)
+        result = self.ldap._resolve('org', org_name, lookup)
+        self.assertEqual(result['data'][0][0], dn)
+        self.assertEqual(self.ldap.dn_cache.get(('org', org_name)), result)
+        self.ldap._delete_object(dn)
+        self.assertEqual(self.ldap.dn_cache.get(('org', org_name)), None)
+        result = self.ldap._resolve('org', org_name, lookup)
+        self.assertEqual(result['data'], [])
+        
+    def test_spoke_LDAP_search_cache_invalidated_on_create(self):
+        """A cached search is dropped when an entry is created under it."""
+        org_name = 'testSpokeLDAPSearchCache'
+        dn = 'o=%s,%s' % (org_name, self.base_dn)
+        search_filter = 'o=%s' % org_name
+        self.ldap.search_cache = directory.SpokeSearchCache()
+        result = self.ldap._get_object(self.base_dn, self.search_scope,
+                                       search_filter)['data']
+        self.assertEqual(result, [])
+        dn_attributes = [('o', [org_name]), 
+                         ('objectClass', ['top', 'organization'])]
+        self.ldap._create_object(dn, dn_attributes)
+        result = self.ldap._get_object(self.base_dn, self.search_scope,
+                                       search_filter, ['o'])['data']
+        self.assertEqual(result, [(dn, {'o': [org_name]})])
+        self.ldap._delete_object(dn)
+        self.ldap.search_cache = None
+        
 if __name__ == "__main__":
     unittest.main()
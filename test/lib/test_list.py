@@ -119,6 +119,20 @@ class TestSpokeMailingList(unittest.TestCase):
         expected_result = [(dn, dn_info)]
         self.assertEqual(result, expected_result)
         
+    def test_get_mailing_list_with_members(self):
+        """Retrieve a mailing list with two members; return every member,
+        as member lookups read them from the list entry."""
+        member_address = 'testgetmember@testdomain.loc'
+        member = SpokeMailingListMember(self.org_name, self.list_address)
+        member.create(member_address)
+        list = SpokeMailingList(self.org_name)
+        result = list.get(self.list_address)['data'][0][1]
+        self.assertTrue(self.list_class in result['objectClass'])
+        self.assertEqual(result[self.list_destination_attr],
+                         [self.list_member, member_address])
+        member = SpokeMailingListMember(self.org_name, self.list_address)
+        self.assertEqual(member.get(member_address)['count'], 1)
+        
     def test_get_all_mailing_lists(self):
         """Retrieve all mailing lists; return results object."""      
         expected_result = []
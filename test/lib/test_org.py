@@ -7,6 +7,8 @@ import spoke.lib.config as config
 import spoke.lib.log as logger
 from spoke.lib.org import SpokeOrg
 from spoke.lib.org import SpokeOrgChild
+from spoke.lib.directory import SpokeLDAP, TXN_START
+from test_ldap_helper import FakeLDAPTestCase, FakeLDAPObject
 
 class SpokeOrgTest(unittest.TestCase):
     
@@ -145,6 +147,27 @@ class SpokeOrgTest(unittest.TestCase):
         self.assertEqual(result, expected_result)        
         org.delete(org_name, self.org_children)
     
+    def test_spoke_org_get_projection(self):
+        """Get an org and its child; return the attributes org lookups use."""
+        org = SpokeOrg()
+        org.modify(self.org_name, self.org_suffix_name)
+        dn = '%s=%s,%s' % (self.org_attr, self.org_name, self.base_dn)
+        entry = SpokeLDAP()._get_object(dn, 0)['data'][0][1]
+        result = org.get(self.org_name)['data']
+        self.assertEqual(result[0][0], dn)
+        attrs = result[0][1]
+        for attr in ['objectClass', self.org_attr, self.org_suffix_attr]:
+            self.assertEqual(attrs[attr], entry[attr])
+        for attr in attrs:
+            self.assertTrue(attr in org.projection)
+        child_name = self.org_children[0]
+        child = SpokeOrgChild(self.org_name)
+        self.assertEqual(child.org_dn, dn)
+        result = child.get(child_name)['data'][0][1]
+        expected_result = {'objectClass': ['top', self.container_class],
+                           self.container_attr: [child_name]}
+        self.assertEqual(result, expected_result)
+        
     def test_spoke_org_delete(self):
         """Delete an org; return True."""
         org_name = 'testSpokeOrgDelete'
@@ -240,5 +263,119 @@ class SpokeOrgTest(unittest.TestCase):
         child = SpokeOrgChild(self.org_name)
         self.assertRaises(error.NotFound, child.delete, child_name)
 
+class SpokeOrgUnitTest(FakeLDAPTestCase):
+    
+    """A class for testing org writes as one unit, with and without LDAP
+    transactions, against an in-memory directory."""
+    
+    def setUp(self):
+        FakeLDAPTestCase.setUp(self)
+        self.org_name = 'testSpokeOrgUnit'
+        self.org_dn = 'o=%s,%s' % (self.org_name, self.base_dn)
+        self.org_children = self.config.get('ATTR_MAP', 
+                                            'org_def_children').split(',')
+        self.container_attr = self.config.get('ATTR_MAP', 'container_attr')
+        self.connect()
+        
+    def child_dn(self, child_name):
+        return '%s=%s,%s' % (self.container_attr, child_name, self.org_dn)
+    
+    def test_create_in_transaction(self):
+        """Create an org where transactions are supported; commit the org
+        and its children in one transaction."""
+        FakeLDAPObject.extensions = [TXN_START]
+        result = SpokeOrg().create(self.org_name)
+        self.assertEqual(result['data'][0][0], self.org_dn)
+        self.assertEqual(FakeLDAPObject.calls.count('extop'), 2)
+        for child_name in self.org_children:
+            self.assertEqual(self.entry(self.child_dn(child_name)),
+                             {self.container_attr: [child_name]})
+            
+    def test_create_transaction_refused(self):
+        """Create an org where the server refuses a transaction; create the
+        org and its children without one."""
+        FakeLDAPObject.extensions = [TXN_START]
+        FakeLDAPObject.refuse_txn = True
+        result = SpokeOrg().create(self.org_name)
+        self.assertEqual(result['data'][0][0], self.org_dn)
+        for child_name in self.org_children:
+            self.assertEqual(self.entry(self.child_dn(child_name)),
+                             {self.container_attr: [child_name]})
+        
+    def test_create_with_failed_child_in_transaction(self):
+        """Create an org whose child fails in a transaction; raise 
+        AlreadyExists naming the child and create nothing."""
+        FakeLDAPObject.extensions = [TXN_START]
+        failed = self.org_children[-1]
+        self.add(self.child_dn(failed), {self.container_attr: [failed]})
+        try:
+            SpokeOrg().create(self.org_name)
+            self.fail('AlreadyExists not raised')
+        except error.AlreadyExists, e:
+            self.assertTrue(self.child_dn(failed) in e.msg)
+        self.assertEqual(self.entry(self.org_dn), None)
+        for child_name in self.org_children[:-1]:
+            self.assertEqual(self.entry(self.child_dn(child_name)), None)
+        
+    def test_create_with_failed_children(self):
+        """Create an org whose children fail without transactions; raise 
+        AlreadyExists naming each failed child and delete those created."""
+        failed = self.org_children[1:]
+        for child_name in failed:
+            self.add(self.child_dn(child_name), 
+                     {self.container_attr: [child_name]})
+        try:
+            SpokeOrg().create(self.org_name)
+            self.fail('AlreadyExists not raised')
+        except error.AlreadyExists, e:
+            for child_name in failed:
+                self.assertTrue(self.child_dn(child_name) in e.msg)
+        self.assertEqual(self.entry(self.child_dn(self.org_children[0])), 
+                         None)
+        
+    def test_delete_in_transaction(self):
+        """Delete an org where transactions are supported; delete the org
+        and its children in one transaction."""
+        FakeLDAPObject.extensions = [TXN_START]
+        org = SpokeOrg()
+        org.create(self.org_name)
+        FakeLDAPObject.calls = []
+        org.delete(self.org_name)
+        self.assertEqual(FakeLDAPObject.calls.count('extop'), 2)
+        self.assertEqual(self.entry(self.org_dn), None)
+        for child_name in self.org_children:
+            self.assertEqual(self.entry(self.child_dn(child_name)), None)
+            
+    def test_delete_with_grandchild_in_transaction(self):
+        """Delete an org whose child has children in a transaction; raise
+        SaveTheBabies and delete nothing."""
+        FakeLDAPObject.extensions = [TXN_START]
+        org = SpokeOrg()
+        org.create(self.org_name)
+        child_dn = self.child_dn(self.org_children[-1])
+        self.add('cn=orphan,%s' % child_dn, {'cn': ['orphan']})
+        self.assertRaises(error.SaveTheBabies, org.delete, self.org_name)
+        for child_name in self.org_children:
+            self.assertEqual(self.entry(self.child_dn(child_name)),
+                             {self.container_attr: [child_name]})
+            
+    def test_delete_with_grandchild(self):
+        """Delete an org whose child has children without transactions; 
+        raise SaveTheBabies, leaving the other children deleted."""
+        org = SpokeOrg()
+        org.create(self.org_name)
+        child_dn = self.child_dn(self.org_children[-1])
+        self.add('cn=orphan,%s' % child_dn, {'cn': ['orphan']})
+        try:
+            org.delete(self.org_name)
+            self.fail('SaveTheBabies not raised')
+        except error.SaveTheBabies, e:
+            self.assertTrue(child_dn in e.msg)
+        self.assertEqual(self.entry(child_dn), 
+                         {self.container_attr: [self.org_children[-1]]})
+        for child_name in self.org_children[:-1]:
+            self.assertEqual(self.entry(self.child_dn(child_name)), None)
+        self.assertEqual(self.entry(self.org_dn), {'o': [self.org_name]})
+
 if __name__ == "__main__":
     unittest.main()
@@ -7,6 +7,7 @@ import spoke.lib.config as config
 import spoke.lib.log as logger
 from spoke.lib.org import SpokeOrg
 from spoke.lib.user import SpokeUser
+from spoke.lib.vcs import SpokeSVN
 
 class SpokeUserTest(unittest.TestCase):
     
@@ -96,6 +97,19 @@ class SpokeUserTest(unittest.TestCase):
         result = user.get(self.first)['data']
         self.assertEqual(result, expected_result)
     
+    def test_get_user_with_svn_repo(self):
+        """Retrieve a user with a svn repo; return the svn attributes the
+        VCS module reads as well."""
+        svn_class = self.config.get('VCS', 'svn_class')
+        svn_repo_attr = self.config.get('VCS', 'svn_repo_attr')
+        svn = SpokeSVN(self.org_name, self.user_id)
+        svn.create('main')
+        user = SpokeUser(self.org_name)
+        result = user.get(self.first)['data'][0][1]
+        self.assertTrue(svn_class in result['objectClass'])
+        self.assertEqual(result[svn_repo_attr], ['main'])
+        self.assertEqual(result[self.user_key], [self.user_id])
+        
     def test_get_missing_user(self):
         """Retrieve a missing user account; return an empty list."""
         user_id = 'missinguser'